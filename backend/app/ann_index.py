@@ -0,0 +1,735 @@
+"""
+进程内的近似最近邻索引（IVF-Flat，纯 NumPy），用于"查找相似图片"。
+
+  - 向量归一化后用内积作为余弦相似度
+  - 主段：球面 k-means 得到 nlist 个聚类中心，向量按所属聚类连续存放在内存映射文件里，
+    查询时只扫描离查询向量最近的 nprobe 个聚类
+  - 尾段：上次全量构建之后新增/修改的向量，按主段的聚类中心分组存放，
+    查询时与主段的同一个聚类一起扫描
+  - 增量更新按 images / image_features 的 updated_at 水位读取变化的行（与 meilisearch_sync 相同），
+    旧位置标记为失效，新向量追加到尾段；尾段过大时全量重建
+  - 按数据集过滤时，如果选中的数据集向量很少（不超过 EXACT_FILTER_ROWS），直接在这些行上精确计算
+
+磁盘布局（settings.ann_index_dir）。已发布的目录不再修改：每次全量构建或增量更新都写一个新目录，
+最后原子替换 CURRENT 发布：
+  CURRENT                当前一代的目录名
+  main-<时间戳>/         主段，全量构建时写入
+    centroids.npy        (nlist, dim) 聚类中心
+    vectors.f32          (n, dim) 主段向量，按聚类排序，内存映射只读
+    list_offsets.npy     (nlist+1,) 每个聚类在主段中的起止行
+    ids.npy / dataset_idx.npy             主段每行的图片 id / 数据集下标
+    sorted_ids.npy / id_order.npy         按 id 排序的查找表
+    dataset_order.npy / dataset_offsets.npy  按数据集分组的行号
+  gen-<时间戳>/          一代索引
+    meta.json            维度、水位、catalog_version、所用主段的目录名
+    datasets.json        数据集 id 列表，向量的数据集用列表下标表示
+    alive.npy            主段每行是否有效
+    tail_*.npy           尾段，tail_list_offsets.npy 为每个聚类在尾段中的起止行
+
+每个 uvicorn 进程都有自己的 AnnIndex，但只有取得 advisory lock 的进程构建、发布新的一代并清理旧目录，
+其它进程只读取 CURRENT 指向的那一代。
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import func, select, union
+
+from .config import settings
+from .crud import get_catalog_version
+from .database import AsyncSessionLocal
+from .models import Image, ImageFeatures, ImageTombstone
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_ROWS = 5000              # 从数据库读向量时服务端游标每次取的行数
+ASSIGN_CHUNK_ROWS = 65536           # 分配聚类 / 重排主段时每块的行数
+TRAIN_SAMPLE = 100_000              # k-means 训练采样数
+KMEANS_ITERS = 10
+DEFAULT_NPROBE = 16
+EXACT_FILTER_ROWS = 4_096           # 过滤后行数不超过此值时直接精确计算（从内存映射随机读取，不宜过大）
+TAIL_REBUILD_MIN = 50_000           # 尾段超过 max(此值, 主段 * 比例) 时全量重建
+TAIL_REBUILD_RATIO = 0.1
+WATERMARK_OVERLAP = timedelta(minutes=5)
+KEEP_GENERATIONS = 3                # 保留最近几代，其它进程可能还在加载较旧的一代
+
+# 所有进程共用的 advisory lock 键，保证同一时刻只有一个进程构建和发布索引
+ANN_INDEX_LOCK_ID = 0x414E4E1D
+
+ID_DTYPE = "S16"                    # uuid.bytes
+
+
+def _id_key(image_id: uuid.UUID) -> bytes:
+    return image_id.bytes
+
+
+def _key_id(key: bytes) -> uuid.UUID:
+    # numpy 的 S 类型会去掉末尾的 \0，还原时补齐
+    return uuid.UUID(bytes=key.ljust(16, b"\0"))
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return x / norms
+
+
+def assign_lists(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """每行分配到内积最大的聚类中心"""
+    out = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), ASSIGN_CHUNK_ROWS):
+        chunk = np.asarray(x[start:start + ASSIGN_CHUNK_ROWS], dtype=np.float32)
+        out[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return out
+
+
+def train_kmeans(sample: np.ndarray, nlist: int, iters: int = KMEANS_ITERS, seed: int = 0) -> np.ndarray:
+    """球面 k-means：中心每轮取成员均值后重新归一化，空聚类从样本中重新选点"""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = assign_lists(sample, centroids)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=nlist)
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        centroids[nonempty] = np.add.reduceat(sample[order], starts, axis=0)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), len(empty))]
+        centroids = normalize(centroids)
+    return centroids
+
+
+def _group_offsets(keys: np.ndarray, num_groups: int) -> np.ndarray:
+    return np.concatenate([[0], np.cumsum(np.bincount(keys, minlength=num_groups))]).astype(np.int64)
+
+
+def _new_name(prefix: str) -> str:
+    """主段 / 代的目录名，按名字排序即按创建时间排序"""
+    return f"{prefix}-{time.time_ns():020d}-{os.getpid()}"
+
+
+def read_current(root: Path) -> Optional[str]:
+    """CURRENT 指向的代的目录名，尚未发布过时返回 None"""
+    try:
+        name = (root / "CURRENT").read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return None
+    return name or None
+
+
+def publish_generation(root: Path, name: str):
+    """原子替换 CURRENT，读者要么看到旧的一代，要么看到新的一代"""
+    tmp = root / f"CURRENT.tmp.{os.getpid()}"
+    tmp.write_text(name, encoding="utf-8")
+    os.replace(tmp, root / "CURRENT")
+
+
+@dataclass(frozen=True)
+class IndexSnapshot:
+    """
+    某一时刻的完整索引。快照不可变：更新时构造新快照再整体替换，
+    正在执行的查询继续使用旧快照。
+    """
+    dim: int
+    watermark: Optional[datetime]
+    catalog_version: Optional[int]
+    datasets: Tuple[str, ...]
+    centroids: np.ndarray
+    vectors: np.ndarray
+    list_offsets: np.ndarray
+    ids: np.ndarray
+    dataset_idx: np.ndarray
+    sorted_ids: np.ndarray
+    id_order: np.ndarray
+    dataset_order: np.ndarray
+    dataset_offsets: np.ndarray
+    alive: np.ndarray
+    tail_vectors: np.ndarray
+    tail_ids: np.ndarray
+    tail_dataset_idx: np.ndarray
+    tail_list_offsets: np.ndarray       # 尾段按聚类分组，(nlist+1,)；还没有主段时整个尾段是一组
+    main_segment: Optional[str] = None  # 主段目录名
+    generation: Optional[str] = None    # 从哪一代加载，尚未发布时为 None
+
+    @property
+    def size(self) -> int:
+        return int(self.alive.sum()) + len(self.tail_ids)
+
+    def dataset_index(self) -> Dict[str, int]:
+        return {d: i for i, d in enumerate(self.datasets)}
+
+    def main_rows_of(self, keys: np.ndarray) -> np.ndarray:
+        """主段中这些 id 所在的行（不存在的忽略）"""
+        if not len(self.ids) or not len(keys):
+            return np.empty(0, dtype=np.int64)
+        pos = np.searchsorted(self.sorted_ids, keys)
+        pos = np.minimum(pos, len(self.sorted_ids) - 1)
+        found = self.sorted_ids[pos] == keys
+        return self.id_order[pos[found]]
+
+    def vector_of(self, image_id: uuid.UUID) -> Optional[np.ndarray]:
+        key = np.array([_id_key(image_id)], dtype=ID_DTYPE)
+        hit = np.flatnonzero(self.tail_ids == key[0])
+        if len(hit):
+            return np.asarray(self.tail_vectors[hit[-1]])
+        rows = self.main_rows_of(key)
+        if len(rows) and self.alive[rows[0]]:
+            return np.asarray(self.vectors[rows[0]])
+        return None
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        dataset_ids: Optional[Sequence[str]] = None,
+        nprobe: int = DEFAULT_NPROBE,
+        exclude: Optional[uuid.UUID] = None
+    ) -> List[Tuple[uuid.UUID, float]]:
+        """
+        返回相似度最高的 k 个 (图片 id, 余弦相似度)，按相似度降序。
+        dataset_ids 不为 None 时只在这些数据集中查找。
+        """
+        q = normalize(query)
+        allowed = None
+        if dataset_ids is not None:
+            index = self.dataset_index()
+            allowed = np.zeros(len(self.datasets), dtype=bool)
+            allowed[[index[str(d)] for d in dataset_ids if str(d) in index]] = True
+            if not allowed.any():
+                return []
+        # 多取一个，给 exclude 留余量
+        want = k + (1 if exclude is not None else 0)
+
+        cand_ids, cand_scores = [], []
+
+        rows = tail_rows = None
+        if allowed is not None:
+            # 增量更新新出现的数据集只在尾段里
+            ds = np.flatnonzero(allowed[:len(self.dataset_offsets) - 1])
+            sizes = self.dataset_offsets[ds + 1] - self.dataset_offsets[ds]
+            tail_rows = np.flatnonzero(allowed[self.tail_dataset_idx])
+            if sizes.sum() + len(tail_rows) <= EXACT_FILTER_ROWS:
+                rows = np.concatenate(
+                    [np.empty(0, dtype=np.int64)]
+                    + [self.dataset_order[self.dataset_offsets[d]:self.dataset_offsets[d + 1]] for d in ds]
+                )
+                rows = np.sort(rows[self.alive[rows]])
+
+        if rows is not None or not len(self.centroids):
+            # 选中的向量很少，或者还没有主段（尾段不会超过 TAIL_REBUILD_MIN）：精确计算
+            if rows is not None and len(rows):
+                cand_ids.append(self.ids[rows])
+                cand_scores.append(np.asarray(self.vectors[rows]) @ q)
+            if tail_rows is None:
+                tail_rows = np.arange(len(self.tail_ids))
+            if len(tail_rows):
+                cand_ids.append(self.tail_ids[tail_rows])
+                cand_scores.append(np.asarray(self.tail_vectors[tail_rows]) @ q)
+        else:
+            self._probe(q, want, allowed, nprobe, cand_ids, cand_scores)
+
+        if not cand_ids:
+            return []
+        ids = np.concatenate(cand_ids)
+        scores = np.concatenate(cand_scores)
+        if exclude is not None:
+            keep = ids != np.array(_id_key(exclude), dtype=ID_DTYPE)
+            ids, scores = ids[keep], scores[keep]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(_key_id(ids[i]), float(scores[i])) for i in top]
+
+    def _probe(self, q, want, allowed, nprobe, cand_ids, cand_scores):
+        """
+        按离查询向量由近到远的顺序扫描聚类（主段和尾段中属于该聚类的行），
+        至少扫 nprobe 个且凑够 want 个候选为止
+        """
+        nlist = len(self.centroids)
+        list_order = np.argsort(-(self.centroids @ q))
+        found = 0
+        for probed, lst in enumerate(list_order):
+            if probed >= nprobe and found >= want:
+                break
+            segments = (
+                (self.ids, self.vectors, self.dataset_idx, self.alive,
+                 int(self.list_offsets[lst]), int(self.list_offsets[lst + 1])),
+                (self.tail_ids, self.tail_vectors, self.tail_dataset_idx, None,
+                 int(self.tail_list_offsets[lst]), int(self.tail_list_offsets[lst + 1])),
+            )
+            for ids, vectors, dataset_idx, alive, start, end in segments:
+                if start == end:
+                    continue
+                mask = alive[start:end] if alive is not None else np.ones(end - start, dtype=bool)
+                if allowed is not None:
+                    mask = mask & allowed[dataset_idx[start:end]]
+                if not mask.any():
+                    continue
+                rows = np.flatnonzero(mask) + start
+                cand_ids.append(ids[rows])
+                cand_scores.append(np.asarray(vectors[start:end])[mask] @ q)
+                found += len(rows)
+        logger.debug("ann probe: %d/%d lists, %d candidates", min(probed + 1, nlist), nlist, found)
+
+
+def empty_snapshot(dim: int = 0, watermark=None, catalog_version=None) -> IndexSnapshot:
+    return IndexSnapshot(
+        dim=dim,
+        watermark=watermark,
+        catalog_version=catalog_version,
+        datasets=(),
+        centroids=np.empty((0, dim), dtype=np.float32),
+        vectors=np.empty((0, dim), dtype=np.float32),
+        list_offsets=np.zeros(1, dtype=np.int64),
+        ids=np.empty(0, dtype=ID_DTYPE),
+        dataset_idx=np.empty(0, dtype=np.int32),
+        sorted_ids=np.empty(0, dtype=ID_DTYPE),
+        id_order=np.empty(0, dtype=np.int64),
+        dataset_order=np.empty(0, dtype=np.int64),
+        dataset_offsets=np.zeros(1, dtype=np.int64),
+        alive=np.empty(0, dtype=bool),
+        tail_vectors=np.empty((0, dim), dtype=np.float32),
+        tail_ids=np.empty(0, dtype=ID_DTYPE),
+        tail_dataset_idx=np.empty(0, dtype=np.int32),
+        tail_list_offsets=np.zeros(1, dtype=np.int64),
+    )
+
+
+def load_snapshot(path: Path) -> Optional[IndexSnapshot]:
+    """从一代索引的目录加载，主段向量以只读内存映射打开；目录不完整时返回 None"""
+    meta_path = path / "meta.json"
+    if not meta_path.exists():
+        return None
+    meta = json.loads(meta_path.read_text(encoding="utf-8"))
+    dim = meta["dim"]
+    main = path.parent / meta["main"]
+    # 与行数成正比的大数组都以只读内存映射打开（已发布的目录不会再被修改），alive 和尾段的 id 较小，读入内存
+    ids = np.load(main / "ids.npy", mmap_mode="r")
+    vectors = (
+        np.memmap(main / "vectors.f32", dtype=np.float32, mode="r", shape=(len(ids), dim))
+        if len(ids) else np.empty((0, dim), dtype=np.float32)
+    )
+    return IndexSnapshot(
+        dim=dim,
+        watermark=datetime.fromisoformat(meta["watermark"]) if meta.get("watermark") else None,
+        catalog_version=meta.get("catalog_version"),
+        datasets=tuple(json.loads((path / "datasets.json").read_text(encoding="utf-8"))),
+        centroids=np.load(main / "centroids.npy"),
+        vectors=vectors,
+        list_offsets=np.load(main / "list_offsets.npy"),
+        ids=ids,
+        dataset_idx=np.load(main / "dataset_idx.npy", mmap_mode="r"),
+        sorted_ids=np.load(main / "sorted_ids.npy", mmap_mode="r"),
+        id_order=np.load(main / "id_order.npy", mmap_mode="r"),
+        dataset_order=np.load(main / "dataset_order.npy", mmap_mode="r"),
+        dataset_offsets=np.load(main / "dataset_offsets.npy"),
+        alive=np.load(path / "alive.npy"),
+        tail_vectors=np.load(path / "tail_vectors.npy", mmap_mode="r"),
+        tail_ids=np.load(path / "tail_ids.npy"),
+        tail_dataset_idx=np.load(path / "tail_dataset_idx.npy"),
+        tail_list_offsets=np.load(path / "tail_list_offsets.npy"),
+        main_segment=meta["main"],
+        generation=path.name,
+    )
+
+
+def save_generation(path: Path, snap: IndexSnapshot):
+    """把一代索引（alive、尾段、数据集列表、meta）写入新目录 path，主段用 snap.main_segment 引用"""
+    path.mkdir(parents=True)
+    np.save(path / "alive.npy", snap.alive)
+    np.save(path / "tail_vectors.npy", snap.tail_vectors)
+    np.save(path / "tail_ids.npy", snap.tail_ids)
+    np.save(path / "tail_dataset_idx.npy", snap.tail_dataset_idx)
+    np.save(path / "tail_list_offsets.npy", snap.tail_list_offsets)
+    (path / "datasets.json").write_text(json.dumps(list(snap.datasets)), encoding="utf-8")
+    (path / "meta.json").write_text(json.dumps({
+        "dim": snap.dim,
+        "watermark": snap.watermark.isoformat() if snap.watermark else None,
+        "catalog_version": snap.catalog_version,
+        "main": snap.main_segment,
+        "size": snap.size,
+    }), encoding="utf-8")
+
+
+def remove_stale_generations(root: Path, keep: int = KEEP_GENERATIONS):
+    """
+    删除较旧的代以及不再被保留的代引用的主段（包括中断的构建留下的目录）。
+    只由持有 advisory lock 的进程调用；其它进程已经打开的内存映射在 Linux 上仍然可读。
+    """
+    current = read_current(root)
+    generations = sorted(p.name for p in root.glob("gen-*") if p.is_dir())
+    kept = set(generations[-keep:])
+    if current is not None:
+        kept.add(current)
+    mains = set()
+    for name in kept:
+        try:
+            mains.add(json.loads((root / name / "meta.json").read_text(encoding="utf-8"))["main"])
+        except (OSError, ValueError, KeyError):
+            pass
+    for p in root.iterdir():
+        if p.is_dir() and ((p.name.startswith("gen-") and p.name not in kept)
+                           or (p.name.startswith("main-") and p.name not in mains)):
+            shutil.rmtree(p, ignore_errors=True)
+
+
+def build_main_segment(path: Path, raw: np.ndarray, ids: np.ndarray, dataset_idx: np.ndarray, num_datasets: int):
+    """
+    由未排序的向量（raw，已归一化）构建主段并写入 path：
+    训练聚类中心 -> 分块分配聚类 -> 按聚类重排向量写入 vectors.f32。返回聚类数
+    """
+    n, dim = raw.shape
+    if n:
+        nlist = max(1, min(n, int(4 * math.sqrt(n))))
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(n, min(n, TRAIN_SAMPLE), replace=False))
+        centroids = train_kmeans(np.asarray(raw[sample_rows]), nlist)
+        assign = assign_lists(raw, centroids)
+        order = np.argsort(assign, kind="stable")
+
+        vectors = np.memmap(path / "vectors.f32", dtype=np.float32, mode="w+", shape=(n, dim))
+        for start in range(0, n, ASSIGN_CHUNK_ROWS):
+            rows = order[start:start + ASSIGN_CHUNK_ROWS]
+            vectors[start:start + len(rows)] = raw[rows]
+        vectors.flush()
+        del vectors
+        list_offsets = _group_offsets(assign, nlist)
+    else:
+        centroids = np.empty((0, dim), dtype=np.float32)
+        order = np.empty(0, dtype=np.int64)
+        list_offsets = np.zeros(1, dtype=np.int64)
+        (path / "vectors.f32").touch()
+
+    ids = ids[order]
+    dataset_idx = dataset_idx[order]
+    np.save(path / "centroids.npy", centroids)
+    np.save(path / "list_offsets.npy", list_offsets)
+    np.save(path / "ids.npy", ids)
+    np.save(path / "dataset_idx.npy", dataset_idx)
+    id_order = np.argsort(ids, kind="stable")
+    np.save(path / "sorted_ids.npy", ids[id_order])
+    np.save(path / "id_order.npy", id_order)
+    np.save(path / "dataset_order.npy", np.argsort(dataset_idx, kind="stable"))
+    np.save(path / "dataset_offsets.npy", _group_offsets(dataset_idx, num_datasets))
+    return len(centroids)
+
+
+def apply_changes(
+    snap: IndexSnapshot,
+    removed: np.ndarray,
+    added_ids: np.ndarray,
+    added_datasets: List[str],
+    added_vectors: np.ndarray,
+    watermark: datetime,
+    catalog_version: int
+) -> IndexSnapshot:
+    """
+    增量更新：removed（以及 added 中已存在的 id）的旧位置失效，added 分配到最近的聚类中心后并入尾段，
+    尾段按聚类重新排序。返回新快照，不修改 snap。
+    """
+    stale = np.concatenate([removed, added_ids]) if len(added_ids) else removed
+
+    alive = snap.alive
+    rows = snap.main_rows_of(np.unique(stale))
+    if len(rows):
+        alive = alive.copy()
+        alive[rows] = False
+
+    keep = ~np.isin(snap.tail_ids, stale)
+    datasets = list(snap.datasets)
+    index = snap.dataset_index()
+    for d in added_datasets:
+        if d not in index:
+            index[d] = len(datasets)
+            datasets.append(d)
+    added_idx = np.array([index[d] for d in added_datasets], dtype=np.int32)
+
+    dim = snap.dim or added_vectors.shape[1]
+    tail_vectors = np.asarray(snap.tail_vectors[keep]) if snap.dim else np.empty((0, dim), dtype=np.float32)
+
+    num_lists = max(1, len(snap.centroids))
+    old_lists = np.repeat(
+        np.arange(len(snap.tail_list_offsets) - 1, dtype=np.int32), np.diff(snap.tail_list_offsets)
+    )[keep]
+    added_lists = (
+        assign_lists(added_vectors, snap.centroids)
+        if len(snap.centroids) else np.zeros(len(added_vectors), dtype=np.int32)
+    )
+    tail_lists = np.concatenate([old_lists, added_lists])
+    order = np.argsort(tail_lists, kind="stable")
+    return replace(
+        snap,
+        dim=dim,
+        watermark=watermark,
+        catalog_version=catalog_version,
+        datasets=tuple(datasets),
+        alive=alive,
+        tail_vectors=np.concatenate([tail_vectors, added_vectors])[order],
+        tail_ids=np.concatenate([snap.tail_ids[keep], added_ids])[order],
+        tail_dataset_idx=np.concatenate([snap.tail_dataset_idx[keep], added_idx])[order],
+        tail_list_offsets=_group_offsets(tail_lists, num_lists),
+    )
+
+
+async def try_lock_ann_index(db) -> bool:
+    """在 db 的当前事务里尝试取得索引构建锁，事务结束时释放"""
+    result = await db.execute(select(func.pg_try_advisory_xact_lock(ANN_INDEX_LOCK_ID)))
+    return bool(result.scalar())
+
+
+class AnnIndex:
+    """
+    持有当前快照，并在 catalog_version 变化后于后台刷新（同一时间只有一个刷新任务）：
+    取得 advisory lock 的进程增量更新或全量重建并发布新的一代，其它进程只重新加载 CURRENT。
+    查询始终使用当前快照，不等待更新。
+    """
+
+    def __init__(self, session_factory, path: Path):
+        self.session_factory = session_factory
+        self.path = Path(path)
+        self.snapshot: Optional[IndexSnapshot] = None
+        self._task: Optional[asyncio.Task] = None
+        self.last_error: Optional[str] = None
+
+    # ---------- 生命周期 ----------
+
+    async def load(self):
+        await self.reload()
+
+    async def reload(self):
+        """CURRENT 指向的代与当前快照不同时加载它"""
+        for attempt in range(3):
+            name = await asyncio.to_thread(read_current, self.path)
+            if name is None or (self.snapshot is not None and self.snapshot.generation == name):
+                return
+            try:
+                snap = await asyncio.to_thread(load_snapshot, self.path / name)
+            except FileNotFoundError:
+                # 加载期间这一代已被持锁进程清理，重新读取 CURRENT
+                if attempt == 2:
+                    raise
+                continue
+            if snap is not None:
+                self.snapshot = snap
+            return
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def schedule_refresh(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.refresh())
+
+    async def ensure_fresh(self, db):
+        """目录版本变化（导入、回收站操作）时安排一次后台更新"""
+        version = await get_catalog_version(db)
+        if self.snapshot is None or self.snapshot.catalog_version != version:
+            self.schedule_refresh()
+
+    async def refresh(self):
+        try:
+            async with self.session_factory() as db:
+                if await try_lock_ann_index(db):
+                    # 先读取其它进程可能已经发布的一代，在它的基础上更新
+                    await self.reload()
+                    snap = self.snapshot
+                    if snap is None or snap.watermark is None:
+                        await self.rebuild()
+                    else:
+                        await self.update()
+                else:
+                    # 另一个进程正在构建，只使用它已经发布的一代
+                    await self.reload()
+            self.last_error = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("ann index refresh failed")
+            self.last_error = str(e)
+
+    # ---------- 读取 ----------
+
+    @staticmethod
+    def _live_stmt():
+        return (
+            select(Image.id, Image.dataset_id, ImageFeatures.embedding)
+            .join(ImageFeatures, ImageFeatures.image_id == Image.id)
+            .where(Image.is_deleted.isnot(True), ImageFeatures.embedding.isnot(None))
+        )
+
+    async def rebuild(self):
+        """全量构建新的主段并发布为新的一代；调用方须持有 advisory lock"""
+        async with self.session_factory() as db:
+            watermark = (await db.execute(select(func.now()))).scalar_one()
+            version = await get_catalog_version(db)
+            total = (await db.execute(
+                select(func.count()).select_from(self._live_stmt().subquery())
+            )).scalar_one()
+
+            main_segment = _new_name("main")
+            building = self.path / main_segment
+            building.mkdir(parents=True)
+
+            raw = None
+            ids = np.empty(total, dtype=ID_DTYPE)
+            ds_names: List[str] = []
+            ds_index: Dict[str, int] = {}
+            dataset_idx = np.empty(total, dtype=np.int32)
+            n = 0
+            result = await db.stream(self._live_stmt().execution_options(yield_per=READ_CHUNK_ROWS))
+            async for rows in result.partitions():
+                # 统计之后新增的行留给下一次增量更新
+                rows = rows[:total - n]
+                if not rows:
+                    break
+                chunk = normalize(np.stack([r.embedding for r in rows]))
+                if raw is None:
+                    raw = np.lib.format.open_memmap(
+                        building / "raw.npy", mode="w+", dtype=np.float32, shape=(total, chunk.shape[1])
+                    )
+                raw[n:n + len(rows)] = chunk
+                for i, r in enumerate(rows):
+                    ids[n + i] = _id_key(r.id)
+                    d = str(r.dataset_id)
+                    if d not in ds_index:
+                        ds_index[d] = len(ds_names)
+                        ds_names.append(d)
+                    dataset_idx[n + i] = ds_index[d]
+                n += len(rows)
+
+        dim = raw.shape[1] if raw is not None else 0
+        raw_view = raw[:n] if raw is not None else np.empty((0, dim), dtype=np.float32)
+        nlist = await asyncio.to_thread(
+            build_main_segment, building, raw_view, ids[:n], dataset_idx[:n], len(ds_names)
+        )
+        del raw, raw_view
+        (building / "raw.npy").unlink(missing_ok=True)
+
+        snap = replace(
+            empty_snapshot(dim, watermark, version),
+            datasets=tuple(ds_names),
+            alive=np.ones(n, dtype=bool),
+            tail_list_offsets=np.zeros(max(1, nlist) + 1, dtype=np.int64),
+            main_segment=main_segment,
+        )
+        await self._publish(snap)
+        logger.info("ann index rebuilt: %d vectors, dim %d", n, dim)
+
+    async def _publish(self, snap: IndexSnapshot):
+        """把 snap 写成新的一代并发布，然后从刚写好的目录加载；调用方须持有 advisory lock"""
+        generation = self.path / _new_name("gen")
+        await asyncio.to_thread(save_generation, generation, snap)
+        await asyncio.to_thread(publish_generation, self.path, generation.name)
+        self.snapshot = await asyncio.to_thread(load_snapshot, generation)
+        await asyncio.to_thread(remove_stale_generations, self.path)
+
+    async def update(self):
+        """读取水位之后变化的行和墓碑，更新尾段并发布新的一代；变化太多时改为全量重建。调用方须持有 advisory lock"""
+        snap = self.snapshot
+        since = snap.watermark - WATERMARK_OVERLAP
+        async with self.session_factory() as db:
+            watermark = (await db.execute(select(func.now()))).scalar_one()
+            version = await get_catalog_version(db)
+            # 回收站状态在 images 上，向量在 image_features 上，两边的变化都要取
+            changed_ids = union(
+                select(Image.id).where(Image.updated_at > since),
+                select(ImageFeatures.image_id).where(ImageFeatures.updated_at > since),
+            ).subquery()
+            changed = (await db.execute(
+                select(func.count()).select_from(changed_ids)
+            )).scalar_one()
+            limit = max(TAIL_REBUILD_MIN, int(len(snap.ids) * TAIL_REBUILD_RATIO))
+            if changed + len(snap.tail_ids) > limit:
+                return await self.rebuild()
+
+            removed = [
+                _id_key(image_id) for image_id in (await db.execute(
+                    select(ImageTombstone.image_id).where(ImageTombstone.deleted_at > since)
+                )).scalars()
+            ]
+            added_ids, added_datasets, added_vectors = [], [], []
+            result = await db.stream(
+                select(Image.id, Image.dataset_id, Image.is_deleted, ImageFeatures.embedding)
+                .outerjoin(ImageFeatures, ImageFeatures.image_id == Image.id)
+                .where(Image.id.in_(select(changed_ids.c[0])))
+                .execution_options(yield_per=READ_CHUNK_ROWS)
+            )
+            async for rows in result.partitions():
+                for r in rows:
+                    if r.is_deleted or r.embedding is None:
+                        removed.append(_id_key(r.id))
+                    else:
+                        added_ids.append(_id_key(r.id))
+                        added_datasets.append(str(r.dataset_id))
+                        added_vectors.append(r.embedding)
+
+        dim = snap.dim or (len(added_vectors[0]) if added_vectors else 0)
+        added = (
+            normalize(np.stack(added_vectors))
+            if added_vectors else np.empty((0, dim), dtype=np.float32)
+        )
+        new_snap = apply_changes(
+            snap,
+            np.array(removed, dtype=ID_DTYPE),
+            np.array(added_ids, dtype=ID_DTYPE),
+            added_datasets,
+            added,
+            watermark,
+            version,
+        )
+        await self._publish(new_snap)
+        logger.info("ann index updated: +%d / -%d, tail %d", len(added_ids), len(removed), len(new_snap.tail_ids))
+
+    # ---------- 查询 ----------
+
+    async def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        dataset_ids: Optional[Sequence[str]] = None,
+        nprobe: int = DEFAULT_NPROBE,
+        exclude: Optional[uuid.UUID] = None
+    ) -> Optional[List[Tuple[uuid.UUID, float]]]:
+        """索引尚未构建时返回 None"""
+        snap = self.snapshot
+        if snap is None:
+            return None
+        return await asyncio.to_thread(snap.search, query, k, dataset_ids, nprobe, exclude)
+
+
+ann_index = AnnIndex(AsyncSessionLocal, settings.ann_index_dir)
+
+
+# 手动全量重建（python -m app.ann_index）
+if __name__ == "__main__":
+    async def _main():
+        index = AnnIndex(AsyncSessionLocal, settings.ann_index_dir)
+        async with AsyncSessionLocal() as db:
+            if not await try_lock_ann_index(db):
+                raise SystemExit("ann index is being built by another process")
+            await index.rebuild()
+        print(f"{index.snapshot.size} vectors -> {index.path}")
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
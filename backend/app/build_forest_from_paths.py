@@ -1,13 +1,25 @@
 import uuid
 
 
-def build_forest_from_abs_paths(dir_records):
+def tree_node_id(parts):
+    """
+    目录节点 id：uuid5(NAMESPACE_URL, "/" + 含顶层目录的完整路径)，
+    不同顶层下同名的子目录（/A/x 与 /B/x）得到不同的 id
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "/" + "/".join(parts)))
+
+
+def build_forest_from_abs_paths(dir_records, dataset_counts=None):
     """
     dir_records: List[Tuple[UUID, str]]  # (id, abs_path)，路径保证是“绝对路径”(以 / 开头)
+    dataset_counts: Optional[Dict[UUID, Tuple[int, int]]]
+        dataset_id -> (image_count, deleted_count)，缺省时所有计数为 0
 
     返回：
-        List[树]，每棵树是 dict，格式同 build_dir_tree_with_ids
+        List[树]，每棵树是 dict，格式同 build_dir_tree_with_ids，
+        每个节点的 image_count / deleted_count 为整棵子树的汇总
     """
+    dataset_counts = dataset_counts or {}
 
     # 先分组：按第一层目录名作为不同的树
     top_level_map = {}  # key = 顶层目录名, value = list of (id, relative_path)
@@ -31,28 +43,42 @@ def build_forest_from_abs_paths(dir_records):
 
     for top_name, rel_records in top_level_map.items():
         # 用顶层目录名构造一个稳定的 UUID
-        root_node_id = str(uuid.uuid5(uuid.NAMESPACE_URL, "/" + top_name))
+        root_node_id = tree_node_id([top_name])
+
+        # 构建子树，中间目录的 id 包含顶层目录名
+        tree = build_dir_tree_with_ids(rel_records, dataset_counts, parent_parts=[top_name])
 
-        # 构建子树
-        tree = build_dir_tree_with_ids(rel_records)
+        # 直接挂在顶层目录上的数据集计入根节点
+        image_count = sum(c["image_count"] for c in tree)
+        deleted_count = sum(c["deleted_count"] for c in tree)
+        for dir_id, rel_path in rel_records:
+            if not rel_path:
+                own_images, own_deleted = dataset_counts.get(dir_id, (0, 0))
+                image_count += own_images
+                deleted_count += own_deleted
 
         forest.append({
             "id": root_node_id,
             "name": top_name,
-            "children": tree
+            "children": tree,
+            "image_count": image_count,
+            "deleted_count": deleted_count
         })
 
     return forest
 
 
-def build_dir_tree_with_ids(dir_records):
+def build_dir_tree_with_ids(dir_records, dataset_counts=None, parent_parts=()):
     """
     dir_records: List[Tuple[UUID, str]]
         [(dir_id, relative_path), ...]
     relative_path 可以是 "" 表示直接挂在父节点下
+    dataset_counts: 同 build_forest_from_abs_paths
+    parent_parts: relative_path 所相对的父目录路径（各级目录名），用于生成中间目录的 id
 
-    返回: 嵌套树 [{id, name, children}]
+    返回: 嵌套树 [{id, name, children, image_count, deleted_count}]
     """
+    dataset_counts = dataset_counts or {}
     tree = {}
 
     for dir_id, path in dir_records:
@@ -61,32 +87,97 @@ def build_dir_tree_with_ids(dir_records):
             continue
 
         parts = [p for p in path.split("/") if p]
-        path_so_far = ""
         node = tree
 
         for i, part in enumerate(parts):
-            path_so_far = f"{path_so_far}/{part}" if path_so_far else part
-
-            node_id = str(dir_id) if i == len(parts) - 1 else str(uuid.uuid5(uuid.NAMESPACE_URL, path_so_far))
+            node_id = str(dir_id) if i == len(parts) - 1 else tree_node_id([*parent_parts, *parts[:i + 1]])
 
             if part not in node:
                 node[part] = {
                     "id": node_id,
                     "name": part,
-                    "children": {}
+                    "children": {},
+                    "own_counts": [0, 0]
                 }
-            node = node[part]["children"]
+            if i == len(parts) - 1:
+                own_images, own_deleted = dataset_counts.get(dir_id, (0, 0))
+                node[part]["own_counts"][0] += own_images
+                node[part]["own_counts"][1] += own_deleted
+            else:
+                node = node[part]["children"]
 
     return convert_children_dict_to_list(tree)
 
 
 def convert_children_dict_to_list(children_dict):
-    """递归把 children 从 dict 转 list"""
-    return [
-        {
+    """递归把 children 从 dict 转 list，同时自底向上汇总子树计数"""
+    result = []
+    for v in children_dict.values():
+        children = convert_children_dict_to_list(v["children"])
+        own_images, own_deleted = v.get("own_counts", (0, 0))
+        result.append({
             "id": v["id"],
             "name": v["name"],
-            "children": convert_children_dict_to_list(v["children"])
+            "children": children,
+            "image_count": own_images + sum(c["image_count"] for c in children),
+            "deleted_count": own_deleted + sum(c["deleted_count"] for c in children)
+        })
+    return result
+
+
+def build_children_index(forest):
+    """
+    把 build_forest_from_abs_paths 的结果展开成按节点 id 查子节点的索引，
+    用于按需逐层展开目录树：展开一个节点只需 O(子节点数)。
+
+    返回: (roots, index)
+        roots: 顶层节点摘要列表
+        index: Dict[str(node_id), List[节点摘要]]
+    节点摘要格式: {id, name, image_count, deleted_count, has_children}
+    节点 id 重复时抛出 ValueError，不会用后一个节点覆盖前一个
+    """
+    def summarize(node):
+        return {
+            "id": node["id"],
+            "name": node["name"],
+            "image_count": node.get("image_count", 0),
+            "deleted_count": node.get("deleted_count", 0),
+            "has_children": bool(node["children"])
         }
-        for v in children_dict.values()
-    ]
+
+    roots = [summarize(n) for n in forest]
+    index = {}
+    stack = list(forest)
+    while stack:
+        node = stack.pop()
+        node_id = str(node["id"])
+        if node_id in index:
+            # 两个节点共用一个 id 时展开其中一个会返回另一个的子节点
+            raise ValueError(f"Duplicate tree node id {node_id} ({node['name']})")
+        index[node_id] = [summarize(c) for c in node["children"]]
+        stack.extend(node["children"])
+    return roots, index
+
+
+def build_node_prefix_index(dir_records):
+    """
+    建立 树节点 id -> dir_path 前缀集合 的索引，用于把任意树节点展开成其下的数据集。
+    节点 id 的生成规则与 build_forest_from_abs_paths 相同：
+      - 顶层 / 中间目录: tree_node_id(含顶层目录名的完整路径)
+      - 数据集本身: 数据集 id（同样展开为它自己的目录，以包含挂在它下面的数据集）
+    一个 id 正常只对应一个前缀；只有 dir_path 写法不一致（有的带开头的 "/"、有的不带）时
+    才会对应多个，DatasetTreeCache.resolve_selection 会拒绝这种 id。
+
+    返回: Dict[str(node_id), Set[str]]，前缀与 datasets.dir_path 的写法一致
+    """
+    index = {}
+    for dir_id, abs_path in dir_records:
+        parts = [p for p in abs_path.strip("/").split("/") if p]
+        if not parts:
+            continue
+        lead = "/" if abs_path.startswith("/") else ""
+
+        for i in range(len(parts)):
+            index.setdefault(tree_node_id(parts[:i + 1]), set()).add(lead + "/".join(parts[:i + 1]))
+        index.setdefault(str(dir_id), set()).add(lead + "/".join(parts))
+    return index
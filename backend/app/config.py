@@ -6,6 +6,8 @@ from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
     root_dir: Path = "Dataset root dir"
     image_dir: Path = "Sub set of dataset dir"
+    # 相似图片 ANN 索引的存放目录
+    ann_index_dir: Path = Path("ann_index")
 
     class Config:
         env_file = ".env"  # 自动从 .env 文件读取
@@ -1,14 +1,15 @@
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
 import uuid
 from sqlalchemy import UUID, select
 from sqlalchemy.orm import selectinload
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from .schemas import ImageOut, ImageSize
-from .models import Image, Dataset, ImageCaption, ImagePose, ImageTag
+from .models import Image, CatalogVersion, Dataset, DatasetStats, DuplicateCluster, DuplicateScanRun, ImageCaption, ImageFeatures, ImagePose, ImageTag, RecycleBinLog
 from .build_forest_from_paths import build_forest_from_abs_paths
 from .config import settings
+from .database import AsyncSessionLocal
 from sqlalchemy.orm import aliased
 from sqlalchemy import func
 
@@ -24,6 +25,11 @@ from sqlalchemy.dialects.postgresql import UUID as PG_UUID, TEXT
 
 
 from urllib.parse import quote
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import BigInteger, Text, and_, any_, case, insert, or_, union, update, literal, literal_column, tuple_, true
+from sqlalchemy.dialects.postgresql import JSON, aggregate_order_by
 
 IMGPROXY_URL = "http://localhost:8082"
 IMGPROXY_PATH_PREFIX = "insecure/width:300/plain/local://"
@@ -34,106 +40,620 @@ IMAGE_DIR = settings.image_dir
 
 
 
+# keyset 分页中 "从数据集开头读起" 的下界，(file_path, id) 总是大于它
+_KEYSET_MIN_FILE_PATH = ""
+_KEYSET_MIN_ID = uuid.UUID(int=0)
+
+# 作为标题优先选用的 caption 类型
+HQ_CAPTION_TYPES = ("hq", "high_quality", "hq_cap")
+
+
+def _encode_cursor(*values) -> str:
+    """把排序键编码成不透明的游标字符串（UUID / datetime 等按 str 序列化）"""
+    raw = json.dumps([str(v) for v in values], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor: str, *parsers):
+    """解析 _encode_cursor 生成的游标，parsers 依次把每个值转回原类型，格式不对时抛 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii"))
+        values = json.loads(raw.decode("utf-8"))
+        if len(values) != len(parsers):
+            raise ValueError("cursor arity mismatch")
+        return tuple(parse(v) for parse, v in zip(parsers, values))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def encode_image_cursor(dir_path: str, file_path: str, image_id) -> str:
+    """把最后一行的 (dir_path, file_path, id) 编码成不透明的游标字符串"""
+    return _encode_cursor(dir_path, file_path, image_id)
+
+
+def decode_image_cursor(cursor: str):
+    """解析 encode_image_cursor 生成的游标，格式不对时抛 ValueError"""
+    return _decode_cursor(cursor, str, str, uuid.UUID)
+
+
+def selected_datasets_stmt(dataset_ids, path_prefixes=None):
+    """
+    把选中的数据集表示成一个子查询：
+      - dataset_ids: 直接给出的数据集 id
+      - path_prefixes: 树上的目录节点对应的 dir_path 前缀，匹配该目录本身及其下所有数据集
+    id 和前缀各作为一个数组参数绑定，选中多少数据集 SQL 文本都不变，执行计划稳定。
+    前缀匹配走 idx_datasets_dir_path_c（dir_path COLLATE "C"）上的范围扫描：
+    "a/b" 之下的路径都落在 ["a/b/", "a/b0") 之间（'0' 是 '/' 之后的字符）。
+    """
+    # 用 Core 表列构造，既能嵌进 ORM 查询，也能嵌进 analyze 里的纯文本 FROM 查询
+    datasets = Dataset.__table__
+    ids_param = literal(list(dataset_ids), ARRAY(PG_UUID(as_uuid=True)))
+    stmt = select(datasets.c.id).where(datasets.c.id == any_(ids_param))
+    if path_prefixes:
+        p = (
+            func.unnest(literal(list(path_prefixes), ARRAY(Text)))
+            .table_valued("prefix")
+            .render_derived()
+        )
+        dir_path = datasets.c.dir_path.collate("C")
+        under_prefix = select(datasets.c.id).select_from(p).join(
+            datasets,
+            or_(
+                dir_path == p.c.prefix,
+                and_(dir_path >= p.c.prefix + "/", dir_path < p.c.prefix + "0"),
+            ),
+        )
+        stmt = union(stmt, under_prefix)
+    return stmt
+
+
+def _page_columns(img):
+    """
+    列表接口需要的列。所有列表接口都只投影这些列并返回 Core 行，
+    不构造 ORM 实体。
+    """
+    return (
+        img.id,
+        img.file_path,
+        img.width,
+        img.height,
+        img.quality_score,
+        img.aesthetic_score,
+        img.is_deleted,
+        img.deleted_at,
+        img.deleted_by,
+    )
+
+
+def _keyset_page_stmt(selection, pagesize: int, cursor=None):
+    """
+    按 (dir_path, file_path, id) 顺序取一页的 keyset 查询：
+      - 外层按 dir_path 有序遍历选中的数据集（datasets.dir_path 唯一索引）
+      - 每个数据集用 LATERAL 子查询沿 idx_images_dataset_file_path_id 做范围扫描
+      - 游标所在数据集从 (file_path, id) 之后开始，其后的数据集从头开始
+    这样第 N 页和第 1 页的代价相同，不需要 OFFSET 扔掉前面的行。
+    """
+    ds_stmt = select(Dataset.id, Dataset.dir_path).where(Dataset.id.in_(selection))
+    if cursor is not None:
+        cur_dir_path, cur_file_path, cur_id = cursor
+        ds_stmt = ds_stmt.where(Dataset.dir_path >= cur_dir_path)
+    d = ds_stmt.subquery("d")
+
+    img_stmt = select(*_page_columns(Image)).where(Image.dataset_id == d.c.id)
+    if cursor is not None:
+        at_cursor = d.c.dir_path == cur_dir_path
+        img_stmt = img_stmt.where(
+            tuple_(Image.file_path, Image.id) > tuple_(
+                case((at_cursor, literal(cur_file_path)), else_=literal(_KEYSET_MIN_FILE_PATH)),
+                case((at_cursor, literal(cur_id, Image.id.type)), else_=literal(_KEYSET_MIN_ID, Image.id.type)),
+            )
+        )
+    img = img_stmt.order_by(Image.file_path.asc(), Image.id.asc()).limit(pagesize).lateral("i")
+
+    return (
+        select(*img.c, d.c.dir_path)
+        .select_from(d)
+        .join(img, true())
+        .order_by(d.c.dir_path.asc(), img.c.file_path.asc(), img.c.id.asc())
+        .limit(pagesize)
+    )
+
+
+def _offset_page_stmt(selection, page: int, pagesize: int):
+    """兼容旧客户端的 OFFSET 分页"""
+    return (
+        select(*_page_columns(Image), Dataset.dir_path)
+        .join(Dataset, Image.dataset_id == Dataset.id)
+        .where(Image.dataset_id.in_(selection))
+        .order_by(Dataset.dir_path.asc(), Image.file_path.asc(), Image.id.asc())
+        .limit(pagesize)
+        .offset(page * pagesize)
+    )
+
+
+def _gallery_page_stmt(page_stmt, count_stmt=None, order_by=("dir_path", "file_path", "id")):
+    """
+    把一页图片和它的标题、tags、poses 以及总数拼成一条 SQL：
+      - 总数放在只有一行的子查询里，LEFT JOIN 本页，空页也能拿到 total
+      - 标题 / tags / poses 各用一个 LATERAL 子查询，poses 用 json_agg 聚合
+      - order_by: 结果排序用的 page_stmt 列名，应与 page_stmt 自身的顺序一致
+    """
+    if count_stmt is None:
+        count_stmt = select(literal(None, BigInteger).label("total"))
+    head = count_stmt.subquery("head")
+    p = page_stmt.subquery("p")
+
+    title = (
+        select(ImageCaption.caption.label("title"))
+        .where(ImageCaption.image_id == p.c.id)
+        .order_by(case((func.lower(ImageCaption.caption_type).in_(HQ_CAPTION_TYPES), 0), else_=1))
+        .limit(1)
+        .lateral("title")
+    )
+    tags = (
+        select(ImageTag.tags.label("tags"))
+        .where(ImageTag.image_id == p.c.id)
+        .lateral("tags")
+    )
+    poses = (
+        select(
+            func.coalesce(
+                func.json_agg(
+                    aggregate_order_by(
+                        func.json_build_object(
+                            "pose_index", ImagePose.pose_index,
+                            "bbox", ImagePose.bbox,
+                            "invalid_kpts_idx", ImagePose.invalid_kpts_idx,
+                            "kpts_x", ImagePose.kpts_x,
+                            "kpts_y", ImagePose.kpts_y,
+                        ),
+                        ImagePose.pose_index,
+                    )
+                ),
+                literal_column("'[]'::json"),
+                type_=JSON,
+            ).label("poses")
+        )
+        .where(ImagePose.image_id == p.c.id)
+        .lateral("poses")
+    )
+
+    return (
+        select(head.c.total, *p.c, title.c.title, tags.c.tags, poses.c.poses)
+        .select_from(head)
+        .outerjoin(p, true())
+        .outerjoin(title, true())
+        .outerjoin(tags, true())
+        .outerjoin(poses, true())
+        .order_by(*(p.c[name].asc() for name in order_by))
+    )
+
+
+def _image_out(row) -> Dict:
+    """把 _gallery_page_stmt 返回的一行转成 ImageOut 结构"""
+    # 将 dataset.dir_path 作为 root，生成相对路径
+    mid_path = Path(row.file_path)
+    rel_path = row.dir_path / mid_path
+    url = f"{IMGPROXY_URL}/{IMGPROXY_PATH_PREFIX}/{quote(rel_path.as_posix(), safe=':/?=&')}@webp"
+    raw_size_image_url = f"{IMGPROXY_URL}/{IMGPROXY_PATH_PREFIX_RAW_SIZE}/{quote(rel_path.as_posix(), safe=':/?=&')}@webp"
+
+    return {
+        "id": row.id,
+        "path": str(rel_path),
+        "url": url,
+        "raw_size_image_url": raw_size_image_url,
+        "title": row.title,
+        "tags": row.tags,
+        "size": {"w": row.width, "h": row.height},
+        "score_quality": row.quality_score,
+        "score_aesthetics": row.aesthetic_score,
+        "poses": row.poses,
+        "is_deleted": bool(row.is_deleted),
+        "deleted_at": row.deleted_at,
+        "deleted_by": row.deleted_by
+    }
+
+
 async def query_images_by_dataset_ids(
     db: AsyncSession,
     dataset_ids: List[str],
     page: int = 0,
-    pagesize: int = 20
+    pagesize: int = 20,
+    cursor: Optional[str] = None,
+    with_total: bool = True,
+    path_prefixes: Optional[List[str]] = None
 ) -> Dict:
-    if not dataset_ids:
-        return {"total": 0, "images": []}
+    """
+    查询选中数据集下的图片，整页（含标题、tags、poses、总数）只用一次数据库往返。
+      - dataset_ids / path_prefixes 含义见 selected_datasets_stmt
+      - cursor 为空时沿用 page/pagesize 的 OFFSET 分页（兼容旧客户端）
+      - 传入 cursor 时走 keyset 分页，page 被忽略
+      - with_total=False 时不统计总数，total 返回 None
+    两种模式都会在本页取满时返回 next_cursor，客户端可以随时切到游标模式。
+    """
+    if not dataset_ids and not path_prefixes:
+        return {"total": 0, "images": [], "next_cursor": None}
 
-    # 查询 images + dataset
-    stmt = (
-        select(Image, Dataset)
+    selection = selected_datasets_stmt(dataset_ids, path_prefixes)
+    if cursor:
+        page_stmt = _keyset_page_stmt(selection, pagesize, decode_image_cursor(cursor))
+    else:
+        page_stmt = _offset_page_stmt(selection, page, pagesize)
+
+    count_stmt = None
+    if with_total:
+        count_stmt = dataset_totals_stmt(selection)
+
+    result = await db.execute(_gallery_page_stmt(page_stmt, count_stmt))
+    rows = result.all()
+
+    total_count = rows[0].total if rows else None
+    # 空页时 LEFT JOIN 仍会返回一行 total，id 为 NULL
+    rows = [r for r in rows if r.id is not None]
+
+    images_out = [_image_out(row) for row in rows]
+
+    next_cursor = None
+    if len(rows) == pagesize:
+        last = rows[-1]
+        next_cursor = encode_image_cursor(last.dir_path, last.file_path, last.id)
+
+    return {"total": total_count, "images": images_out, "next_cursor": next_cursor}
+
+
+def _image_list_stmt(deleted: bool, limit: Optional[int] = None, after_id=None):
+    """
+    未删除 / 回收站图片按 id 做 keyset 分页：
+      - 未删除图片沿主键索引扫描
+      - 回收站图片走部分索引 idx_images_recycle_bin（WHERE is_deleted = true），不扫描正常图片
+    """
+    page_stmt = (
+        select(*_page_columns(Image), Dataset.dir_path)
         .join(Dataset, Image.dataset_id == Dataset.id)
-        .where(Image.dataset_id.in_(dataset_ids))
-        .order_by(Dataset.dir_path.asc(), Image.file_path.asc(), Image.id.asc())
-        .limit(pagesize)
-        .offset(page * pagesize)
+        .where(Image.is_deleted == deleted)
     )
-    result = await db.execute(stmt)
+    if after_id is not None:
+        page_stmt = page_stmt.where(Image.id > after_id)
+    page_stmt = page_stmt.order_by(Image.id.asc())
+    if limit is not None:
+        page_stmt = page_stmt.limit(limit)
+    return _gallery_page_stmt(page_stmt, order_by=("id",))
+
+
+async def query_image_list_page(db: AsyncSession, deleted: bool, limit: int, cursor: Optional[str] = None) -> Dict:
+    """按 id keyset 分页列出未删除 / 回收站图片，返回 ImagesOut 结构（不统计 total）"""
+    after_id = _decode_cursor(cursor, uuid.UUID)[0] if cursor else None
+    result = await db.execute(_image_list_stmt(deleted, limit, after_id))
+    rows = [row for row in result if row.id is not None]
+    next_cursor = _encode_cursor(rows[-1].id) if len(rows) == limit else None
+    return {"total": None, "images": [_image_out(row) for row in rows], "next_cursor": next_cursor}
+
+
+async def stream_image_list_ndjson(deleted: bool, chunk_rows: int = 1000):
+    """
+    以 NDJSON 流式输出全部未删除 / 回收站图片。
+    通过服务端游标每次只取 chunk_rows 行，内存占用与表大小无关。
+    StreamingResponse 在依赖清理之后才开始迭代，所以这里自己打开会话。
+    """
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(
+            _image_list_stmt(deleted).execution_options(yield_per=chunk_rows))
+        async for rows in result.partitions():
+            yield "".join(
+                json.dumps(_image_out(row), ensure_ascii=False, default=str) + "\n"
+                for row in rows if row.id is not None
+            ).encode("utf-8")
+
+
+def _recycle_bin_log_stmt(limit: Optional[int] = None, after=None):
+    """回收站日志按 (action_at, id) 做 keyset 分页，走 idx_recycle_bin_log_action_at_id"""
+    stmt = select(
+        RecycleBinLog.id,
+        RecycleBinLog.image_id,
+        RecycleBinLog.action,
+        RecycleBinLog.action_at,
+        RecycleBinLog.action_by,
+        RecycleBinLog.reason,
+    )
+    if after is not None:
+        stmt = stmt.where(tuple_(RecycleBinLog.action_at, RecycleBinLog.id) > tuple_(*after))
+    stmt = stmt.order_by(RecycleBinLog.action_at.asc(), RecycleBinLog.id.asc())
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+async def query_recycle_bin_log_page(db: AsyncSession, limit: int, cursor: Optional[str] = None) -> Dict:
+    """按 (action_at, id) keyset 分页列出回收站日志"""
+    after = _decode_cursor(cursor, datetime.fromisoformat, uuid.UUID) if cursor else None
+    result = await db.execute(_recycle_bin_log_stmt(limit, after))
     rows = result.all()
+    next_cursor = _encode_cursor(rows[-1].action_at.isoformat(), rows[-1].id) if len(rows) == limit else None
+    return {"items": [row._asdict() for row in rows], "next_cursor": next_cursor}
 
-    # 总数
-    count_stmt = select(func.count()).select_from(
-        Image).where(Image.dataset_id.in_(dataset_ids))
-    count_result = await db.execute(count_stmt)
-    total_count = count_result.scalar_one()
-
-    image_ids = [img.id for img, _ in rows]
-
-    # captions
-    captions_map = {}
-    if image_ids:
-        captions_stmt = select(ImageCaption).where(
-            ImageCaption.image_id.in_(image_ids))
-        captions_result = await db.execute(captions_stmt)
-        for c in captions_result.scalars().all():
-            captions_map.setdefault(c.image_id, []).append(c)
-
-    # tags
-    tags_map = {}
-    if image_ids:
-        tags_stmt = select(ImageTag).where(ImageTag.image_id.in_(image_ids))
-        tags_result = await db.execute(tags_stmt)
-        for t in tags_result.scalars().all():
-            tags_map[t.image_id] = t.tags
-
-    # poses
-    poses_map = {}
-    if image_ids:
-        poses_stmt = select(ImagePose).where(ImagePose.image_id.in_(image_ids))
-        poses_result = await db.execute(poses_stmt)
-        for p in poses_result.scalars().all():
-            poses_map.setdefault(p.image_id, []).append({
-                "pose_index": p.pose_index,
-                "bbox": p.bbox,
-                "invalid_kpts_idx": p.invalid_kpts_idx,
-                "kpts_x": p.kpts_x,
-                "kpts_y": p.kpts_y
-            })
-
-    images_out = []
-    for image, dataset in rows:
-        caps = captions_map.get(image.id, [])
-        title = None
-        for c in caps:
-            if c.caption_type.lower() in ("hq", "high_quality", "hq_cap"):
-                title = c.caption
-                break
-        if not title and caps:
-            title = caps[0].caption
-
-        # 将 dataset.dir_path 作为 root，生成相对路径
-        mid_path = Path(image.file_path)
-        rel_path = dataset.dir_path / mid_path
-        url = f"{IMGPROXY_URL}/{IMGPROXY_PATH_PREFIX}/{quote(rel_path.as_posix(), safe=':/?=&')}@webp"
-        raw_size_image_url = f"{IMGPROXY_URL}/{IMGPROXY_PATH_PREFIX_RAW_SIZE}/{quote(rel_path.as_posix(), safe=':/?=&')}@webp"
-
-        images_out.append({
-            "id": image.id,
-            "path": str(rel_path),
-            "url": url,
-            "raw_size_image_url": raw_size_image_url,
-            "title": title,
-            "tags": tags_map.get(image.id),
-            "size": {"w": image.width, "h": image.height},
-            "score_quality": image.quality_score,
-            "score_aesthetics": image.aesthetic_score,
-            "poses": poses_map.get(image.id, [])
-        })
-
-    return {"total": total_count, "images": images_out}
 
+async def stream_recycle_bin_log_ndjson(chunk_rows: int = 1000):
+    """以 NDJSON 流式输出回收站日志（服务端游标，内存有界）"""
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(
+            _recycle_bin_log_stmt().execution_options(yield_per=chunk_rows))
+        async for rows in result.partitions():
+            yield "".join(
+                json.dumps(row._asdict(), ensure_ascii=False, default=str) + "\n"
+                for row in rows
+            ).encode("utf-8")
 
-async def query_dataset_ids_and_build_tree(db: AsyncSession):
+
+async def query_image_list(db: AsyncSession, deleted: bool) -> List[Dict]:
+    """列出未删除（deleted=False）或回收站中（deleted=True）的图片"""
+    page_stmt = (
+        select(*_page_columns(Image), Dataset.dir_path)
+        .join(Dataset, Image.dataset_id == Dataset.id)
+        .where(Image.is_deleted == deleted)
+    )
+    result = await db.execute(_gallery_page_stmt(page_stmt))
+    return [_image_out(row) for row in result if row.id is not None]
+
+
+async def query_images_by_ids(db: AsyncSession, image_ids: List) -> List[Dict]:
+    """按给定 id 取图片（ImageOut 结构），结果保持 image_ids 的顺序，不存在的 id 被忽略"""
+    if not image_ids:
+        return []
+    page_stmt = (
+        select(*_page_columns(Image), Dataset.dir_path)
+        .join(Dataset, Image.dataset_id == Dataset.id)
+        .where(Image.id == any_(literal(list(image_ids), ARRAY(PG_UUID(as_uuid=True)))))
+    )
+    result = await db.execute(_gallery_page_stmt(page_stmt, order_by=("id",)))
+    by_id = {row.id: _image_out(row) for row in result if row.id is not None}
+    return [by_id[i] for i in image_ids if i in by_id]
+
+
+async def query_duplicate_clusters_page(
+    db: AsyncSession,
+    selection,
+    limit: int,
+    cursor: Optional[str] = None,
+    max_members: int = 50
+) -> Dict:
+    """
+    列出最近一次完成的近重复扫描（utils/FindNearDuplicates.py）中，
+    至少有一张图片属于 selection 中数据集的重复簇，按 cluster_id keyset 分页。
+    簇成员不限于 selection（跨数据集的重复正是要找的），每簇最多返回 max_members 张图片，size 为完整大小。
+    """
+    run_id = (await db.execute(
+        select(DuplicateScanRun.id)
+        .where(DuplicateScanRun.status == "done")
+        .order_by(DuplicateScanRun.id.desc())
+        .limit(1)
+    )).scalar_one_or_none()
+    if run_id is None:
+        return {"run_id": None, "clusters": [], "next_cursor": None}
+
+    c = DuplicateCluster
+    stmt = (
+        select(c.cluster_id)
+        .where(c.run_id == run_id, c.dataset_id.in_(selection))
+        .distinct()
+        .order_by(c.cluster_id.asc())
+        .limit(limit)
+    )
+    if cursor:
+        stmt = stmt.where(c.cluster_id > _decode_cursor(cursor, uuid.UUID)[0])
+    cluster_ids = list((await db.execute(stmt)).scalars())
+    if not cluster_ids:
+        return {"run_id": run_id, "clusters": [], "next_cursor": None}
+
+    members: Dict = {cid: [] for cid in cluster_ids}
+    result = await db.execute(
+        select(c.cluster_id, c.image_id)
+        .where(c.run_id == run_id, c.cluster_id == any_(literal(cluster_ids, ARRAY(PG_UUID(as_uuid=True)))))
+        .order_by(c.cluster_id.asc(), c.image_id.asc())
+    )
+    for cluster_id, image_id in result:
+        members[cluster_id].append(image_id)
+
+    shown = [image_id for cid in cluster_ids for image_id in members[cid][:max_members]]
+    images = {img["id"]: img for img in await query_images_by_ids(db, shown)}
+    clusters = [
+        {
+            "cluster_id": cid,
+            "size": len(members[cid]),
+            "images": [images[i] for i in members[cid][:max_members] if i in images],
+        }
+        for cid in cluster_ids
+    ]
+    next_cursor = _encode_cursor(cluster_ids[-1]) if len(cluster_ids) == limit else None
+    return {"run_id": run_id, "clusters": clusters, "next_cursor": next_cursor}
+
+
+async def get_image_embedding(db: AsyncSession, image_id):
+    """读取单张图片的 embedding（float32 ndarray），图片不存在或没有 embedding 时返回 None"""
+    result = await db.execute(select(ImageFeatures.embedding).where(ImageFeatures.image_id == image_id))
+    return result.scalar_one_or_none()
+
+
+async def query_recycle_bin_log(db: AsyncSession) -> List[Dict]:
+    """列出回收站日志，只取 RecycleBinLogOut 需要的列"""
+    stmt = select(
+        RecycleBinLog.image_id,
+        RecycleBinLog.action,
+        RecycleBinLog.action_by,
+        RecycleBinLog.reason,
+    )
+    result = await db.execute(stmt)
+    return [row._asdict() for row in result]
+
+
+def dataset_totals_stmt(selection):
+    """
+    从 dataset_stats 汇总选中数据集的图片总数（含回收站），代价只和数据集个数有关
+    selection: 数据集 id 列表或 selected_datasets_stmt 子查询
+    """
+    return (
+        select(
+            func.coalesce(
+                func.sum(DatasetStats.image_count + DatasetStats.deleted_count), 0
+            ).cast(BigInteger).label("total")
+        )
+        .where(DatasetStats.dataset_id.in_(selection))
+    )
+
+
+async def apply_recycle_bin_stats_deltas(
+    db: AsyncSession,
+    deltas: Dict,
+    deleted: bool
+):
+    """
+    图片移入（deleted=True）或移出回收站后，增量调整 dataset_stats。
+    deltas: dataset_id -> (图片数, 字节数)
+    只调整计数和字节数，分数统计覆盖回收站中的图片，不受影响。
+    调用方负责在同一事务里提交。
+    """
+    if not deltas:
+        return
+    sign = 1 if deleted else -1
+    for dataset_id, (num_images, num_bytes) in deltas.items():
+        await db.execute(
+            update(DatasetStats)
+            .where(DatasetStats.dataset_id == dataset_id)
+            .values(
+                image_count=DatasetStats.image_count - sign * num_images,
+                deleted_count=DatasetStats.deleted_count + sign * num_images,
+                total_bytes=DatasetStats.total_bytes - sign * num_bytes,
+                updated_at=func.now(),
+            )
+        )
+    await bump_catalog_version(db)
+
+
+async def set_images_deleted(
+    db: AsyncSession,
+    deleted: bool,
+    deleted_by: str,
+    reason: Optional[str] = None,
+    image_ids: Optional[List] = None,
+    selection=None,
+    max_quality_score: Optional[float] = None,
+    max_aesthetic_score: Optional[float] = None
+) -> Dict:
+    """
+    批量把图片移入（deleted=True）或移出回收站：
+      - 一条 UPDATE ... RETURNING 完成状态修改，只改状态确实变化的行
+      - 批量写入 recycle_bin_log
+      - 按数据集汇总后增量调整 dataset_stats 和 dataset_histograms
+    筛选条件之间是 AND：image_ids 为 id 列表，selection 为 selected_datasets_stmt 子查询，
+    max_*_score 只匹配分数低于阈值的图片。调用方负责提交。
+
+    返回: {"changed": [(id, dataset_id, file_size), ...], "results": [{"id", "status"}, ...]}
+        status: 'ok' 已修改 / 'unchanged' 已处于目标状态 / 'not_found' 不存在（仅 image_ids 模式）
+    """
+    conds = [Image.is_deleted == (not deleted)]
+    if image_ids is not None:
+        conds.append(Image.id == any_(literal(list(image_ids), ARRAY(PG_UUID(as_uuid=True)))))
+    if selection is not None:
+        conds.append(Image.dataset_id.in_(selection))
+    if max_quality_score is not None:
+        conds.append(Image.quality_score < max_quality_score)
+    if max_aesthetic_score is not None:
+        conds.append(Image.aesthetic_score < max_aesthetic_score)
+
+    stmt = (
+        update(Image)
+        .where(*conds)
+        .values(
+            is_deleted=deleted,
+            deleted_at=func.now() if deleted else None,
+            deleted_by=deleted_by,
+        )
+        .returning(Image.id, Image.dataset_id, Image.file_size)
+        .execution_options(synchronize_session=False)
+    )
+    changed = (await db.execute(stmt)).all()
+
+    if changed:
+        await db.execute(insert(RecycleBinLog), [
+            {
+                "image_id": image_id,
+                "action": "DELETE" if deleted else "RESTORE",
+                "action_by": deleted_by,
+                "reason": reason,
+            }
+            for image_id, _, _ in changed
+        ])
+
+        deltas = {}
+        for _, dataset_id, file_size in changed:
+            num_images, num_bytes = deltas.get(dataset_id, (0, 0))
+            deltas[dataset_id] = (num_images + 1, num_bytes + (file_size or 0))
+        await apply_recycle_bin_stats_deltas(db, deltas, deleted)
+        await db.execute(select(func.apply_dataset_histogram_delta(
+            literal([image_id for image_id, _, _ in changed], ARRAY(PG_UUID(as_uuid=True))),
+            -1 if deleted else 1,
+        )))
+
+    changed_ids = {image_id for image_id, _, _ in changed}
+    if image_ids is None:
+        results = [{"id": image_id, "status": "ok"} for image_id in changed_ids]
+    else:
+        unchanged = set(image_ids) - changed_ids
+        existing = set()
+        if unchanged:
+            existing = set((await db.execute(
+                select(Image.id).where(Image.id == any_(literal(list(unchanged), ARRAY(PG_UUID(as_uuid=True)))))
+            )).scalars())
+        results = [
+            {
+                "id": image_id,
+                "status": "ok" if image_id in changed_ids else ("unchanged" if image_id in existing else "not_found"),
+            }
+            for image_id in image_ids
+        ]
+    return {"changed": changed, "results": results}
+
+
+async def get_catalog_version(db: AsyncSession) -> int:
+    """读取当前目录版本号（catalog_version 单行表）"""
+    result = await db.execute(select(CatalogVersion.version))
+    return result.scalar_one_or_none() or 0
+
+
+async def bump_catalog_version(db: AsyncSession) -> int:
+    """递增目录版本号，调用方负责提交"""
+    result = await db.execute(select(func.bump_catalog_version()))
+    return result.scalar_one()
+
+
+async def query_dataset_records(db: AsyncSession):
+    """
+    返回 (dataset_records, dataset_counts)
+        dataset_records: List[Tuple[UUID, str]]  # (dataset_id, dir_path)
+        dataset_counts: Dict[UUID, Tuple[int, int]]  # dataset_id -> (image_count, deleted_count)
+    """
     async with db:
-        # 查 datasets.id 和 dir_path
-        stmt = select(Dataset.id, Dataset.dir_path)
+        # 查 datasets.id、dir_path 以及统计信息
+        stmt = (
+            select(
+                Dataset.id,
+                Dataset.dir_path,
+                func.coalesce(DatasetStats.image_count, 0),
+                func.coalesce(DatasetStats.deleted_count, 0),
+            )
+            .outerjoin(DatasetStats, DatasetStats.dataset_id == Dataset.id)
+        )
         result = await db.execute(stmt)
-        dataset_records = result.all()  # List[Tuple[UUID, str]]
+        rows = result.all()
 
-    # dataset_records 元素格式示例: (dataset_id, dir_path)
-    tree = build_forest_from_abs_paths(dataset_records)
+    dataset_records = [(dataset_id, dir_path) for dataset_id, dir_path, _, _ in rows]
+    dataset_counts = {
+        dataset_id: (image_count, deleted_count)
+        for dataset_id, _, image_count, deleted_count in rows
+    }
+    return dataset_records, dataset_counts
+
+
+async def query_dataset_ids_and_build_tree(db: AsyncSession):
+    dataset_records, dataset_counts = await query_dataset_records(db)
+    tree = build_forest_from_abs_paths(dataset_records, dataset_counts)
     return tree
@@ -1,58 +1,326 @@
-import psycopg2
-from typing import List, Dict, Tuple
-
-DB_CONFIG = {
-    "host": "localhost",
-    "port": 5432,
-    "dbname": "image_dataset_db4",
-    "user": "postgres",
-    "password": "example"
-}
-
-def fetch_distribution(query: str) -> List[Tuple[int, int]]:
-    """执行 SQL 获取分布数据 [(bucket, count), ...]"""
-    conn = psycopg2.connect(**DB_CONFIG)
-    cur = conn.cursor()
-    cur.execute(query)
-    data = cur.fetchall()
-    cur.close()
-    conn.close()
-    return data
-
-def compute_distribution(
-    min_val: float,
-    max_val: float,
-    num_buckets: int,
-    sql_expr: str,
-    table: str,
-    where_clause: str = "TRUE"
-) -> Dict[str, List]:
-    """
-    通用分布统计函数
-    - sql_expr: SQL 表达式计算数值，比如 width::float/height 或 sqrt(width*height)
-    - table: SQL 表名
-    - where_clause: SQL 过滤条件，默认不限制
-    返回: { "labels": [...], "counts": [...] }
-    """
-    query = f"""
-        SELECT width_bucket({sql_expr}, {min_val}, {max_val}, {num_buckets}) AS bucket,
-               count(*) AS cnt
-        FROM {table}
-        WHERE {where_clause}
-        GROUP BY bucket
-        ORDER BY bucket;
-    """
-    data = fetch_distribution(query)
+import asyncio
+import json
+import math
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+
+from sqlalchemy import func, literal_column, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..crud import get_catalog_version, selected_datasets_stmt
+from ..models import DatasetHistogram, HistogramMetric
+
+
+# 近似模式的置信水平（95%）
+APPROX_Z = 1.96
+
+
+def sampled_source(table: str, sample_percent: Optional[float] = None) -> str:
+    """FROM 子句里的表名，近似模式下加上 TABLESAMPLE SYSTEM"""
+    if sample_percent is None:
+        return table
+    return f"{table} TABLESAMPLE SYSTEM ({float(sample_percent)})"
+
+
+def width_bucket_sql(field: Dict) -> str:
+    return (
+        f"width_bucket(({field['sql_expr']})::float8, "
+        f"{field['min_val']}, {field['max_val']}, {field['num_buckets']})"
+    )
+
+
+def build_distribution_stmt(
+    fields: List[Dict],
+    table: str = "images",
+    selection=None,
+    sample_percent: Optional[float] = None
+):
+    """
+    把多个字段的分布统计合并成一次表扫描：
+      - 每行通过 LATERAL (VALUES ...) 展开成 (字段序号, 数值) 多行
+      - 字段自己的 where_clause 折叠进 CASE，不满足的值为 NULL 后被过滤
+      - 最后按 (字段序号, bucket) 分组计数
+    selection: 可选的数据集子查询（见 crud.selected_datasets_stmt），只统计这些数据集
+    sample_percent: 可选，用 TABLESAMPLE SYSTEM 只扫描这个百分比的数据页
+    返回的行格式: (字段序号, bucket, count)
+    """
+    values = []
+    for i, f in enumerate(fields):
+        values.append(
+            f"({i}, CASE WHEN {f.get('where_clause', 'TRUE')} THEN {width_bucket_sql(f)} END)"
+        )
+    source = sampled_source(table, sample_percent)
+
+    k, bucket = literal_column("x.k"), literal_column("x.bucket")
+    stmt = (
+        select(k, bucket, func.count().label("cnt"))
+        .select_from(text(f"{source} CROSS JOIN LATERAL (VALUES {', '.join(values)}) AS x(k, bucket)"))
+        .where(bucket.isnot(None))
+    )
+    if selection is not None:
+        stmt = stmt.where(literal_column(f"{table}.dataset_id").in_(selection))
+    return stmt.group_by(k, bucket).order_by(k, bucket)
+
+
+def bucket_labels(min_val: float, max_val: float, num_buckets: int, buckets: List[int]) -> List[str]:
+    bucket_width = (max_val - min_val) / num_buckets
+    return [f"{min_val + (b-1)*bucket_width:.2f}~{min_val + b*bucket_width:.2f}" for b in buckets]
+
+
+async def compute_distributions(
+    db: AsyncSession,
+    fields: List[Dict],
+    selection=None,
+    sample_percent: Optional[float] = None
+) -> List[Dict[str, List]]:
+    """
+    一次扫描计算多个字段的分布
+    返回: 与 fields 一一对应的 [{ "labels": [...], "counts": [...], "errors": [...] }, ...]
+      - 精确模式 errors 为 None
+      - 近似模式 counts 为按采样比例放大后的估计值，errors 为 95% 置信区间的半宽
+        （按独立抽样的二项分布估计；SYSTEM 按页抽样，数据按页聚集时实际误差会更大）
+    fields 中的表名必须相同（默认 images）
+    """
+    if not fields:
+        return []
+    tables = {f.get("table", "images") for f in fields}
+    if len(tables) != 1:
+        raise ValueError(f"All fields must come from the same table, got {sorted(tables)}")
+
+    result = await db.execute(build_distribution_stmt(fields, tables.pop(), selection, sample_percent))
+    per_field = [([], []) for _ in fields]
+    for k, bucket, cnt in result:
+        per_field[k][0].append(bucket)
+        per_field[k][1].append(cnt)
+
+    dists = []
+    for f, (buckets, counts) in zip(fields, per_field):
+        errors = None
+        if sample_percent is not None:
+            frac = sample_percent / 100.0
+            errors = [round(APPROX_Z * math.sqrt(c * (1 - frac)) / frac) for c in counts]
+            counts = [round(c / frac) for c in counts]
+        dists.append({
+            "labels": bucket_labels(f["min_val"], f["max_val"], f["num_buckets"], buckets),
+            "counts": counts,
+            "errors": errors,
+        })
+    return dists
+
+
+def bucket_edges(min_val: float, max_val: float, num_buckets: int) -> List[float]:
     bucket_width = (max_val - min_val) / num_buckets
-    labels = [f"{min_val + (b-1)*bucket_width:.2f}~{min_val + b*bucket_width:.2f}" for b, _ in data]
-    counts = [cnt for _, cnt in data]
-    return {"labels": labels, "counts": counts}
+    return [round(min_val + i * bucket_width, 6) for i in range(num_buckets + 1)]
+
+
+def build_joint_distribution_stmt(
+    x: Dict,
+    y: Dict,
+    table: str = "images",
+    selection=None,
+    sample_percent: Optional[float] = None
+):
+    """
+    二维联合分布：一次扫描同时对两个表达式分桶，按 (x 桶, y 桶) 分组计数。
+    x / y 的格式与 analyze_fields 的字段相同（sql_expr / min_val / max_val / num_buckets / where_clause）
+    返回的行格式: (x 桶, y 桶, count)，桶号为 width_bucket 语义（0 / num_buckets+1 为越界）
+    """
+    xb, yb = literal_column(width_bucket_sql(x)), literal_column(width_bucket_sql(y))
+    stmt = (
+        select(xb.label("xb"), yb.label("yb"), func.count().label("cnt"))
+        .select_from(text(sampled_source(table, sample_percent)))
+        .where(text(x.get("where_clause", "TRUE")))
+        .where(text(y.get("where_clause", "TRUE")))
+    )
+    if selection is not None:
+        stmt = stmt.where(literal_column(f"{table}.dataset_id").in_(selection))
+    return stmt.group_by(text("1, 2"))
+
+
+async def compute_joint_distribution(
+    db: AsyncSession,
+    x: Dict,
+    y: Dict,
+    selection=None,
+    sample_percent: Optional[float] = None
+) -> Dict:
+    """
+    计算二维直方图，返回紧凑的数组格式（不返回逐点数据）：
+    {
+        "x_edges": [...],        # num_buckets + 1 个边界
+        "y_edges": [...],
+        "counts": [[...], ...],  # counts[i][j]: x 落在第 i 个桶、y 落在第 j 个桶的图片数
+        "total": 落在网格内的图片数,
+        "outside": 至少一个维度越界的图片数
+    }
+    近似模式下计数为按采样比例放大后的估计值
+    """
+    tables = {x.get("table", "images"), y.get("table", "images")}
+    if len(tables) != 1:
+        raise ValueError(f"Both axes must come from the same table, got {sorted(tables)}")
+
+    nx, ny = x["num_buckets"], y["num_buckets"]
+    counts = [[0] * ny for _ in range(nx)]
+    total = outside = 0
+    result = await db.execute(build_joint_distribution_stmt(x, y, tables.pop(), selection, sample_percent))
+    for xb, yb, cnt in result:
+        if sample_percent is not None:
+            cnt = round(cnt * 100.0 / sample_percent)
+        if 1 <= xb <= nx and 1 <= yb <= ny:
+            counts[xb - 1][yb - 1] = cnt
+            total += cnt
+        else:
+            outside += cnt
+
+    return {
+        "x_edges": bucket_edges(x["min_val"], x["max_val"], nx),
+        "y_edges": bucket_edges(y["min_val"], y["max_val"], ny),
+        "counts": counts,
+        "total": total,
+        "outside": outside,
+    }
 
-def analyze_fields(
+
+async def load_histogram_metrics(db: AsyncSession) -> Dict[str, Tuple[float, float, int]]:
+    """读取 histogram_metrics：metric -> (min_val, max_val, num_buckets)"""
+    result = await db.execute(
+        select(HistogramMetric.metric, HistogramMetric.min_val, HistogramMetric.max_val, HistogramMetric.num_buckets)
+    )
+    return {metric: (min_val, max_val, n) for metric, min_val, max_val, n in result}
+
+
+def coarse_bucket(value: float, min_val: float, max_val: float, num_buckets: int) -> int:
+    """与 PostgreSQL width_bucket 相同的分桶规则：0 为下溢，num_buckets+1 为上溢"""
+    if value < min_val:
+        return 0
+    if value >= max_val:
+        return num_buckets + 1
+    return int((value - min_val) / (max_val - min_val) * num_buckets) + 1
+
+
+def rebin(fine_spec: Tuple[float, float, int], field: Dict, fine_counts: List[Tuple[int, int]]) -> Tuple[List[int], List[int]]:
+    """
+    把细桶计数合并成 field 要求的粗桶：按细桶中点落在哪个粗桶归并。
+    粗桶边界与细桶边界对齐时（如 0~3 切 20 桶对 0~3 切 300 桶）结果与直接扫表完全一致，
+    不对齐时每个细桶整体归入一个粗桶，误差不超过一个细桶宽度。
+    """
+    fine_min, fine_max, fine_n = fine_spec
+    fine_width = (fine_max - fine_min) / fine_n
+    merged: Dict[int, int] = {}
+    for b, cnt in fine_counts:
+        mid = fine_min + (b - 0.5) * fine_width
+        cb = coarse_bucket(mid, field["min_val"], field["max_val"], field["num_buckets"])
+        merged[cb] = merged.get(cb, 0) + cnt
+    buckets = sorted(b for b, c in merged.items() if c > 0)
+    return buckets, [merged[b] for b in buckets]
+
+
+async def compute_summary_distributions(
+    db: AsyncSession,
+    fields: List[Dict],
+    metrics: Dict[str, Tuple[float, float, int]],
+    selection=None
+) -> List[Dict[str, List]]:
+    """
+    从 dataset_histograms 预聚合的细桶计算分布，不扫描 images。
+    fields 的每个元素必须带 "metric"，且在 metrics 中有定义；返回格式同 compute_distributions
+    """
+    if not fields:
+        return []
+    h = DatasetHistogram
+    stmt = (
+        select(h.metric, h.bucket, func.sum(h.count))
+        .where(h.metric.in_({f["metric"] for f in fields}))
+        .group_by(h.metric, h.bucket)
+    )
+    if selection is not None:
+        stmt = stmt.where(h.dataset_id.in_(selection))
+
+    fine: Dict[str, List[Tuple[int, int]]] = {}
+    for metric, bucket, cnt in await db.execute(stmt):
+        fine.setdefault(metric, []).append((bucket, int(cnt)))
+
+    dists = []
+    for f in fields:
+        buckets, counts = rebin(metrics[f["metric"]], f, fine.get(f["metric"], []))
+        dists.append({
+            "labels": bucket_labels(f["min_val"], f["max_val"], f["num_buckets"], buckets),
+            "counts": counts,
+            "errors": None,
+        })
+    return dists
+
+
+class AnalysisCache:
+    """
+    分布统计结果缓存，以 catalog_version 为键：目录没变化时重复加载看板不再扫表。
+    每个 key 对应一个 Future：同一组参数同时到达的请求共享一次计算，不同参数的计算互不等待。
+    按最近使用保留最多 max_entries 组结果。
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.version: Optional[int] = None
+        self.max_entries = max_entries
+        self.results: "OrderedDict[str, asyncio.Future]" = OrderedDict()
+
+    async def get(self, db: AsyncSession, key: str, compute):
+        """key: 参数的序列化结果；compute: 缓存未命中时调用的无参协程函数"""
+        version = await get_catalog_version(db)
+        if self.version is not None and version < self.version:
+            # 读到的是旧版本（另一个请求已经看到了更新），直接计算，不写入缓存
+            return await compute()
+        if version != self.version:
+            self.version = version
+            self.results = OrderedDict()
+
+        while True:
+            future = self.results.get(key)
+            if future is None:
+                break
+            self.results.move_to_end(key)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 发起计算的请求被取消时由当前请求重新计算；当前请求自己被取消则照常抛出
+                if not future.cancelled():
+                    raise
+
+        results = self.results
+        future = asyncio.get_running_loop().create_future()
+        results[key] = future
+        while len(results) > self.max_entries:
+            results.popitem(last=False)
+        try:
+            result = await compute()
+        except BaseException as e:
+            # 失败的计算不缓存，下一次请求重新计算
+            if results.get(key) is future:
+                del results[key]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # 没有其它请求在等待时避免 "exception was never retrieved" 警告
+                future.exception()
+            raise
+        future.set_result(result)
+        return result
+
+
+analysis_cache = AnalysisCache()
+
+
+async def analyze_fields(
+    db: AsyncSession,
     fields: List[Dict],
+    dataset_ids: Optional[List] = None,
+    path_prefixes: Optional[List[str]] = None,
+    sample_percent: Optional[float] = None,
+    use_summary: bool = True
 ) -> Dict[str, List[Dict[str, int]]]:
     """
-    通用分析函数，可分析任意字段/表达式的数值分布
+    通用分析函数，可分析任意字段/表达式的数值分布，所有字段只扫描一次表，
+    结果按 catalog_version 缓存
     fields 每个元素字典包含:
     {
         "name": "ratio_distribution",  # 返回的字段名
@@ -61,25 +329,84 @@ def analyze_fields(
         "min_val": 0,
         "max_val": 3,
         "num_buckets": 30,
-        "where_clause": "width IS NOT NULL AND height IS NOT NULL AND height<>0"
+        "where_clause": "width IS NOT NULL AND height IS NOT NULL AND height<>0",
+        "metric": "ratio"  # 可选，histogram_metrics 中的指标名
     }
+    dataset_ids / path_prefixes: 只统计这些数据集（含义见 crud.selected_datasets_stmt），都为 None 时统计全部
+    sample_percent: 近似模式的采样百分比，None 为精确模式
+    use_summary: 精确模式下，带 metric 的字段从 dataset_histograms 预聚合细桶合并得到，不扫描 images；
+        其余字段仍走一次扫表
     """
-    result = {}
-    for f in fields:
-        dist = compute_distribution(
-            min_val=f["min_val"],
-            max_val=f["max_val"],
-            num_buckets=f["num_buckets"],
-            sql_expr=f["sql_expr"],
-            table=f.get("table", "images"),
-            where_clause=f.get("where_clause", "TRUE")
-        )
+    selection = None
+    if dataset_ids is not None or path_prefixes is not None:
+        selection = selected_datasets_stmt(dataset_ids or [], path_prefixes)
+
+    async def compute():
+        # 字段序号分成两组：走预聚合直方图的，和需要扫表的
+        summary_idx, scan_idx = [], list(range(len(fields)))
+        if use_summary and sample_percent is None:
+            metrics = await load_histogram_metrics(db)
+            summary_idx = [i for i in scan_idx if fields[i].get("metric") in metrics]
+            scan_idx = [i for i in scan_idx if i not in summary_idx]
+
+        dists = [None] * len(fields)
+        if summary_idx:
+            summary = await compute_summary_distributions(db, [fields[i] for i in summary_idx], metrics, selection)
+            for i, d in zip(summary_idx, summary):
+                dists[i] = d
+        if scan_idx:
+            scanned = await compute_distributions(db, [fields[i] for i in scan_idx], selection, sample_percent)
+            for i, d in zip(scan_idx, scanned):
+                dists[i] = d
+
         # 转换成前端友好的格式
-        result[f["name"]] = [{"range": r, "count": c} for r, c in zip(dist["labels"], dist["counts"])]
-    return result
+        result = {}
+        for f, dist in zip(fields, dists):
+            items = [{"range": r, "count": c} for r, c in zip(dist["labels"], dist["counts"])]
+            if dist["errors"] is not None:
+                for item, err in zip(items, dist["errors"]):
+                    item["error"] = err
+            result[f["name"]] = items
+        return result
+
+    key = json.dumps({
+        "fields": fields,
+        "dataset_ids": sorted(str(i) for i in dataset_ids) if dataset_ids is not None else None,
+        "path_prefixes": sorted(path_prefixes) if path_prefixes is not None else None,
+        "sample_percent": sample_percent,
+        "use_summary": use_summary,
+    }, sort_keys=True, ensure_ascii=False)
+    return await analysis_cache.get(db, key, compute)
+
+
+async def analyze_joint(
+    db: AsyncSession,
+    x: Dict,
+    y: Dict,
+    dataset_ids: Optional[List] = None,
+    path_prefixes: Optional[List[str]] = None,
+    sample_percent: Optional[float] = None
+) -> Dict:
+    """二维联合分布，参数含义同 analyze_fields，结果按 catalog_version 缓存"""
+    selection = None
+    if dataset_ids is not None or path_prefixes is not None:
+        selection = selected_datasets_stmt(dataset_ids or [], path_prefixes)
 
-# 使用示例：
+    async def compute():
+        return await compute_joint_distribution(db, x, y, selection, sample_percent)
+
+    key = json.dumps({
+        "joint": [x, y],
+        "dataset_ids": sorted(str(i) for i in dataset_ids) if dataset_ids is not None else None,
+        "path_prefixes": sorted(path_prefixes) if path_prefixes is not None else None,
+        "sample_percent": sample_percent,
+    }, sort_keys=True, ensure_ascii=False)
+    return await analysis_cache.get(db, key, compute)
+
+# 使用示例（python -m app.dataset_analysis.analyze）：
 if __name__ == "__main__":
+    from ..database import AsyncSessionLocal
+
     fields_to_analyze = [
         {
             "name": "ratio_distribution",
@@ -100,5 +427,9 @@ if __name__ == "__main__":
             "where_clause": "width IS NOT NULL AND height IS NOT NULL"
         }
     ]
-    data = analyze_fields(fields_to_analyze)
-    print(data)
+
+    async def _main():
+        async with AsyncSessionLocal() as db:
+            print(await analyze_fields(db, fields_to_analyze))
+
+    asyncio.run(_main())
@@ -0,0 +1,90 @@
+import asyncio
+import json
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .build_forest_from_paths import build_children_index, build_forest_from_abs_paths, build_node_prefix_index
+from .crud import get_catalog_version, query_dataset_records
+
+
+class AmbiguousTreeNodeError(ValueError):
+    """一个树节点 id 对应多个目录前缀，无法确定用户选中的是哪一个"""
+
+
+class DatasetTreeCache:
+    """
+    进程内缓存构建好的数据集树，以 catalog_version 为键。
+
+    - 每次请求只读一次版本号，版本没变直接返回缓存好的 JSON
+    - 版本变化后只有一个请求负责重建，同时到达的请求等待并共享结果
+    - 同时缓存 node_id -> 子节点 的索引，供按需逐层展开使用
+    - 以及 node_id -> dir_path 前缀 的索引，供把树节点展开成其下的数据集
+    """
+
+    def __init__(self):
+        self.version: Optional[int] = None
+        self.etag: Optional[str] = None
+        self.body: Optional[bytes] = None
+        self.roots: List[Dict] = []
+        self.children_index: Dict[str, List[Dict]] = {}
+        self.node_prefixes: Dict[str, Set[str]] = {}
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, db: AsyncSession) -> str:
+        """版本号变化时重建缓存，返回当前 etag"""
+        version = await get_catalog_version(db)
+        if version == self.version:
+            return self.etag
+
+        async with self._lock:
+            # 等锁期间可能已经有别的请求重建好了
+            if version != self.version:
+                dataset_records, dataset_counts = await query_dataset_records(db)
+                forest = build_forest_from_abs_paths(dataset_records, dataset_counts)
+                self.node_prefixes = build_node_prefix_index(dataset_records)
+                self.body = json.dumps(forest, ensure_ascii=False, default=str).encode("utf-8")
+                self.roots, self.children_index = build_children_index(forest)
+                self.etag = f'W/"dataset-tree-{version}"'
+                self.version = version
+            return self.etag
+
+    async def get(self, db: AsyncSession) -> Tuple[str, bytes]:
+        """返回 (etag, 序列化后的整棵树 JSON)"""
+        etag = await self.refresh(db)
+        return etag, self.body
+
+    async def get_roots(self, db: AsyncSession) -> Tuple[str, List[Dict]]:
+        """返回 (etag, 顶层节点摘要列表)"""
+        etag = await self.refresh(db)
+        return etag, self.roots
+
+    async def get_children(self, db: AsyncSession, node_id: str) -> Tuple[str, Optional[List[Dict]]]:
+        """返回 (etag, 子节点摘要列表)，节点不存在时列表为 None"""
+        etag = await self.refresh(db)
+        return etag, self.children_index.get(str(node_id))
+
+    async def resolve_selection(self, db: AsyncSession, node_ids: Iterable) -> Tuple[List, List[str]]:
+        """
+        把前端选中的任意树节点 id 解析为 (dataset_ids, path_prefixes)：
+          - 认识的节点（目录或数据集）展开成 dir_path 前缀，交给数据库按前缀索引匹配
+          - 不认识的 id（例如缓存建好后新增的数据集）原样当作数据集 id
+          - 对应多个前缀的 id 抛出 AmbiguousTreeNodeError，不取并集
+            （选择结果会用于批量删除，不能扩大到用户没选的目录）
+        """
+        await self.refresh(db)
+        dataset_ids = []
+        path_prefixes = set()
+        for node_id in node_ids:
+            prefixes = self.node_prefixes.get(str(node_id))
+            if prefixes and len(prefixes) > 1:
+                raise AmbiguousTreeNodeError(
+                    f"Tree node {node_id} matches multiple folders: {sorted(prefixes)}")
+            if prefixes:
+                path_prefixes.update(prefixes)
+            else:
+                dataset_ids.append(node_id)
+        return dataset_ids, sorted(path_prefixes)
+
+
+dataset_tree_cache = DatasetTreeCache()
@@ -1,25 +1,69 @@
-from fastapi import FastAPI, Depends, Query, HTTPException
-from typing import List
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Depends, Query, HTTPException, Header
+from typing import List, Optional
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from uuid import UUID
 from datetime import datetime
 
-from .database import get_db
-from .crud import query_dataset_ids_and_build_tree, query_images_by_dataset_ids
-from .schemas import DatasetTree, ImageOut, ImageRequest, ImagesOut, ImageDeleteRequest, RecycleBinLogOut
+from contextlib import asynccontextmanager
+
+from .database import AsyncSessionLocal, get_db
+from .crud import (
+    get_image_embedding, query_duplicate_clusters_page, query_image_list, query_image_list_page, query_images_by_dataset_ids, query_images_by_ids,
+    query_recycle_bin_log, query_recycle_bin_log_page, selected_datasets_stmt, set_images_deleted,
+    stream_image_list_ndjson, stream_recycle_bin_log_ndjson
+)
+from .schemas import BulkRecycleOut, BulkRecycleRequest, DatasetTree, DatasetTreeNode, ImageOut, ImageRequest, ImagesOut, ImageDeleteRequest, RecycleBinLogOut, RecycleBinLogPage, SimilarImagesOut, DuplicateClustersPage
 from fastapi.middleware.cors import CORSMiddleware
-from .dataset_analysis.analyze import analyze_fields
+from .dataset_analysis.analyze import analyze_fields, analyze_joint
+from .ann_index import ann_index
+from .dataset_tree_cache import AmbiguousTreeNodeError, dataset_tree_cache
 from .models import Image, RecycleBinLog
 
+from .search_outbox import SearchOutboxWorker, enqueue_search_updates, search_outbox_lag
+
 from meilisearch import Client
 
 MEILI_URL = "http://127.0.0.1:7700"
 client = Client(MEILI_URL)
 index = client.index("images")
 
-app = FastAPI()
+search_outbox_worker = SearchOutboxWorker(AsyncSessionLocal, index)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    search_outbox_worker.start()
+    await ann_index.load()
+    ann_index.schedule_refresh()
+    yield
+    await ann_index.stop()
+    await search_outbox_worker.stop()
+
+app = FastAPI(lifespan=lifespan)
+
+
+async def sync_recycle_bin_to_meilisearch(db: AsyncSession, changed, deleted: bool, deleted_by: str):
+    """把回收站状态变化写入 search_outbox，由后台 worker 批量同步到 Meilisearch"""
+    await enqueue_search_updates(db, [
+        {"id": image_id, "is_deleted": deleted, "deleted_by": deleted_by}
+        for image_id, _, _ in changed
+    ])
+
+def parse_node_ids(ids: str) -> List[UUID]:
+    """解析逗号分隔的树节点 id，格式错误返回 400"""
+    try:
+        return [UUID(i) for i in ids.split(",") if i]
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid node ids: {ids}")
+
+async def resolve_tree_selection(db: AsyncSession, node_ids):
+    """dataset_tree_cache.resolve_selection，对应多个目录的节点 id 返回 400"""
+    try:
+        return await dataset_tree_cache.resolve_selection(db, node_ids)
+    except AmbiguousTreeNodeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 # 允许前端访问
 app.add_middleware(
@@ -33,8 +77,21 @@ app.add_middleware(
 # ------------------- 分析接口保持不变 -------------------
 
 @app.get("/analyze_json")
-def analyze_json(fields: str = Query("ratio,width_height", description="要分析的字段列表，用逗号分隔")):
+async def analyze_json(
+    fields: str = Query("ratio,width_height", description="要分析的字段列表，用逗号分隔"),
+    ids: Optional[str] = Query(None, description="只分析这些树节点（数据集或目录）下的图片，逗号分隔，默认全部"),
+    approximate: bool = Query(False, description="近似模式：按采样估计，并返回误差范围"),
+    sample_percent: float = Query(1.0, gt=0, le=100, description="近似模式的采样百分比"),
+    use_summary: bool = Query(True, description="精确模式下从预聚合直方图合并结果，不扫描 images"),
+    db: AsyncSession = Depends(get_db)
+):
+    dataset_ids = path_prefixes = None
+    if ids:
+        node_ids = parse_node_ids(ids)
+        dataset_ids, path_prefixes = await resolve_tree_selection(db, node_ids)
     try:
+        sample = sample_percent if approximate else None
+
         field_list = fields.split(",")
         analysis_params = []
         for f in field_list:
@@ -45,7 +102,8 @@ def analyze_json(fields: str = Query("ratio,width_height", description="要分
                     "min_val": 0,
                     "max_val": 3,
                     "num_buckets": 20,
-                    "where_clause": "width IS NOT NULL AND height IS NOT NULL AND height<>0"
+                    "where_clause": "is_deleted IS NOT TRUE AND width IS NOT NULL AND height IS NOT NULL AND height<>0",
+                    "metric": "ratio"
                 })
             elif f == "size":
                 analysis_params.append({
@@ -54,7 +112,8 @@ def analyze_json(fields: str = Query("ratio,width_height", description="要分
                     "min_val": 0,
                     "max_val": 3000,
                     "num_buckets": 20,
-                    "where_clause": "width IS NOT NULL AND height IS NOT NULL"
+                    "where_clause": "is_deleted IS NOT TRUE AND width IS NOT NULL AND height IS NOT NULL",
+                    "metric": "size"
                 })
             elif f == "quality_score":
                 analysis_params.append({
@@ -63,7 +122,8 @@ def analyze_json(fields: str = Query("ratio,width_height", description="要分
                     "min_val": 0,
                     "max_val": 100,
                     "num_buckets": 20,
-                    "where_clause": "quality_score IS NOT NULL"
+                    "where_clause": "is_deleted IS NOT TRUE AND quality_score IS NOT NULL",
+                    "metric": "quality_score"
                 })
             elif f == "aesthetic_score":
                 analysis_params.append({
@@ -72,7 +132,8 @@ def analyze_json(fields: str = Query("ratio,width_height", description="要分
                     "min_val": 0,
                     "max_val": 10,
                     "num_buckets": 20,
-                    "where_clause": "aesthetic_score IS NOT NULL"
+                    "where_clause": "is_deleted IS NOT TRUE AND aesthetic_score IS NOT NULL",
+                    "metric": "aesthetic_score"
                 })
             elif f == "aesthetic_eat":
                 analysis_params.append({
@@ -81,85 +142,293 @@ def analyze_json(fields: str = Query("ratio,width_height", description="要分
                     "min_val": 0,
                     "max_val": 10,
                     "num_buckets": 20,
-                    "where_clause": "aesthetic_eat IS NOT NULL"
+                    "where_clause": "is_deleted IS NOT TRUE AND aesthetic_eat IS NOT NULL",
+                    "metric": "aesthetic_eat"
                 })
-        data = analyze_fields(analysis_params)
+        data = await analyze_fields(db, analysis_params, dataset_ids, path_prefixes, sample, use_summary)
         result = [{"name": key, "data": items} for key, items in data.items()]
-        return JSONResponse(content={"success": True, "charts": result})
+        return JSONResponse(content={
+            "success": True,
+            "charts": result,
+            "approximate": approximate,
+            "sample_percent": sample,
+        })
     except Exception as e:
         return JSONResponse(content={"success": False, "error": str(e)}, status_code=500)
 
+# 二维联合分布可选的坐标轴（num_buckets 由请求参数决定）
+JOINT_AXES = {
+    "width": {"sql_expr": "width", "min_val": 0, "max_val": 4096, "where_clause": "width IS NOT NULL"},
+    "height": {"sql_expr": "height", "min_val": 0, "max_val": 4096, "where_clause": "height IS NOT NULL"},
+    "ratio": {
+        "sql_expr": "width::float / height", "min_val": 0, "max_val": 3,
+        "where_clause": "width IS NOT NULL AND height IS NOT NULL AND height<>0",
+    },
+    "size": {
+        "sql_expr": "sqrt(width::float * height)", "min_val": 0, "max_val": 3000,
+        "where_clause": "width IS NOT NULL AND height IS NOT NULL",
+    },
+    "quality_score": {"sql_expr": "quality_score", "min_val": 0, "max_val": 100, "where_clause": "quality_score IS NOT NULL"},
+    "aesthetic_score": {"sql_expr": "aesthetic_score", "min_val": 0, "max_val": 10, "where_clause": "aesthetic_score IS NOT NULL"},
+    "aesthetic_eat": {"sql_expr": "aesthetic_eat", "min_val": 0, "max_val": 10, "where_clause": "aesthetic_eat IS NOT NULL"},
+}
+
+@app.get("/analyze_joint_json")
+async def analyze_joint_json(
+    x: str = Query("width", description=f"横轴字段：{'/'.join(JOINT_AXES)}"),
+    y: str = Query("height", description="纵轴字段，可选值同横轴"),
+    x_buckets: int = Query(50, ge=1, le=500),
+    y_buckets: int = Query(50, ge=1, le=500),
+    ids: Optional[str] = Query(None, description="只分析这些树节点（数据集或目录）下的图片，逗号分隔，默认全部"),
+    approximate: bool = Query(False, description="近似模式：按采样估计"),
+    sample_percent: float = Query(1.0, gt=0, le=100, description="近似模式的采样百分比"),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    二维直方图（宽×高热力图、质量×美学散点密度等），服务端一次扫描完成分桶，
+    返回 counts 矩阵和两个轴的边界，不返回逐点数据
+    """
+    for axis in (x, y):
+        if axis not in JOINT_AXES:
+            raise HTTPException(status_code=400, detail=f"Unknown axis: {axis}")
+    dataset_ids = path_prefixes = None
+    if ids:
+        node_ids = parse_node_ids(ids)
+        dataset_ids, path_prefixes = await resolve_tree_selection(db, node_ids)
+    try:
+        sample = sample_percent if approximate else None
+
+        x_field = dict(JOINT_AXES[x], num_buckets=x_buckets)
+        y_field = dict(JOINT_AXES[y], num_buckets=y_buckets)
+        # 和一维分布一致，只统计不在回收站中的图片
+        x_field["where_clause"] = f"is_deleted IS NOT TRUE AND {x_field['where_clause']}"
+
+        data = await analyze_joint(db, x_field, y_field, dataset_ids, path_prefixes, sample)
+        return JSONResponse(content={
+            "success": True,
+            "x": x,
+            "y": y,
+            **data,
+            "approximate": approximate,
+            "sample_percent": sample,
+        })
+    except Exception as e:
+        return JSONResponse(content={"success": False, "error": str(e)}, status_code=500)
+
+# ------------------- 监控指标 -------------------
+
+@app.get("/api/metrics/search_outbox")
+async def get_search_outbox_metrics(db: AsyncSession = Depends(get_db)):
+    metrics = await search_outbox_lag(db)
+    metrics["consecutive_failures"] = search_outbox_worker.failures
+    metrics["last_error"] = search_outbox_worker.last_error
+    return metrics
+
 # ------------------- Dataset tree -------------------
 
 @app.get("/api/datasets/tree", response_model=List[DatasetTree])
-async def get_dataset_tree(db: AsyncSession = Depends(get_db)):
-    return await query_dataset_ids_and_build_tree(db)
+async def get_dataset_tree(
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    etag, body = await dataset_tree_cache.get(db)
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+@app.get("/api/datasets/tree/roots", response_model=List[DatasetTreeNode])
+async def get_dataset_tree_roots(response: Response, db: AsyncSession = Depends(get_db)):
+    etag, roots = await dataset_tree_cache.get_roots(db)
+    response.headers["ETag"] = etag
+    return roots
+
+@app.get("/api/datasets/tree/{node_id}/children", response_model=List[DatasetTreeNode])
+async def get_dataset_tree_children(node_id: UUID, response: Response, db: AsyncSession = Depends(get_db)):
+    etag, children = await dataset_tree_cache.get_children(db, node_id)
+    if children is None:
+        raise HTTPException(status_code=404, detail="Tree node not found")
+    response.headers["ETag"] = etag
+    return children
+
+@app.get("/api/datasets/{node_id}/duplicates", response_model=DuplicateClustersPage)
+async def get_dataset_duplicates(
+    node_id: UUID,
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=200),
+    max_members: int = Query(50, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    """列出树节点（数据集或目录）下图片所在的近重复簇，结果来自最近一次 FindNearDuplicates 扫描"""
+    dataset_ids, path_prefixes = await resolve_tree_selection(db, [node_id])
+    try:
+        return await query_duplicate_clusters_page(
+            db, selected_datasets_stmt(dataset_ids, path_prefixes), limit, cursor, max_members)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 # ------------------- 图片列表 -------------------
 
 @app.post("/api/images", response_model=ImagesOut)
 async def get_images(req: ImageRequest, db: AsyncSession = Depends(get_db)):
-    return await query_images_by_dataset_ids(db, req.ids, req.page, req.pageSize)
+    # ids 可以是任意树节点（目录或数据集），在服务端展开成其下的数据集
+    dataset_ids, path_prefixes = await resolve_tree_selection(db, req.ids)
+    try:
+        return await query_images_by_dataset_ids(
+            db, dataset_ids, req.page, req.pageSize, req.cursor, req.with_total, path_prefixes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/images/{image_id}/similar", response_model=SimilarImagesOut)
+async def get_similar_images(
+    image_id: UUID,
+    k: int = Query(20, ge=1, le=200),
+    ids: Optional[str] = Query(None, description="只在这些树节点（数据集或目录）下查找，逗号分隔，默认全部"),
+    nprobe: int = Query(16, ge=1, le=1024, description="扫描的聚类数，越大越准、越慢"),
+    db: AsyncSession = Depends(get_db)
+):
+    """按 image_embedding 查找相似图片（进程内 ANN 索引，见 ann_index.py）"""
+    # 导入或回收站操作之后在后台增量更新索引，本次查询仍用当前索引
+    await ann_index.ensure_fresh(db)
+    snapshot = ann_index.snapshot
+    if snapshot is None:
+        raise HTTPException(status_code=503, detail="Similarity index is being built")
+
+    query = snapshot.vector_of(image_id)
+    if query is None:
+        query = await get_image_embedding(db, image_id)
+        if query is None:
+            raise HTTPException(status_code=404, detail="Image not found or has no embedding")
+
+    dataset_ids = None
+    if ids:
+        node_ids = parse_node_ids(ids)
+        selected_ids, path_prefixes = await resolve_tree_selection(db, node_ids)
+        result = await db.execute(selected_datasets_stmt(selected_ids, path_prefixes))
+        dataset_ids = [str(i) for i in result.scalars()]
+
+    hits = await ann_index.search(query, k, dataset_ids, nprobe, exclude=image_id)
+    images = await query_images_by_ids(db, [hit_id for hit_id, _ in hits])
+    scores = dict(hits)
+    return {"images": [dict(img, score=scores[img["id"]]) for img in images]}
 
 # ------------------- 回收站接口 -------------------
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# 分页 / 流式版本：整表接口在大目录上会返回数 GB 响应，优先使用这些
+
+@app.get("/images/page", response_model=ImagesOut)
+async def list_images_page(
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        return await query_image_list_page(db, False, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/images/stream")
+async def stream_images():
+    return StreamingResponse(stream_image_list_ndjson(deleted=False), media_type=NDJSON_MEDIA_TYPE)
+
+@app.get("/images/recycle_bin/page", response_model=ImagesOut)
+async def list_recycle_bin_page(
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        return await query_image_list_page(db, True, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/images/recycle_bin/stream")
+async def stream_recycle_bin():
+    return StreamingResponse(stream_image_list_ndjson(deleted=True), media_type=NDJSON_MEDIA_TYPE)
+
+@app.get("/images/recycle_bin_log/page", response_model=RecycleBinLogPage)
+async def list_recycle_bin_log_page(
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        return await query_recycle_bin_log_page(db, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/images/recycle_bin_log/stream")
+async def stream_recycle_bin_log():
+    return StreamingResponse(stream_recycle_bin_log_ndjson(), media_type=NDJSON_MEDIA_TYPE)
+
 @app.get("/images/", response_model=List[ImageOut])
 async def list_images(db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Image).where(Image.is_deleted == False))
-    return result.scalars().all()
+    return await query_image_list(db, deleted=False)
 
 @app.get("/images/recycle_bin_log", response_model=List[RecycleBinLogOut])
 async def list_recycle_bin_log(db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(RecycleBinLog))
-    return result.scalars().all()
+    return await query_recycle_bin_log(db)
 
 @app.get("/images/recycle_bin", response_model=List[ImageOut])
 async def list_recycle_bin(db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Image).where(Image.is_deleted == True))
-    return result.scalars().all()
+    return await query_image_list(db, deleted=True)
 
 
 # 删除接口
 @app.post("/images/{image_id}/delete")
 async def delete_image(image_id: UUID, data: ImageDeleteRequest, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Image).where(Image.id == image_id))
-    image = result.scalar_one_or_none()
-    if not image:
+    outcome = await set_images_deleted(db, True, data.deleted_by, data.reason, image_ids=[image_id])
+    if outcome["results"][0]["status"] == "not_found":
         raise HTTPException(status_code=404, detail="Image not found")
 
-    image.is_deleted = True
-    image.deleted_at = datetime.utcnow()
-    image.deleted_by = data.deleted_by
+    # 同步到 Meilisearch（经 search_outbox，与本次修改同事务）
+    await sync_recycle_bin_to_meilisearch(db, outcome["changed"], True, data.deleted_by)
 
     await db.commit()
 
-    # 同步到 Meilisearch
-    index.update_documents([{
-        "id": str(image.id),
-        "is_deleted": True,
-        "deleted_by": data.deleted_by
-    }])
-
     return {"message": "Image moved to recycle bin"}
 
 # 恢复接口类似
 @app.post("/images/{image_id}/restore")
 async def restore_image(image_id: UUID, data: ImageDeleteRequest, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Image).where(Image.id == image_id))
-    image = result.scalar_one_or_none()
-    if not image:
+    outcome = await set_images_deleted(db, False, data.deleted_by, data.reason, image_ids=[image_id])
+    if outcome["results"][0]["status"] == "not_found":
         raise HTTPException(status_code=404, detail="Image not found")
 
-    image.is_deleted = False
-    image.deleted_at = None
-    image.deleted_by = data.deleted_by
+    await sync_recycle_bin_to_meilisearch(db, outcome["changed"], False, data.deleted_by)
+
+    await db.commit()
+
+    return {"message": "Image restored"}
+
+# 批量删除 / 恢复
+async def bulk_set_deleted(req: BulkRecycleRequest, deleted: bool, db: AsyncSession):
+    if (req.image_ids is None) == (req.filter is None):
+        raise HTTPException(status_code=400, detail="Exactly one of image_ids or filter is required")
+
+    if req.image_ids is not None:
+        outcome = await set_images_deleted(db, deleted, req.deleted_by, req.reason, image_ids=req.image_ids)
+    else:
+        if not req.filter.ids:
+            raise HTTPException(status_code=400, detail="filter.ids must not be empty")
+        dataset_ids, path_prefixes = await resolve_tree_selection(db, req.filter.ids)
+        outcome = await set_images_deleted(
+            db, deleted, req.deleted_by, req.reason,
+            selection=selected_datasets_stmt(dataset_ids, path_prefixes),
+            max_quality_score=req.filter.max_quality_score,
+            max_aesthetic_score=req.filter.max_aesthetic_score)
+
+    await sync_recycle_bin_to_meilisearch(db, outcome["changed"], deleted, req.deleted_by)
 
     await db.commit()
 
-    index.update_documents([{
-        "id": str(image.id),
-        "is_deleted": False,
-        "deleted_by": data.deleted_by
-    }])
+    return {"affected": len(outcome["changed"]), "results": outcome["results"]}
+
+@app.post("/images/bulk_delete", response_model=BulkRecycleOut)
+async def bulk_delete_images(req: BulkRecycleRequest, db: AsyncSession = Depends(get_db)):
+    return await bulk_set_deleted(req, True, db)
 
-    return {"message": "Image restored"}
\ No newline at end of file
+@app.post("/images/bulk_restore", response_model=BulkRecycleOut)
+async def bulk_restore_images(req: BulkRecycleRequest, db: AsyncSession = Depends(get_db)):
+    return await bulk_set_deleted(req, False, db)
@@ -1,13 +1,44 @@
 import uuid
+import numpy as np
 from sqlalchemy import (
     Column, LargeBinary, PrimaryKeyConstraint, String, Integer, BigInteger, Text, Float, TIMESTAMP, UniqueConstraint,
-    ForeignKey, Index, ARRAY, Boolean, CheckConstraint
+    ForeignKey, Index, ARRAY, Boolean, CheckConstraint, text
 )
-from sqlalchemy.dialects.postgresql import UUID, REAL, CHAR
+from sqlalchemy.dialects.postgresql import JSONB, UUID, REAL, CHAR
 from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.types import TypeDecorator
 
 Base = declarative_base()
 
+# image_features.embedding 的存储格式：小端 float16
+EMBEDDING_DTYPE = np.dtype("<f2")
+
+
+def encode_embedding(values):
+    """向量（list / ndarray）-> float16 字节串"""
+    if values is None:
+        return None
+    return np.asarray(values, dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def decode_embedding(data):
+    """float16 字节串 -> float32 ndarray"""
+    if data is None:
+        return None
+    return np.frombuffer(data, dtype=EMBEDDING_DTYPE).astype(np.float32)
+
+
+class Float16Vector(TypeDecorator):
+    """以 float16 BYTEA 存储的定长向量，读出为 float32 ndarray，写入接受 list / ndarray"""
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return encode_embedding(value)
+
+    def process_result_value(self, value, dialect):
+        return decode_embedding(value)
+
 
 class Dataset(Base):
     __tablename__ = "datasets"
@@ -20,7 +51,80 @@ class Dataset(Base):
     origin_url = Column(Text)
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="now()")
 
+    __table_args__ = (
+        # 目录前缀匹配（按树节点展开数据集）用的 C 排序规则索引
+        Index("idx_datasets_dir_path_c", text('dir_path COLLATE "C"')),
+    )
+
     images = relationship("Image", cascade="all, delete-orphan", back_populates="dataset")
+    stats = relationship("DatasetStats", cascade="all, delete-orphan", uselist=False, back_populates="dataset")
+
+
+class DatasetStats(Base):
+    """
+    每个数据集的统计信息，由 refresh_dataset_stats() 在导入后按数据集重算，
+    回收站接口删除/恢复时做增量调整。
+    """
+    __tablename__ = "dataset_stats"
+
+    dataset_id = Column(UUID(as_uuid=True), ForeignKey("datasets.id", ondelete="CASCADE"), primary_key=True)
+    image_count = Column(BigInteger, nullable=False, server_default="0")    # 未删除图片数
+    deleted_count = Column(BigInteger, nullable=False, server_default="0")  # 回收站中的图片数
+    total_bytes = Column(BigInteger, nullable=False, server_default="0")    # 未删除图片 file_size 之和
+    # 分数统计覆盖数据集全部图片（含回收站），*_count 为非空分数个数，用于跨数据集加权平均
+    quality_count = Column(BigInteger, nullable=False, server_default="0")
+    quality_min = Column(REAL)
+    quality_avg = Column(Float)
+    quality_max = Column(REAL)
+    aesthetic_count = Column(BigInteger, nullable=False, server_default="0")
+    aesthetic_min = Column(REAL)
+    aesthetic_avg = Column(Float)
+    aesthetic_max = Column(REAL)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="now()")
+
+    dataset = relationship("Dataset", back_populates="stats")
+
+
+class HistogramMetric(Base):
+    """
+    直方图指标定义：按 [min_val, max_val) 等宽切成 num_buckets 个细桶（width_bucket 语义），
+    指标取值的表达式见 schema2.sql 中的 image_histogram_buckets()。
+    """
+    __tablename__ = "histogram_metrics"
+
+    metric = Column(Text, primary_key=True)
+    min_val = Column(Float, nullable=False)
+    max_val = Column(Float, nullable=False)
+    num_buckets = Column(Integer, nullable=False)
+
+
+class DatasetHistogram(Base):
+    """
+    每个数据集在各指标细桶上的图片数（只统计未删除图片）。
+    导入后由 refresh_dataset_stats() 重算，回收站操作由 apply_dataset_histogram_delta() 增量调整。
+    """
+    __tablename__ = "dataset_histograms"
+
+    dataset_id = Column(UUID(as_uuid=True), ForeignKey("datasets.id", ondelete="CASCADE"), primary_key=True)
+    metric = Column(Text, ForeignKey("histogram_metrics.metric", ondelete="CASCADE"), primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    count = Column(BigInteger, nullable=False, server_default="0")
+
+
+class CatalogVersion(Base):
+    """
+    单行表，保存目录版本号。数据集变更（触发器）、导入（refresh_dataset_stats）
+    和回收站操作都会递增 version，用于判断进程内缓存是否过期。
+    """
+    __tablename__ = "catalog_version"
+
+    id = Column(Boolean, primary_key=True, server_default="true")
+    version = Column(BigInteger, nullable=False, server_default="0")
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="now()")
+
+    __table_args__ = (
+        CheckConstraint("id", name="ck_catalog_version_single_row"),
+    )
 
 
 class Image(Base):
@@ -34,14 +138,16 @@ class Image(Base):
     file_format = Column(Text)
     last_modified = Column(TIMESTAMP(timezone=True))
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="now()")
+    # 行内容变化时由触发器更新，用于增量同步 Meilisearch
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="now()")
     width = Column(Integer)
     height = Column(Integer)
-    semantic_center = Column(ARRAY(REAL))
     aesthetic_eat = Column(REAL)
     watermark_prob = Column(REAL)
     quality_score = Column(REAL)
     aesthetic_score = Column(REAL)
-    image_embedding = Column(ARRAY(REAL))
+    # semantic_center / image_embedding 在 image_features 表
+    features = relationship("ImageFeatures", uselist=False, back_populates="image", passive_deletes=True)
 
     # 回收站相关字段
     is_deleted = Column(Boolean, nullable=False, server_default="false")
@@ -51,11 +157,16 @@ class Image(Base):
     __table_args__ = (
         UniqueConstraint("dataset_id", "file_path", name="uq_images_dataset_file_path"),
         Index("idx_images_dataset_id", "dataset_id"),
+        # keyset 分页：按 (dataset_id, file_path, id) 范围扫描
+        Index("idx_images_dataset_file_path_id", "dataset_id", "file_path", "id"),
         Index("idx_images_file_hash", "file_hash"),
         Index("idx_images_quality_score", "quality_score"),
         Index("idx_images_aesthetic_score", "aesthetic_score"),
         Index("idx_images_width", "width"),
         Index("idx_images_height", "height"),
+        # 回收站浏览只扫描已删除的行
+        Index("idx_images_recycle_bin", "id", postgresql_where=text("is_deleted = true")),
+        Index("idx_images_updated_at", "updated_at"),
     )
 
     dataset = relationship("Dataset", back_populates="images")
@@ -128,6 +239,131 @@ class RecycleBinLog(Base):
     __table_args__ = (
         CheckConstraint("action IN ('DELETE', 'RESTORE')", name="ck_recycle_action"),
         Index("idx_recycle_bin_log_image_id", "image_id"),
+        Index("idx_recycle_bin_log_action_at_id", "action_at", "id"),
     )
 
     image = relationship("Image", back_populates="recycle_logs")
+
+
+class SearchOutbox(Base):
+    """
+    Meilisearch 更新的事务性发件箱：业务修改时在同一事务里写入，
+    由后台 SearchOutboxWorker 合并后批量推送，推送成功后删除。
+    """
+    __tablename__ = "search_outbox"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    doc_id = Column(UUID(as_uuid=True), nullable=False)
+    payload = Column(JSONB, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="now()")
+
+
+class ImageTombstone(Base):
+    """图片硬删除时由触发器写入，增量同步据此从 Meilisearch 删除文档"""
+    __tablename__ = "image_tombstones"
+
+    image_id = Column(UUID(as_uuid=True), primary_key=True)
+    deleted_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="now()")
+
+    __table_args__ = (
+        Index("idx_image_tombstones_deleted_at", "deleted_at"),
+    )
+
+
+class SyncState(Base):
+    """各增量同步任务的水位（上次成功同步时的时间点）"""
+    __tablename__ = "sync_state"
+
+    name = Column(Text, primary_key=True)
+    watermark = Column(TIMESTAMP(timezone=True))
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="now()")
+
+
+class DuplicateScanRun(Base):
+    """
+    一次近重复扫描（utils/FindNearDuplicates.py）。
+    status: exporting 导出向量 / comparing 按行块比较（next_block 之前的块已完成）/ done
+    """
+    __tablename__ = "duplicate_scan_runs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    threshold = Column(REAL, nullable=False)
+    block_rows = Column(Integer, nullable=False)
+    num_rows = Column(BigInteger)
+    next_block = Column(Integer, nullable=False, server_default="0")
+    status = Column(Text, nullable=False, server_default="exporting")
+    started_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="now()")
+    finished_at = Column(TIMESTAMP(timezone=True))
+
+    __table_args__ = (
+        CheckConstraint("status IN ('exporting', 'comparing', 'done')", name="ck_duplicate_scan_status"),
+    )
+
+
+class DuplicatePair(Base):
+    """相似度超过阈值、且连接了两个不同簇的图片对（生成森林的边）"""
+    __tablename__ = "duplicate_pairs"
+
+    run_id = Column(Integer, ForeignKey("duplicate_scan_runs.id", ondelete="CASCADE"), primary_key=True)
+    image_a = Column(UUID(as_uuid=True), primary_key=True)
+    image_b = Column(UUID(as_uuid=True), primary_key=True)
+    similarity = Column(REAL, nullable=False)
+
+
+class DuplicateCluster(Base):
+    """扫描完成后每张重复图片所属的簇，cluster_id 为簇内最小的图片 id"""
+    __tablename__ = "duplicate_clusters"
+
+    run_id = Column(Integer, ForeignKey("duplicate_scan_runs.id", ondelete="CASCADE"), primary_key=True)
+    image_id = Column(UUID(as_uuid=True), ForeignKey("images.id", ondelete="CASCADE"), primary_key=True)
+    dataset_id = Column(UUID(as_uuid=True), nullable=False)
+    cluster_id = Column(UUID(as_uuid=True), nullable=False)
+
+    __table_args__ = (
+        Index("idx_duplicate_clusters_dataset", "run_id", "dataset_id", "cluster_id"),
+        Index("idx_duplicate_clusters_cluster", "run_id", "cluster_id"),
+    )
+
+
+class ImportManifest(Base):
+    """
+    已导入的 ImageInfo 文件（utils/ImportParquetDataset.py、ImportJsonDataset.py）。
+    status: running 导入中（rows_done 之前的行已提交）/ done
+    """
+    __tablename__ = "import_manifest"
+
+    file_path = Column(Text, primary_key=True)
+    dataset_id = Column(UUID(as_uuid=True), ForeignKey("datasets.id", ondelete="CASCADE"))
+    file_size = Column(BigInteger, nullable=False)
+    file_mtime = Column(TIMESTAMP(timezone=True), nullable=False)
+    content_hash = Column(LargeBinary, nullable=False)
+    tables = Column(ARRAY(Text), nullable=False)
+    total_rows = Column(BigInteger)
+    rows_done = Column(BigInteger, nullable=False, server_default="0")
+    status = Column(Text, nullable=False, server_default="running")
+    started_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="now()")
+    finished_at = Column(TIMESTAMP(timezone=True))
+
+    __table_args__ = (
+        CheckConstraint("status IN ('running', 'done')", name="ck_import_manifest_status"),
+    )
+
+
+class ImageFeatures(Base):
+    """
+    只有相似度功能用到的大字段，从 images 拆出，列表和统计扫描 images 时不会读到。
+    embedding 以 float16 字节串存储（Float16Vector），读出为 float32 ndarray。
+    """
+    __tablename__ = "image_features"
+
+    image_id = Column(UUID(as_uuid=True), ForeignKey("images.id", ondelete="CASCADE"), primary_key=True)
+    embedding = Column(Float16Vector)
+    semantic_center = Column(ARRAY(REAL))
+    # 行内容变化时由触发器更新，用于增量同步
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="now()")
+
+    image = relationship("Image", back_populates="features")
+
+    __table_args__ = (
+        Index("idx_image_features_updated_at", "updated_at"),
+    )
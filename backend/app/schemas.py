@@ -10,6 +10,17 @@ class DatasetTree(BaseModel):
     id: UUID
     name: str
     children: Optional[List[DatasetTree]]
+    # 子树汇总计数（来自 dataset_stats）
+    image_count: int = 0
+    deleted_count: int = 0
+
+class DatasetTreeNode(BaseModel):
+    """按需展开时返回的单个节点（不含子节点，has_children 表示能否继续展开）"""
+    id: UUID
+    name: str
+    image_count: int = 0
+    deleted_count: int = 0
+    has_children: bool = False
 
 class ImageSize(BaseModel):
     w: Optional[int]
@@ -33,21 +44,78 @@ class ImageOut(BaseModel):
     deleted_by: Optional[str] = None
 
 class ImagesOut(BaseModel):
-    total: int
+    # ImageRequest.with_total=False 时为 None
+    total: Optional[int]
     images: List[ImageOut]
+    # keyset 分页游标，本页取满时返回，传回 ImageRequest.cursor 取下一页
+    next_cursor: Optional[str] = None
+
+class SimilarImageOut(ImageOut):
+    # 与查询图片 embedding 的余弦相似度
+    score: float
+
+class SimilarImagesOut(BaseModel):
+    images: List[SimilarImageOut]
+
+class DuplicateClusterOut(BaseModel):
+    # 簇内最小的图片 id
+    cluster_id: UUID
+    # 簇的完整大小，images 最多只返回 max_members 张
+    size: int
+    images: List[ImageOut]
+
+class DuplicateClustersPage(BaseModel):
+    # 结果来自的扫描；还没有完成过扫描时为 None
+    run_id: Optional[int]
+    clusters: List[DuplicateClusterOut]
+    next_cursor: Optional[str] = None
 
 class ImageRequest(BaseModel):
+    # 树节点 id：数据集 id 或目录节点 id，目录会在服务端展开成其下所有数据集
     ids: List[UUID]
     page: int = 0
     pageSize: int = 20
+    # 不透明游标（来自上一页的 next_cursor），传入时忽略 page
+    cursor: Optional[str] = None
+    # 是否同时统计总数（翻页时已知总数可以关掉）
+    with_total: bool = True
 
 class ImageDeleteRequest(BaseModel):
     deleted_by: str
     reason: Optional[str] = None
 
 
+class ImageFilter(BaseModel):
+    # 树节点 id：数据集 id 或目录节点 id
+    ids: List[UUID]
+    # 只匹配分数低于阈值的图片
+    max_quality_score: Optional[float] = None
+    max_aesthetic_score: Optional[float] = None
+
+class BulkRecycleRequest(BaseModel):
+    # image_ids 与 filter 二选一
+    image_ids: Optional[List[UUID]] = None
+    filter: Optional[ImageFilter] = None
+    deleted_by: str
+    reason: Optional[str] = None
+
+class BulkRecycleResult(BaseModel):
+    id: UUID
+    status: str  # 'ok' / 'unchanged' / 'not_found'
+
+class BulkRecycleOut(BaseModel):
+    affected: int
+    results: List[BulkRecycleResult]
+
+
 class RecycleBinLogOut(BaseModel):
     image_id: UUID
     action: str  # 'DELETE' 或 'RESTORE'
+    action_at: Optional[datetime] = None
     action_by: Optional[str] = None
     reason: Optional[str] = None
+
+class RecycleBinLogPage(BaseModel):
+    items: List[RecycleBinLogOut]
+    # keyset 分页游标，本页取满时返回
+    next_cursor: Optional[str] = None
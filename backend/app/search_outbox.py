@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import SearchOutbox
+
+logger = logging.getLogger(__name__)
+
+
+async def enqueue_search_updates(db: AsyncSession, docs: Iterable[Dict]):
+    """
+    把 Meilisearch 文档的局部更新写入 search_outbox。
+    docs 每项必须带 "id"，其余字段作为要更新的内容。
+    与业务修改在同一事务里提交，数据库回滚时更新也一起丢弃。
+    """
+    rows = [
+        {"doc_id": doc["id"], "payload": {k: v for k, v in doc.items() if k != "id"}}
+        for doc in docs
+    ]
+    if rows:
+        await db.execute(insert(SearchOutbox), rows)
+
+
+async def search_outbox_lag(db: AsyncSession) -> Dict:
+    """待同步条数以及最老一条的积压时间（秒）"""
+    result = await db.execute(
+        select(
+            func.count(),
+            func.extract("epoch", func.now() - func.min(SearchOutbox.created_at)),
+        )
+    )
+    pending, lag = result.one()
+    return {"pending": pending, "lag_seconds": float(lag) if lag is not None else 0.0}
+
+
+# 所有进程共用的 advisory lock 键，保证同一时刻只有一个进程在推送 search_outbox
+SEARCH_OUTBOX_LOCK_ID = 0x5EA7C40B0C
+
+
+def merge_outbox_rows(rows) -> List[Dict]:
+    """rows: 按 id 升序的 (id, doc_id, payload)；同一文档的多次更新按顺序合并，后写入的字段覆盖先写入的"""
+    merged = {}
+    for _, doc_id, payload in rows:
+        merged.setdefault(str(doc_id), {}).update(payload or {})
+    return [{"id": doc_id, **fields} for doc_id, fields in merged.items()]
+
+
+class SearchOutboxWorker:
+    """
+    后台消费 search_outbox，把更新批量推送到 Meilisearch：
+      - 每个 uvicorn 进程都会启动 worker，但每批都在事务里先取 pg_try_advisory_xact_lock，
+        取不到锁的进程跳过本轮，所以同一时刻只有一个进程在推送，各批次严格按 id 顺序发送，
+        同一文档的更新不会乱序
+      - 每批按 id 顺序取出，同一文档的多次更新按顺序合并成一条
+      - 推送成功后在同一事务里删除这批行并释放锁；失败则回滚并指数退避重试
+    写入方先修改 images 行再写 outbox，同一图片的修改被行锁串行化，outbox id 的顺序与提交顺序一致。
+    meilisearch.Client 是同步的，推送放到线程里执行，不阻塞事件循环。
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        index,
+        batch_size: int = 1000,
+        poll_interval: float = 1.0,
+        max_backoff: float = 60.0
+    ):
+        self.session_factory = session_factory
+        self.index = index
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def drain_once(self) -> int:
+        """处理一批，返回处理的 outbox 行数；其它进程正在推送时返回 0"""
+        async with self.session_factory() as db:
+            locked = await db.execute(select(func.pg_try_advisory_xact_lock(SEARCH_OUTBOX_LOCK_ID)))
+            if not locked.scalar():
+                return 0
+
+            result = await db.execute(
+                select(SearchOutbox.id, SearchOutbox.doc_id, SearchOutbox.payload)
+                .order_by(SearchOutbox.id)
+                .limit(self.batch_size)
+            )
+            rows = result.all()
+            if not rows:
+                return 0
+
+            await asyncio.to_thread(self.index.update_documents, merge_outbox_rows(rows))
+
+            await db.execute(
+                delete(SearchOutbox).where(SearchOutbox.id.in_([row_id for row_id, _, _ in rows]))
+            )
+            await db.commit()
+            return len(rows)
+
+    async def run(self):
+        while True:
+            try:
+                processed = await self.drain_once()
+                self.failures = 0
+                self.last_error = None
+                if processed < self.batch_size:
+                    await asyncio.sleep(self.poll_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                backoff = min(self.max_backoff, self.poll_interval * 2 ** self.failures)
+                logger.warning("search outbox sync failed (%d), retry in %.1fs: %s", self.failures, backoff, e)
+                await asyncio.sleep(backoff)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# 测试以 app 包的形式导入后端代码：python -m pytest backend/tests
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from app.dataset_analysis import analyze
+
+
+@pytest.fixture
+def catalog_version(monkeypatch):
+    state = {"version": 1}
+
+    async def fake_get_catalog_version(db):
+        return state["version"]
+
+    monkeypatch.setattr(analyze, "get_catalog_version", fake_get_catalog_version)
+    return state
+
+
+def test_different_keys_compute_concurrently(catalog_version):
+    cache = analyze.AnalysisCache()
+
+    async def main():
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await release.wait()
+            return "slow"
+
+        async def fast():
+            return "fast"
+
+        slow_task = asyncio.create_task(cache.get(None, "a", slow))
+        await started.wait()
+        # key a 的计算还没结束，key b 不应被它阻塞
+        assert await asyncio.wait_for(cache.get(None, "b", fast), 1) == "fast"
+        release.set()
+        assert await slow_task == "slow"
+
+    asyncio.run(main())
+
+
+def test_identical_keys_share_one_computation(catalog_version):
+    cache = analyze.AnalysisCache()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"n": len(calls)}
+
+    async def main():
+        return await asyncio.gather(*(cache.get(None, "k", compute) for _ in range(5)))
+
+    assert asyncio.run(main()) == [{"n": 1}] * 5
+    assert len(calls) == 1
+
+
+def test_failed_computation_is_not_cached(catalog_version):
+    cache = analyze.AnalysisCache()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        return "ok"
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await cache.get(None, "k", compute)
+        return await cache.get(None, "k", compute)
+
+    assert asyncio.run(main()) == "ok"
+    assert len(calls) == 2
+
+
+def test_lru_limit_and_version_reset(catalog_version):
+    cache = analyze.AnalysisCache(max_entries=2)
+
+    async def value(v):
+        return v
+
+    async def main():
+        for key in ("a", "b"):
+            await cache.get(None, key, lambda key=key: value(key))
+        await cache.get(None, "a", lambda: value("a"))  # a 变为最近使用
+        await cache.get(None, "c", lambda: value("c"))
+        assert list(cache.results) == ["a", "c"]
+
+        catalog_version["version"] = 2
+        await cache.get(None, "d", lambda: value("d"))
+        assert list(cache.results) == ["d"]
+
+    asyncio.run(main())
@@ -0,0 +1,133 @@
+import asyncio
+import uuid
+from dataclasses import replace
+from datetime import datetime, timezone
+
+import numpy as np
+
+from app import ann_index
+from app.ann_index import (
+    ID_DTYPE, AnnIndex, apply_changes, build_main_segment, empty_snapshot, load_snapshot,
+    normalize, publish_generation, read_current, remove_stale_generations, save_generation
+)
+
+WATERMARK = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def make_ids(n):
+    return np.array([uuid.UUID(int=i + 1).bytes for i in range(n)], dtype=ID_DTYPE)
+
+
+def build_generation(root, n=200, dim=8, seed=0):
+    """构建一个主段并发布一代，返回 (向量, ids, 代的目录名)"""
+    rng = np.random.default_rng(seed)
+    raw = normalize(rng.standard_normal((n, dim)))
+    ids = make_ids(n)
+    main = ann_index._new_name("main")
+    (root / main).mkdir(parents=True)
+    nlist = build_main_segment(root / main, raw, ids, np.zeros(n, dtype=np.int32), 1)
+    snap = replace(empty_snapshot(dim, WATERMARK, 1), datasets=("ds",), alive=np.ones(n, dtype=bool),
+                   tail_list_offsets=np.zeros(nlist + 1, dtype=np.int64), main_segment=main)
+    generation = ann_index._new_name("gen")
+    save_generation(root / generation, snap)
+    publish_generation(root, generation)
+    return raw, ids, generation
+
+
+def test_search_finds_the_query_vector(tmp_path):
+    raw, ids, generation = build_generation(tmp_path)
+    snap = load_snapshot(tmp_path / generation)
+    hits = snap.search(raw[7], 3, nprobe=len(snap.centroids))
+    assert hits[0][0] == uuid.UUID(bytes=bytes(ids[7]))
+    assert abs(hits[0][1] - 1.0) < 1e-5
+
+
+def test_update_publishes_new_generation_without_touching_the_old_one(tmp_path):
+    raw, ids, first = build_generation(tmp_path)
+    old = load_snapshot(tmp_path / first)
+    new = apply_changes(old, ids[:10], np.empty(0, dtype=ID_DTYPE), [], np.empty((0, 8), np.float32),
+                        WATERMARK, 2)
+    second = ann_index._new_name("gen")
+    save_generation(tmp_path / second, new)
+    publish_generation(tmp_path, second)
+
+    assert read_current(tmp_path) == second
+    assert load_snapshot(tmp_path / first).alive.all()
+    reloaded = load_snapshot(tmp_path / second)
+    assert reloaded.size == len(ids) - 10
+    assert len(reloaded.alive) == len(reloaded.ids)
+
+
+def test_tail_is_grouped_by_nearest_centroid_and_probed_with_it(tmp_path):
+    raw, ids, generation = build_generation(tmp_path)
+    snap = load_snapshot(tmp_path / generation)
+    # 新数据集的向量只在尾段里：取主段里几个向量的近邻作为新增向量
+    rng = np.random.default_rng(1)
+    added = normalize(raw[:20] + 0.01 * rng.standard_normal((20, 8)))
+    added_ids = np.array([uuid.uuid4().bytes for _ in range(20)], dtype=ID_DTYPE)
+    new = apply_changes(snap, np.empty(0, dtype=ID_DTYPE), added_ids, ["new"] * 20, added, WATERMARK, 2)
+
+    lists = np.repeat(np.arange(len(new.centroids)), np.diff(new.tail_list_offsets))
+    assert np.array_equal(lists, ann_index.assign_lists(new.tail_vectors, new.centroids))
+
+    # nprobe=1 只扫描一个聚类，仍然能在尾段里找到查询向量本身
+    query_row = int(np.flatnonzero(new.tail_ids == added_ids[3])[0])
+    hits = new.search(new.tail_vectors[query_row], 1, nprobe=1)
+    assert hits[0][0] == uuid.UUID(bytes=bytes(added_ids[3]))
+
+    # 只选尾段里的数据集：行数很少，走精确计算
+    hits = new.search(added[5], 20, dataset_ids=["new"])
+    assert len(hits) == 20
+    assert hits[0][0] == uuid.UUID(bytes=bytes(added_ids[5]))
+
+
+def test_remove_stale_generations_keeps_recent_ones_and_their_main_segments(tmp_path):
+    for seed in range(5):
+        build_generation(tmp_path, seed=seed)
+    current = read_current(tmp_path)
+    remove_stale_generations(tmp_path, keep=2)
+
+    generations = sorted(p.name for p in tmp_path.glob("gen-*"))
+    assert len(generations) == 2 and generations[-1] == current
+    assert len(list(tmp_path.glob("main-*"))) == 2
+    for name in generations:
+        assert load_snapshot(tmp_path / name) is not None
+
+
+class FakeSession:
+    def __init__(self, locked):
+        self.locked = locked
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt):
+        assert "pg_try_advisory_xact_lock" in str(stmt)
+        locked = self.locked
+
+        class Result:
+            def scalar(self):
+                return locked
+
+        return Result()
+
+
+def test_refresh_without_lock_only_reloads_published_generation(tmp_path):
+    _, _, first = build_generation(tmp_path)
+    index = AnnIndex(lambda: FakeSession(locked=False), tmp_path)
+    asyncio.run(index.load())
+    assert index.snapshot.generation == first
+
+    # 另一个进程发布了新的一代
+    _, _, second = build_generation(tmp_path, seed=1)
+
+    async def must_not_build():
+        raise AssertionError("only the lock holder may build")
+
+    index.rebuild = index.update = must_not_build
+    asyncio.run(index.refresh())
+    assert index.last_error is None
+    assert index.snapshot.generation == second
@@ -0,0 +1,101 @@
+import asyncio
+import uuid
+
+import pytest
+
+from app.build_forest_from_paths import (
+    build_children_index, build_forest_from_abs_paths, build_node_prefix_index, tree_node_id
+)
+from app.dataset_tree_cache import AmbiguousTreeNodeError, DatasetTreeCache
+
+DS_AX1 = uuid.UUID("00000000-0000-0000-0000-000000000001")
+DS_AX2 = uuid.UUID("00000000-0000-0000-0000-000000000002")
+DS_BX1 = uuid.UUID("00000000-0000-0000-0000-000000000003")
+
+# 两个顶层目录下都有同名子目录 x
+RECORDS = [
+    (DS_AX1, "/A/x/ds1"),
+    (DS_AX2, "/A/x/ds2"),
+    (DS_BX1, "/B/x/ds1"),
+]
+
+
+def find_node(forest, *names):
+    nodes = forest
+    node = None
+    for name in names:
+        node = next(n for n in nodes if n["name"] == name)
+        nodes = node["children"]
+    return node
+
+
+def make_cache(records):
+    cache = DatasetTreeCache()
+    cache.node_prefixes = build_node_prefix_index(records)
+
+    async def refresh(db):
+        return cache.etag
+
+    cache.refresh = refresh
+    return cache
+
+
+def test_same_subfolder_name_under_different_tops_gets_distinct_ids():
+    forest = build_forest_from_abs_paths(RECORDS)
+    a_x = find_node(forest, "A", "x")
+    b_x = find_node(forest, "B", "x")
+
+    assert a_x["id"] != b_x["id"]
+    assert a_x["id"] == tree_node_id(["A", "x"])
+    assert b_x["id"] == tree_node_id(["B", "x"])
+
+
+def test_children_index_expands_the_selected_folder_only():
+    forest = build_forest_from_abs_paths(RECORDS)
+    _, index = build_children_index(forest)
+
+    a_children = index[find_node(forest, "A", "x")["id"]]
+    b_children = index[find_node(forest, "B", "x")["id"]]
+    assert sorted(c["id"] for c in a_children) == sorted([str(DS_AX1), str(DS_AX2)])
+    assert [c["id"] for c in b_children] == [str(DS_BX1)]
+
+
+def test_children_index_rejects_duplicate_ids():
+    node = {"id": "dup", "name": "x", "children": []}
+    forest = [{"id": "root", "name": "A", "children": [node, dict(node)]}]
+    with pytest.raises(ValueError):
+        build_children_index(forest)
+
+
+def test_prefix_index_maps_each_folder_to_one_prefix():
+    index = build_node_prefix_index(RECORDS)
+
+    assert index[tree_node_id(["A", "x"])] == {"/A/x"}
+    assert index[tree_node_id(["B", "x"])] == {"/B/x"}
+    assert index[tree_node_id(["A"])] == {"/A"}
+    assert index[str(DS_BX1)] == {"/B/x/ds1"}
+
+
+def test_prefix_index_ids_match_forest_ids():
+    forest = build_forest_from_abs_paths(RECORDS)
+    index = build_node_prefix_index(RECORDS)
+    _, children_index = build_children_index(forest)
+
+    assert set(children_index) <= set(index)
+
+
+def test_resolve_selection_returns_only_the_selected_folder():
+    cache = make_cache(RECORDS)
+    b_x = tree_node_id(["B", "x"])
+    unknown = uuid.UUID("00000000-0000-0000-0000-0000000000ff")
+
+    dataset_ids, prefixes = asyncio.run(cache.resolve_selection(None, [uuid.UUID(b_x), unknown]))
+    assert prefixes == ["/B/x"]
+    assert dataset_ids == [unknown]
+
+
+def test_resolve_selection_refuses_ambiguous_node():
+    # 同一顶层目录的 dir_path 写法不一致时，顶层节点对应两个前缀
+    cache = make_cache([(DS_AX1, "/A/x/ds1"), (DS_BX1, "A/y/ds1")])
+    with pytest.raises(AmbiguousTreeNodeError):
+        asyncio.run(cache.resolve_selection(None, [tree_node_id(["A"])]))
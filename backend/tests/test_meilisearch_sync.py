@@ -0,0 +1,49 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+# meilisearch_sync 作为脚本运行，用顶层模块名导入 models / config
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+import meilisearch_sync  # noqa: E402
+
+
+class FailingIndex:
+    def __init__(self, fail_after):
+        self.fail_after = fail_after
+        self.batches = []
+
+    def update_documents(self, docs):
+        if len(self.batches) >= self.fail_after:
+            raise ConnectionError("meilisearch is down")
+        self.batches.append(docs)
+
+
+def fake_stream(num_batches):
+    async def stream_changed_docs(session, since, queue):
+        for i in range(num_batches):
+            await queue.put([{"id": str(i)}])
+        return num_batches
+    return stream_changed_docs
+
+
+def test_upload_failure_is_raised_instead_of_hanging(monkeypatch):
+    index = FailingIndex(fail_after=1)
+    monkeypatch.setattr(meilisearch_sync, "index", index)
+    # 批次数远大于队列容量：上传协程全部失败后读取协程会阻塞在 queue.put 上
+    monkeypatch.setattr(meilisearch_sync, "stream_changed_docs", fake_stream(100))
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(asyncio.wait_for(meilisearch_sync.upload_changed_docs(None, None), timeout=5))
+
+
+def test_all_batches_uploaded(monkeypatch):
+    index = FailingIndex(fail_after=10 ** 6)
+    monkeypatch.setattr(meilisearch_sync, "index", index)
+    monkeypatch.setattr(meilisearch_sync, "stream_changed_docs", fake_stream(50))
+
+    total = asyncio.run(meilisearch_sync.upload_changed_docs(None, None))
+    assert total == 50
+    assert sorted(int(b[0]["id"]) for b in index.batches) == list(range(50))
@@ -0,0 +1,30 @@
+import asyncio
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+from app.main import analyze_joint_json, analyze_json, parse_node_ids
+
+
+def test_parse_node_ids():
+    a, b = uuid.uuid4(), uuid.uuid4()
+    assert parse_node_ids(f"{a},{b},") == [a, b]
+
+
+def test_parse_node_ids_rejects_malformed_ids():
+    with pytest.raises(HTTPException) as exc:
+        parse_node_ids("not-a-uuid")
+    assert exc.value.status_code == 400
+
+
+@pytest.mark.parametrize("endpoint, kwargs", [
+    (analyze_json, {"fields": "ratio", "approximate": False, "sample_percent": 1.0, "use_summary": True}),
+    (analyze_joint_json, {"x": "width", "y": "height", "x_buckets": 10, "y_buckets": 10,
+                          "approximate": False, "sample_percent": 1.0}),
+])
+def test_malformed_ids_return_400(endpoint, kwargs):
+    # db 为 None：id 在查询数据库之前就被拒绝，不会变成 500
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(endpoint(ids="not-a-uuid", db=None, **kwargs))
+    assert exc.value.status_code == 400
@@ -0,0 +1,113 @@
+import asyncio
+from uuid import UUID
+
+import pytest
+
+from app.search_outbox import SearchOutboxWorker, merge_outbox_rows
+
+DOC_A = UUID("00000000-0000-0000-0000-00000000000a")
+DOC_B = UUID("00000000-0000-0000-0000-00000000000b")
+
+
+class FakeIndex:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+
+    def update_documents(self, docs):
+        if self.fail:
+            raise ConnectionError("meilisearch is down")
+        self.batches.append(docs)
+
+
+class FakeResult:
+    def __init__(self, value):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+    def all(self):
+        return self.value
+
+
+class FakeDatabase:
+    """search_outbox 表和 advisory lock 的最小替身：lock_held 为 True 表示另一个进程正在推送"""
+
+    def __init__(self, rows, lock_held=False):
+        self.rows = list(rows)
+        self.lock_held = lock_held
+        self.commits = 0
+
+    def session(self):
+        return FakeSession(self)
+
+
+class FakeSession:
+    def __init__(self, database):
+        self.database = database
+        self.pending_delete = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt):
+        sql = str(stmt)
+        if "pg_try_advisory_xact_lock" in sql:
+            return FakeResult(not self.database.lock_held)
+        if sql.startswith("DELETE"):
+            self.pending_delete = {value for value in stmt.compile().params.values()
+                                   for value in (value if isinstance(value, list) else [value])}
+            return FakeResult(None)
+        return FakeResult(list(self.database.rows))
+
+    async def commit(self):
+        if self.pending_delete is not None:
+            self.database.rows = [row for row in self.database.rows if row[0] not in self.pending_delete]
+        self.database.commits += 1
+
+
+def test_merge_keeps_latest_update_per_document():
+    rows = [
+        (1, DOC_A, {"is_deleted": True, "deleted_by": "alice"}),
+        (2, DOC_B, {"is_deleted": True}),
+        (3, DOC_A, {"is_deleted": False}),
+    ]
+    assert merge_outbox_rows(rows) == [
+        {"id": str(DOC_A), "is_deleted": False, "deleted_by": "alice"},
+        {"id": str(DOC_B), "is_deleted": True},
+    ]
+
+
+def test_drain_pushes_merged_batch_and_deletes_rows():
+    database = FakeDatabase([(1, DOC_A, {"is_deleted": True}), (2, DOC_A, {"is_deleted": False})])
+    index = FakeIndex()
+    worker = SearchOutboxWorker(database.session, index)
+
+    assert asyncio.run(worker.drain_once()) == 2
+    assert index.batches == [[{"id": str(DOC_A), "is_deleted": False}]]
+    assert database.rows == []
+    assert database.commits == 1
+
+
+def test_drain_skips_while_another_process_holds_the_lock():
+    database = FakeDatabase([(1, DOC_A, {"is_deleted": True})], lock_held=True)
+    index = FakeIndex()
+    worker = SearchOutboxWorker(database.session, index)
+
+    assert asyncio.run(worker.drain_once()) == 0
+    assert index.batches == []
+    assert len(database.rows) == 1
+
+
+def test_failed_push_keeps_rows_for_retry():
+    database = FakeDatabase([(1, DOC_A, {"is_deleted": True})])
+    worker = SearchOutboxWorker(database.session, FakeIndex(fail=True))
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(worker.drain_once())
+    assert len(database.rows) == 1
+    assert database.commits == 0
@@ -25,14 +25,13 @@ CREATE TABLE images (
   file_format TEXT,                                 -- 文件格式
   last_modified TIMESTAMPTZ,                        -- 文件最后修改时间
   created_at TIMESTAMPTZ DEFAULT now(),             -- 记录创建时间
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),    -- 最后修改时间（触发器维护，增量同步用）
   width INTEGER,                                    -- 宽度
   height INTEGER,                                   -- 高度
-  semantic_center REAL[],                           -- 语义中心点 [x,y]
   aesthetic_eat REAL,                               -- 审美指标
   watermark_prob REAL,                              -- 水印概率
   quality_score REAL,                               -- 质量评分
   aesthetic_score REAL,                             -- 审美评分
-  image_embedding REAL[],                           -- 图片嵌入
 
   -- 回收站相关字段
   is_deleted BOOLEAN DEFAULT FALSE,                 -- 是否删除
@@ -42,6 +41,20 @@ CREATE TABLE images (
   UNIQUE (dataset_id, file_path)
 );
 
+--------------------------------------------------------------------------------
+-- 图片特征表：只有相似度功能才用到的大字段，从 images 拆出来，
+-- 列表/统计扫描 images 时不再读取 TOAST、行也更小
+-- embedding 为小端 float16 的紧凑字节串（2 * 维度 字节），确定模型维度后可加约束：
+--   ALTER TABLE image_features ADD CONSTRAINT ck_image_features_embedding_dim
+--     CHECK (octet_length(embedding) = 2 * 768);
+-- 已有数据库迁移见 utils/MigrateImageFeatures.py
+CREATE TABLE image_features (
+  image_id UUID PRIMARY KEY REFERENCES images(id) ON DELETE CASCADE,
+  embedding BYTEA,                                  -- 图片嵌入（float16）
+  semantic_center REAL[],                           -- 语义中心点 [x,y]
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()     -- 最后修改时间（触发器维护，增量同步用）
+);
+
 --------------------------------------------------------------------------------
 -- 图片描述表
 CREATE TABLE image_captions (
@@ -81,9 +94,133 @@ CREATE TABLE recycle_bin_log (
   reason TEXT
 );
 
+--------------------------------------------------------------------------------
+-- 数据集统计表（导入后由 refresh_dataset_stats 按数据集重算，回收站操作增量调整）
+CREATE TABLE dataset_stats (
+  dataset_id UUID PRIMARY KEY REFERENCES datasets(id) ON DELETE CASCADE,
+  image_count BIGINT NOT NULL DEFAULT 0,            -- 未删除图片数
+  deleted_count BIGINT NOT NULL DEFAULT 0,          -- 回收站图片数
+  total_bytes BIGINT NOT NULL DEFAULT 0,            -- 未删除图片 file_size 之和
+  quality_count BIGINT NOT NULL DEFAULT 0,          -- 非空 quality_score 个数（含回收站）
+  quality_min REAL,
+  quality_avg DOUBLE PRECISION,
+  quality_max REAL,
+  aesthetic_count BIGINT NOT NULL DEFAULT 0,        -- 非空 aesthetic_score 个数（含回收站）
+  aesthetic_min REAL,
+  aesthetic_avg DOUBLE PRECISION,
+  aesthetic_max REAL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+--------------------------------------------------------------------------------
+-- 直方图指标定义：每个指标按细粒度等宽分桶（width_bucket 语义，0 为下溢，num_buckets+1 为上溢），
+-- 看板上更粗的分桶由细桶合并得到
+CREATE TABLE histogram_metrics (
+  metric TEXT PRIMARY KEY,
+  min_val DOUBLE PRECISION NOT NULL,
+  max_val DOUBLE PRECISION NOT NULL,
+  num_buckets INTEGER NOT NULL CHECK (num_buckets > 0)
+);
+INSERT INTO histogram_metrics (metric, min_val, max_val, num_buckets) VALUES
+  ('ratio', 0, 3, 300),
+  ('size', 0, 3000, 300),
+  ('quality_score', 0, 100, 200),
+  ('aesthetic_score', 0, 10, 200),
+  ('aesthetic_eat', 0, 10, 200);
+
+--------------------------------------------------------------------------------
+-- 每个数据集的细粒度直方图（只统计未删除图片），
+-- 导入后由 refresh_dataset_histograms 重算，回收站操作由 apply_dataset_histogram_delta 增量调整
+CREATE TABLE dataset_histograms (
+  dataset_id UUID NOT NULL REFERENCES datasets(id) ON DELETE CASCADE,
+  metric TEXT NOT NULL REFERENCES histogram_metrics(metric) ON DELETE CASCADE,
+  bucket INTEGER NOT NULL,
+  count BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (dataset_id, metric, bucket)
+);
+
+--------------------------------------------------------------------------------
+-- Meilisearch 更新发件箱（与业务修改同事务写入，后台 worker 合并后批量推送）
+CREATE TABLE search_outbox (
+  id BIGSERIAL PRIMARY KEY,
+  doc_id UUID NOT NULL,                             -- Meilisearch 文档 id（图片 id）
+  payload JSONB NOT NULL,                           -- 要更新的字段
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+--------------------------------------------------------------------------------
+-- 图片硬删除墓碑（触发器写入，增量同步据此删除 Meilisearch 文档）
+CREATE TABLE image_tombstones (
+  image_id UUID PRIMARY KEY,
+  deleted_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+--------------------------------------------------------------------------------
+-- 增量同步水位
+CREATE TABLE sync_state (
+  name TEXT PRIMARY KEY,                            -- 同步任务名
+  watermark TIMESTAMPTZ,                            -- 上次成功同步的时间点
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+--------------------------------------------------------------------------------
+-- 近重复图片扫描（utils/FindNearDuplicates.py）
+-- 一次扫描 = 一个 run：向量先导出到本地文件，再按行块两两计算余弦相似度，
+-- 每完成一个行块就在同一事务里写入该块的边并推进 next_block，中断后从 next_block 继续
+CREATE TABLE duplicate_scan_runs (
+  id SERIAL PRIMARY KEY,
+  threshold REAL NOT NULL,                          -- 余弦相似度阈值
+  block_rows INTEGER NOT NULL,                      -- 每个行块的向量数
+  num_rows BIGINT,                                  -- 参与比较的向量数（导出完成后写入）
+  next_block INTEGER NOT NULL DEFAULT 0,            -- 下一个待处理的行块
+  status TEXT NOT NULL DEFAULT 'exporting' CHECK (status IN ('exporting', 'comparing', 'done')),
+  started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  finished_at TIMESTAMPTZ
+);
+
+-- 相似度超过阈值的图片对；只保存把两个不同簇连起来的边（生成森林），总数不超过向量数
+CREATE TABLE duplicate_pairs (
+  run_id INTEGER NOT NULL REFERENCES duplicate_scan_runs(id) ON DELETE CASCADE,
+  image_a UUID NOT NULL,
+  image_b UUID NOT NULL,
+  similarity REAL NOT NULL,
+  PRIMARY KEY (run_id, image_a, image_b)
+);
+
+-- 扫描完成后的重复簇：cluster_id 为簇内最小的图片 id
+CREATE TABLE duplicate_clusters (
+  run_id INTEGER NOT NULL REFERENCES duplicate_scan_runs(id) ON DELETE CASCADE,
+  image_id UUID NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+  dataset_id UUID NOT NULL,
+  cluster_id UUID NOT NULL,
+  PRIMARY KEY (run_id, image_id)
+);
+
+--------------------------------------------------------------------------------
+-- 导入清单（utils/ImportParquetDataset.py、utils/ImportJsonDataset.py）：每个 ImageInfo 文件一行
+-- 大小和 mtime 与上次一致且 status = done 时直接跳过；大小或 mtime 变了再比较内容哈希。
+-- parquet 分批导入时每批提交一次并推进 rows_done，中断后从 rows_done 继续
+CREATE TABLE import_manifest (
+  file_path TEXT PRIMARY KEY,                       -- 相对路径（与 datasets.dir_path 同一基准）
+  dataset_id UUID REFERENCES datasets(id) ON DELETE CASCADE,
+  file_size BIGINT NOT NULL,
+  file_mtime TIMESTAMPTZ NOT NULL,
+  content_hash BYTEA NOT NULL,                      -- 文件 SHA256
+  tables TEXT[] NOT NULL,                           -- 导入的目标表，mapping 变化后重新导入
+  total_rows BIGINT,                                -- 文件行数
+  rows_done BIGINT NOT NULL DEFAULT 0,              -- 已提交的行数（断点）
+  status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'done')),
+  started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  finished_at TIMESTAMPTZ
+);
+
 --------------------------------------------------------------------------------
 -- 索引优化
 CREATE INDEX idx_images_dataset_id ON images(dataset_id);
+-- 目录前缀匹配（按树节点展开数据集）：dir_path 在 C 排序规则下的范围扫描
+CREATE INDEX idx_datasets_dir_path_c ON datasets (dir_path COLLATE "C");
+-- keyset 分页：按 (dataset_id, file_path, id) 范围扫描
+CREATE INDEX idx_images_dataset_file_path_id ON images(dataset_id, file_path, id);
 CREATE INDEX idx_images_file_hash ON images(file_hash);
 CREATE INDEX idx_image_captions_caption_trgm ON image_captions USING gin (caption gin_trgm_ops);
 CREATE INDEX idx_image_tags_tags_gin ON image_tags USING gin (tags);
@@ -92,28 +229,169 @@ CREATE INDEX idx_images_aesthetic_score ON images(aesthetic_score);
 CREATE INDEX idx_images_width ON images(width);
 CREATE INDEX idx_images_height ON images(height);
 CREATE INDEX idx_recycle_bin_log_image_id ON recycle_bin_log(image_id);
+CREATE INDEX idx_recycle_bin_log_action_at_id ON recycle_bin_log(action_at, id);
+-- 回收站浏览只扫描已删除的行
+CREATE INDEX idx_images_recycle_bin ON images(id) WHERE is_deleted = true;
+CREATE INDEX idx_images_updated_at ON images(updated_at);
+CREATE INDEX idx_image_features_updated_at ON image_features(updated_at);
+CREATE INDEX idx_image_tombstones_deleted_at ON image_tombstones(deleted_at);
+-- 按数据集列出重复簇 / 取簇成员
+CREATE INDEX idx_duplicate_clusters_dataset ON duplicate_clusters(run_id, dataset_id, cluster_id);
+CREATE INDEX idx_duplicate_clusters_cluster ON duplicate_clusters(run_id, cluster_id);
+
+--------------------------------------------------------------------------------
+-- 回收站日志由后端在删除/恢复时批量写入（带 reason），不再使用逐行触发器。
+-- 已有数据库需删除旧触发器，避免重复写日志：
+--   DROP TRIGGER IF EXISTS trg_images_recycle_log ON images;
+--   DROP FUNCTION IF EXISTS log_recycle_bin_action();
+
 
 --------------------------------------------------------------------------------
--- 触发器函数：自动写入回收站日志
-CREATE OR REPLACE FUNCTION log_recycle_bin_action()
+-- images.updated_at：只有行内容真正变化时才更新（重复导入相同数据不会触发重新同步）
+CREATE OR REPLACE FUNCTION set_images_updated_at()
 RETURNS TRIGGER AS $$
 BEGIN
-  IF NEW.is_deleted IS DISTINCT FROM OLD.is_deleted THEN
-    IF NEW.is_deleted = TRUE THEN
-      INSERT INTO recycle_bin_log(image_id, action, action_by, reason)
-      VALUES (NEW.id, 'DELETE', NEW.deleted_by, '用户删除');
-    ELSE
-      INSERT INTO recycle_bin_log(image_id, action, action_by)
-      VALUES (NEW.id, 'RESTORE', NEW.deleted_by);
-    END IF;
-  END IF;
+  NEW.updated_at := now();
   RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
 
---------------------------------------------------------------------------------
--- 触发器绑定到 images 表
-CREATE TRIGGER trg_images_recycle_log
-AFTER UPDATE OF is_deleted ON images
+CREATE TRIGGER trg_images_updated_at
+BEFORE UPDATE ON images
+FOR EACH ROW
+WHEN (OLD.* IS DISTINCT FROM NEW.*)
+EXECUTE FUNCTION set_images_updated_at();
+
+CREATE TRIGGER trg_image_features_updated_at
+BEFORE UPDATE ON image_features
 FOR EACH ROW
-EXECUTE FUNCTION log_recycle_bin_action();
+WHEN (OLD.* IS DISTINCT FROM NEW.*)
+EXECUTE FUNCTION set_images_updated_at();
+
+-- 图片硬删除时写入墓碑
+CREATE OR REPLACE FUNCTION record_image_tombstone()
+RETURNS TRIGGER AS $$
+BEGIN
+  INSERT INTO image_tombstones (image_id, deleted_at)
+  VALUES (OLD.id, now())
+  ON CONFLICT (image_id) DO UPDATE SET deleted_at = EXCLUDED.deleted_at;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_images_tombstone
+AFTER DELETE ON images
+FOR EACH ROW
+EXECUTE FUNCTION record_image_tombstone();
+
+--------------------------------------------------------------------------------
+-- 目录版本号（单行表）：数据集增删改、导入、回收站操作都会递增，
+-- 后端据此判断进程内缓存（如数据集树）是否过期
+CREATE TABLE catalog_version (
+  id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+  version BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+INSERT INTO catalog_version DEFAULT VALUES;
+
+CREATE OR REPLACE FUNCTION bump_catalog_version()
+RETURNS BIGINT AS $$
+  UPDATE catalog_version SET version = version + 1, updated_at = now()
+  RETURNING version;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION bump_catalog_version_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+  PERFORM bump_catalog_version();
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 数据集表任意变更（语句级）都递增版本号
+CREATE TRIGGER trg_datasets_catalog_version
+AFTER INSERT OR UPDATE OR DELETE ON datasets
+FOR EACH STATEMENT
+EXECUTE FUNCTION bump_catalog_version_trigger();
+
+--------------------------------------------------------------------------------
+-- 单张图片落在各直方图指标的哪个细桶（指标取值的定义只在这里维护）
+CREATE OR REPLACE FUNCTION image_histogram_buckets(i images)
+RETURNS TABLE (metric TEXT, bucket INTEGER) AS $$
+  SELECT m.metric, width_bucket(v.value, m.min_val, m.max_val, m.num_buckets)
+  FROM (VALUES
+    ('ratio', CASE WHEN i.height <> 0 THEN i.width::float8 / i.height END),
+    ('size', sqrt(i.width::float8 * i.height)),
+    ('quality_score', i.quality_score::float8),
+    ('aesthetic_score', i.aesthetic_score::float8),
+    ('aesthetic_eat', i.aesthetic_eat::float8)
+  ) AS v(metric, value)
+  JOIN histogram_metrics m ON m.metric = v.metric
+  WHERE v.value IS NOT NULL;
+$$ LANGUAGE sql STABLE;
+
+-- 按数据集重算 dataset_histograms（由 refresh_dataset_stats 调用）
+CREATE OR REPLACE FUNCTION refresh_dataset_histograms(ds_ids UUID[])
+RETURNS VOID AS $$
+  DELETE FROM dataset_histograms WHERE dataset_id = ANY(ds_ids);
+
+  INSERT INTO dataset_histograms (dataset_id, metric, bucket, count)
+  SELECT i.dataset_id, b.metric, b.bucket, count(*)
+  FROM images i
+  CROSS JOIN LATERAL image_histogram_buckets(i) b
+  WHERE i.dataset_id = ANY(ds_ids) AND i.is_deleted IS NOT TRUE
+  GROUP BY i.dataset_id, b.metric, b.bucket;
+$$ LANGUAGE sql;
+
+-- 图片移入（delta = -1）或移出（delta = 1）回收站后增量调整 dataset_histograms
+CREATE OR REPLACE FUNCTION apply_dataset_histogram_delta(image_ids UUID[], delta INTEGER)
+RETURNS VOID AS $$
+  INSERT INTO dataset_histograms AS h (dataset_id, metric, bucket, count)
+  SELECT i.dataset_id, b.metric, b.bucket, delta * count(*)
+  FROM images i
+  CROSS JOIN LATERAL image_histogram_buckets(i) b
+  WHERE i.id = ANY(image_ids)
+  GROUP BY i.dataset_id, b.metric, b.bucket
+  ON CONFLICT (dataset_id, metric, bucket) DO UPDATE SET count = h.count + EXCLUDED.count;
+$$ LANGUAGE sql;
+
+--------------------------------------------------------------------------------
+-- 按数据集重算 dataset_stats 和 dataset_histograms（导入器在每个数据集写完后调用）
+-- 已有数据库初始化：SELECT refresh_dataset_stats(ARRAY(SELECT id FROM datasets));
+CREATE OR REPLACE FUNCTION refresh_dataset_stats(ds_ids UUID[])
+RETURNS VOID AS $$
+  INSERT INTO dataset_stats (
+    dataset_id, image_count, deleted_count, total_bytes,
+    quality_count, quality_min, quality_avg, quality_max,
+    aesthetic_count, aesthetic_min, aesthetic_avg, aesthetic_max,
+    updated_at
+  )
+  SELECT
+    d.id,
+    count(i.id) FILTER (WHERE i.is_deleted IS NOT TRUE),
+    count(i.id) FILTER (WHERE i.is_deleted IS TRUE),
+    coalesce(sum(i.file_size) FILTER (WHERE i.is_deleted IS NOT TRUE), 0),
+    count(i.quality_score), min(i.quality_score), avg(i.quality_score), max(i.quality_score),
+    count(i.aesthetic_score), min(i.aesthetic_score), avg(i.aesthetic_score), max(i.aesthetic_score),
+    now()
+  FROM datasets d
+  LEFT JOIN images i ON i.dataset_id = d.id
+  WHERE d.id = ANY(ds_ids)
+  GROUP BY d.id
+  ON CONFLICT (dataset_id) DO UPDATE SET
+    image_count = EXCLUDED.image_count,
+    deleted_count = EXCLUDED.deleted_count,
+    total_bytes = EXCLUDED.total_bytes,
+    quality_count = EXCLUDED.quality_count,
+    quality_min = EXCLUDED.quality_min,
+    quality_avg = EXCLUDED.quality_avg,
+    quality_max = EXCLUDED.quality_max,
+    aesthetic_count = EXCLUDED.aesthetic_count,
+    aesthetic_min = EXCLUDED.aesthetic_min,
+    aesthetic_avg = EXCLUDED.aesthetic_avg,
+    aesthetic_max = EXCLUDED.aesthetic_max,
+    updated_at = EXCLUDED.updated_at;
+
+  SELECT refresh_dataset_histograms(ds_ids);
+  SELECT bump_catalog_version();
+$$ LANGUAGE sql;
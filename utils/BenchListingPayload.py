@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+列表接口单页数据量对比：整行实体（select(Image, Dataset)）vs 列投影
+- bytes: 服务端 pg_column_size 统计的每页行数据大小（近似网络传输量）
+- alloc: 客户端取回一页时 tracemalloc 记录的内存分配峰值
+用法：python BenchListingPayload.py [page_size] [pages]
+尚未在有数据的数据库上运行过，没有测量结果。列表接口改为列投影的依据只是不再读取
+image_embedding / semantic_center 等大字段，节省多少需要用本脚本实测后再下结论。
+"""
+
+import sys
+import tracemalloc
+import psycopg2
+
+DB_CONFIG = {
+    'dbname': 'image_dataset_db4',
+    'user': 'postgres',
+    'password': 'example',
+    'host': 'localhost',
+    'port': 5432
+}
+
+# 改动前：ORM 读出 Image + Dataset 的全部列（含 image_embedding / semantic_center）
+BEFORE_SQL = """
+SELECT images.*, datasets.*
+FROM images JOIN datasets ON images.dataset_id = datasets.id
+ORDER BY datasets.dir_path, images.file_path, images.id
+LIMIT %s OFFSET %s
+"""
+
+# 改动后：只投影列表接口需要的列（见 crud._page_columns）
+AFTER_SQL = """
+SELECT images.id, images.file_path, images.width, images.height,
+       images.quality_score, images.aesthetic_score,
+       images.is_deleted, images.deleted_at, images.deleted_by,
+       datasets.dir_path
+FROM images JOIN datasets ON images.dataset_id = datasets.id
+ORDER BY datasets.dir_path, images.file_path, images.id
+LIMIT %s OFFSET %s
+"""
+
+
+def measure(cur, sql, page_size, page):
+    params = (page_size, page * page_size)
+    cur.execute(f"SELECT coalesce(sum(pg_column_size(q.*)), 0) FROM ({sql}) q", params)
+    row_bytes = cur.fetchone()[0]
+
+    tracemalloc.start()
+    cur.execute(sql, params)
+    cur.fetchall()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return row_bytes, peak
+
+
+def main(page_size=100, pages=5):
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            print(f"{'page':>4} {'before bytes':>14} {'after bytes':>12} {'before alloc':>14} {'after alloc':>12}")
+            for page in range(pages):
+                b_bytes, b_alloc = measure(cur, BEFORE_SQL, page_size, page)
+                a_bytes, a_alloc = measure(cur, AFTER_SQL, page_size, page)
+                print(f"{page:>4} {b_bytes:>14} {a_bytes:>12} {b_alloc:>14} {a_alloc:>12}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ParquetSyncer 写入吞吐对比：load_mode='values'（execute_values）vs 'copy'（COPY 临时表 + INSERT ... SELECT）
+- 每种模式在单独的事务里把同一份数据写入一个新建的测试数据集，计时后 ROLLBACK，不留下数据
+- insert: 第一次写入（全部是新行）；upsert: 同一事务里再写一遍（全部走 ON CONFLICT 更新）
+- 不给 parquet 文件时生成合成数据（images + image_features，embedding 维度由 --dim 指定）
+用法：python BenchParquetLoad.py [ImageInfo.parquet] [--rows 200000] [--dim 768]
+尚未在真实数据库上运行过，没有测量结果，不能据此认为 copy 模式更快；默认仍为 values。
+"""
+
+import argparse
+import time
+import uuid
+
+import numpy as np
+import polars as pl
+
+from ImportParquetDataset import DB_CONFIG, ParquetSyncer, features_mapping, images_mapping
+
+MAPPINGS = [images_mapping, features_mapping]
+
+
+def synthetic_frame(rows, dim):
+    rng = np.random.default_rng(0)
+    return pl.DataFrame({
+        "IMG": [f"bench/{i:08d}.jpg" for i in range(rows)],
+        "W": rng.integers(256, 4096, rows),
+        "H": rng.integers(256, 4096, rows),
+        "A_EAT": rng.random(rows, dtype=np.float32) * 10,
+        "HAS_WATERMARK": rng.random(rows, dtype=np.float32),
+        "Q512": rng.random(rows, dtype=np.float32) * 100,
+        "A": rng.random(rows, dtype=np.float32) * 10,
+        "A_CENTER": pl.Series(rng.random((rows, 2), dtype=np.float32)).cast(pl.List(pl.Float32)),
+        "IMG_EMBD": pl.Series(rng.standard_normal((rows, dim), dtype=np.float32)).cast(pl.List(pl.Float32)),
+    })
+
+
+def bench_mode(df, mode):
+    syncer = ParquetSyncer(DB_CONFIG, root_dataset_dir=".", load_mode=mode)
+    syncer.connect_db()
+    timings = {}
+    try:
+        with syncer.conn.cursor() as cur:
+            cur.execute("INSERT INTO datasets (name, dir_path) VALUES ('bench', %s) RETURNING id",
+                        (f"__bench__/{uuid.uuid4()}",))
+            dataset_id = cur.fetchone()[0]
+            frame = syncer.generate_or_fetch_image_id(cur, df, dataset_id)
+            context = {"dataset_id": dataset_id}
+            for label in ("insert", "upsert"):
+                t0 = time.perf_counter()
+                for mapping in MAPPINGS:
+                    syncer.write_mapping(cur, frame, mapping, context)
+                timings[label] = time.perf_counter() - t0
+    finally:
+        syncer.conn.rollback()
+        syncer.close_db()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ParquetSyncer load modes")
+    parser.add_argument("parquet", nargs="?", help="用真实的 ImageInfo.parquet 测试（只取前 --rows 行）")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--dim", type=int, default=768)
+    args = parser.parse_args()
+
+    if args.parquet:
+        df = pl.read_parquet(args.parquet, n_rows=args.rows)
+    else:
+        df = synthetic_frame(args.rows, args.dim)
+
+    print(f"{'mode':>8} {'insert s':>10} {'insert rows/s':>14} {'upsert s':>10} {'upsert rows/s':>14}")
+    for mode in ("values", "copy"):
+        t = bench_mode(df, mode)
+        print(f"{mode:>8} {t['insert']:>10.2f} {df.height / t['insert']:>14.0f} "
+              f"{t['upsert']:>10.2f} {df.height / t['upsert']:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
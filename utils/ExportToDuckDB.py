@@ -29,7 +29,7 @@ SELECT
     i.file_format,
     i.width,
     i.height,
-    i.semantic_center,
+    f.semantic_center,
     i.aesthetic_eat,
     i.watermark_prob,
     i.quality_score,
@@ -39,6 +39,7 @@ SELECT
     t.tags
 FROM images i
 JOIN datasets d ON i.dataset_id = d.id
+LEFT JOIN image_features f ON i.id = f.image_id
 LEFT JOIN image_captions c ON i.id = c.image_id
 LEFT JOIN image_tags t ON i.id = t.image_id
 WHERE d.name = ANY(%s)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+基于 image_embedding 的近重复图片聚类（批处理任务）
+
+流程（一次扫描对应 duplicate_scan_runs 中的一行）：
+  1. 导出：服务端游标分块读取未删除图片的 embedding，归一化后以 float16 写入本地内存映射文件
+  2. 比较：向量按 block_rows 切成行块，行块 i 与所有 j >= i 的行块做分块矩阵乘法求余弦相似度，
+     多个 (i, j) 块在线程池里并行计算（NumPy 矩阵乘法期间释放 GIL）。
+     超过阈值的图片对用并查集合并，只把连接了两个不同簇的边写入 duplicate_pairs，
+     并在同一事务里推进 next_block —— 中断后用 --resume 从下一个行块继续
+  3. 写簇：把大小 >= 2 的连通分量写入 duplicate_clusters，删除更早的已完成扫描
+
+内存占用与总向量数无关：同时驻留的只有 workers 个相似度块（block_rows^2 个 float32）
+和并查集（每个向量 8 字节）。计算量是 O(n^2)，几千万向量需要较长时间，但可以随时中断、续跑。
+
+用法：
+  python FindNearDuplicates.py [--threshold 0.95] [--block-rows 4096] [--workers 8] [--work-dir ./dup_work]
+  python FindNearDuplicates.py --resume            # 继续最近一次未完成的扫描
+"""
+
+import argparse
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+from tqdm import tqdm
+
+DB_CONFIG = {
+    'dbname': 'image_dataset_db4',
+    'user': 'postgres',
+    'password': 'example',
+    'host': 'localhost',
+    'port': 5432
+}
+
+EXPORT_CHUNK_ROWS = 10000   # 导出时服务端游标每次取的行数
+
+EXPORT_SQL = """
+SELECT i.id, i.dataset_id, f.embedding
+FROM images i
+JOIN image_features f ON f.image_id = i.id
+WHERE i.is_deleted IS NOT TRUE AND f.embedding IS NOT NULL
+ORDER BY i.id
+"""
+
+# image_features.embedding 的存储格式（见 schema2.sql）
+EMBEDDING_DTYPE = np.dtype("<f2")
+
+
+def connect_db():
+    return psycopg2.connect(**DB_CONFIG)
+
+
+# ---------- 并查集 ----------
+
+class UnionFind:
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        """合并成功（原本不在同一簇）时返回 True"""
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return False
+        if ra > rb:
+            ra, rb = rb, ra
+        # 根总是簇内最小的行号，行按 id 排序，因此根对应簇内最小的图片 id
+        self.parent[rb] = ra
+        return True
+
+    def roots(self):
+        """所有元素的根（整体路径压缩）"""
+        parent = self.parent
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                return parent
+            parent[:] = grand
+
+
+# ---------- 本地工作文件 ----------
+
+def run_paths(work_dir, run_id):
+    base = Path(work_dir) / f"run_{run_id}"
+    return {
+        "dir": base,
+        "vectors": base / "vectors.f16",
+        "ids": base / "ids.npy",
+        "datasets": base / "dataset_ids.npy",
+        "meta": base / "meta.json",
+    }
+
+
+def export_vectors(conn, paths):
+    """
+    导出向量到 float16 内存映射文件，返回 (ids, dataset_ids, vectors)。
+    先统计行数再导出；导出期间新增的行留给下一次扫描。
+    """
+    paths["dir"].mkdir(parents=True, exist_ok=True)
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM ({EXPORT_SQL}) q")
+        total = cur.fetchone()[0]
+
+    ids = np.empty(total, dtype="S16")
+    dataset_ids = np.empty(total, dtype="S16")
+    vectors = None
+    n = 0
+    with conn.cursor(name="export_embeddings") as cur:
+        cur.itersize = EXPORT_CHUNK_ROWS
+        cur.execute(EXPORT_SQL)
+        with tqdm(total=total, desc="export") as bar:
+            while n < total:
+                rows = cur.fetchmany(EXPORT_CHUNK_ROWS)[:total - n]
+                if not rows:
+                    break
+                # embedding 为定长 float16 字节串，拼接后一次解码
+                chunk = np.frombuffer(b"".join(bytes(r[2]) for r in rows), dtype=EMBEDDING_DTYPE)
+                chunk = chunk.reshape(len(rows), -1).astype(np.float32)
+                norms = np.linalg.norm(chunk, axis=1, keepdims=True)
+                norms[norms == 0] = 1
+                if vectors is None:
+                    vectors = np.memmap(paths["vectors"], dtype=np.float16, mode="w+",
+                                        shape=(total, chunk.shape[1]))
+                vectors[n:n + len(rows)] = chunk / norms
+                for k, r in enumerate(rows):
+                    ids[n + k] = uuid.UUID(str(r[0])).bytes
+                    dataset_ids[n + k] = uuid.UUID(str(r[1])).bytes
+                n += len(rows)
+                bar.update(len(rows))
+
+    if vectors is None:
+        vectors = np.zeros((0, 0), dtype=np.float16)
+    else:
+        vectors.flush()
+    np.save(paths["ids"], ids[:n])
+    np.save(paths["datasets"], dataset_ids[:n])
+    # 文件按导出前统计的行数分配，记录实际的行数和维度
+    paths["meta"].write_text(json.dumps({"rows": n, "dim": vectors.shape[1], "allocated_rows": len(vectors)}))
+    return ids[:n], dataset_ids[:n], vectors[:n]
+
+
+def load_vectors(paths, num_rows):
+    ids = np.load(paths["ids"])
+    dataset_ids = np.load(paths["datasets"])
+    if len(ids) != num_rows:
+        raise RuntimeError(f"{paths['ids']} has {len(ids)} rows, run expects {num_rows}")
+    if num_rows == 0:
+        return ids, dataset_ids, np.zeros((0, 0), dtype=np.float16)
+    meta = json.loads(paths["meta"].read_text())
+    vectors = np.memmap(paths["vectors"], dtype=np.float16, mode="r",
+                        shape=(meta["allocated_rows"], meta["dim"]))
+    return ids, dataset_ids, vectors[:num_rows]
+
+
+def to_uuid(key):
+    # numpy 的 S 类型会去掉末尾的 \0，还原时补齐
+    return str(uuid.UUID(bytes=bytes(key).ljust(16, b"\0")))
+
+
+# ---------- 比较 ----------
+
+def compare_tile(vectors, block_rows, threshold, i, j):
+    """
+    计算行块 i 与行块 j 的相似度，返回超过阈值的 (行 a, 行 b, 相似度)，a < b。
+    i == j 时只取上三角（不含对角线）。
+    """
+    a0, a1 = i * block_rows, min((i + 1) * block_rows, len(vectors))
+    b0, b1 = j * block_rows, min((j + 1) * block_rows, len(vectors))
+    a = np.asarray(vectors[a0:a1], dtype=np.float32)
+    b = a if i == j else np.asarray(vectors[b0:b1], dtype=np.float32)
+    sim = a @ b.T
+    if i == j:
+        sim = np.triu(sim, k=1)
+    ra, rb = np.nonzero(sim >= threshold)
+    return ra + a0, rb + b0, sim[ra, rb]
+
+
+def compare_block(pool, vectors, block_rows, threshold, i, num_blocks, uf):
+    """行块 i 与所有 j >= i 的行块比较，返回新连通两个簇的边"""
+    edges = []
+    tiles = pool.map(lambda j: compare_tile(vectors, block_rows, threshold, i, j), range(i, num_blocks))
+    for ra, rb, sims in tiles:
+        # 相似度高的边优先，生成森林里保留的是最强的连接
+        for k in np.argsort(-sims, kind="stable"):
+            if uf.union(int(ra[k]), int(rb[k])):
+                edges.append((int(ra[k]), int(rb[k]), float(sims[k])))
+    return edges
+
+
+def restore_union_find(cur, run_id, ids):
+    """续跑时用已写入的边重建并查集"""
+    uf = UnionFind(len(ids))
+    cur.execute("SELECT image_a, image_b FROM duplicate_pairs WHERE run_id = %s", (run_id,))
+    pairs = cur.fetchall()
+    if pairs:
+        keys = np.array([uuid.UUID(str(x)).bytes for pair in pairs for x in pair], dtype="S16")
+        rows = np.searchsorted(ids, keys).reshape(-1, 2)
+        for a, b in rows:
+            uf.union(int(a), int(b))
+    return uf
+
+
+def write_clusters(cur, run_id, ids, dataset_ids, uf):
+    roots = uf.roots()
+    sizes = np.bincount(roots, minlength=len(roots))
+    members = np.flatnonzero(sizes[roots] >= 2)
+    print(f"{len(members)} images in {int((sizes >= 2).sum())} duplicate clusters")
+    for start in range(0, len(members), EXPORT_CHUNK_ROWS):
+        chunk = members[start:start + EXPORT_CHUNK_ROWS]
+        execute_values(cur, """
+            INSERT INTO duplicate_clusters (run_id, image_id, dataset_id, cluster_id)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+        """, [
+            (run_id, to_uuid(ids[r]), to_uuid(dataset_ids[r]), to_uuid(ids[roots[r]]))
+            for r in chunk
+        ], page_size=1000)
+
+
+# ---------- 主流程 ----------
+
+def start_run(conn, threshold, block_rows):
+    with conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO duplicate_scan_runs (threshold, block_rows) VALUES (%s, %s) RETURNING id
+        """, (threshold, block_rows))
+        return cur.fetchone()[0]
+
+
+def find_unfinished_run(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT id, threshold, block_rows, num_rows, next_block, status
+            FROM duplicate_scan_runs WHERE status <> 'done'
+            ORDER BY id DESC LIMIT 1
+        """)
+        return cur.fetchone()
+
+
+def main(threshold=0.95, block_rows=4096, workers=None, work_dir="dup_work", resume=False):
+    workers = workers or os.cpu_count()
+    conn = connect_db()
+    try:
+        run = find_unfinished_run(conn) if resume else None
+        if run is None:
+            if resume:
+                print("No unfinished run, starting a new one")
+            run_id = start_run(conn, threshold, block_rows)
+            status, next_block, num_rows = "exporting", 0, None
+        else:
+            run_id, threshold, block_rows, num_rows, next_block, status = run
+            print(f"Resuming run {run_id} ({status}, next block {next_block}, threshold {threshold})")
+        paths = run_paths(work_dir, run_id)
+
+        if status == "exporting":
+            # 导出不可续：从头重新导出
+            ids, dataset_ids, vectors = export_vectors(conn, paths)
+            num_rows = len(ids)
+            with conn, conn.cursor() as cur:
+                cur.execute("DELETE FROM duplicate_pairs WHERE run_id = %s", (run_id,))
+                cur.execute("""
+                    UPDATE duplicate_scan_runs SET status = 'comparing', num_rows = %s, next_block = 0
+                    WHERE id = %s
+                """, (num_rows, run_id))
+            next_block = 0
+        else:
+            ids, dataset_ids, vectors = load_vectors(paths, num_rows)
+
+        with conn.cursor() as cur:
+            uf = restore_union_find(cur, run_id, ids)
+
+        num_blocks = (num_rows + block_rows - 1) // block_rows
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for i in tqdm(range(next_block, num_blocks), desc="compare", initial=next_block, total=num_blocks):
+                edges = compare_block(pool, vectors, block_rows, threshold, i, num_blocks, uf)
+                # 这个行块的边和进度在同一事务里提交，中断后不会重复或遗漏
+                with conn, conn.cursor() as cur:
+                    if edges:
+                        execute_values(cur, """
+                            INSERT INTO duplicate_pairs (run_id, image_a, image_b, similarity)
+                            VALUES %s
+                            ON CONFLICT DO NOTHING
+                        """, [(run_id, to_uuid(ids[a]), to_uuid(ids[b]), s) for a, b, s in edges],
+                            page_size=1000)
+                    cur.execute("UPDATE duplicate_scan_runs SET next_block = %s WHERE id = %s", (i + 1, run_id))
+        print(f"Compared {num_rows} vectors in {time.time() - t0:.1f}s")
+
+        with conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM duplicate_clusters WHERE run_id = %s", (run_id,))
+            write_clusters(cur, run_id, ids, dataset_ids, uf)
+            cur.execute("""
+                UPDATE duplicate_scan_runs SET status = 'done', finished_at = now() WHERE id = %s
+            """, (run_id,))
+            # 只保留最新一次完成的扫描
+            cur.execute("DELETE FROM duplicate_scan_runs WHERE status = 'done' AND id <> %s", (run_id,))
+        print(f"Run {run_id} done")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cluster near-duplicate images by embedding cosine similarity")
+    parser.add_argument("--threshold", type=float, default=0.95, help="余弦相似度阈值")
+    parser.add_argument("--block-rows", type=int, default=4096, help="每个行块的向量数，决定每个相似度块的内存")
+    parser.add_argument("--workers", type=int, default=None, help="并行计算的线程数，默认 CPU 核数")
+    parser.add_argument("--work-dir", default="dup_work", help="导出向量的本地目录")
+    parser.add_argument("--resume", action="store_true", help="继续最近一次未完成的扫描")
+    args = parser.parse_args()
+    main(args.threshold, args.block_rows, args.workers, args.work_dir, args.resume)
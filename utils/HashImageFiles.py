@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+计算图片文件的 SHA256，填充 images.file_hash / file_size / last_modified
+
+流程：
+  1. 按 id 分页（keyset）读取图片及其数据集目录，每页 batch_size 行
+  2. 线程池里逐个 stat 文件：大小和修改时间都与数据库一致且已有 file_hash 的直接跳过，
+     其余按 read_size 大块顺序读取并计算 SHA256（hashlib 处理大块数据时释放 GIL，
+     NAS 上的读延迟也由多个线程重叠）
+  3. 每页的变化行用一条 UPDATE ... FROM (VALUES ...) 批量写回并提交，中断后重新运行即可，
+     已写回的行会因 size/mtime 未变而被跳过
+  4. 最后对变化的数据集执行 refresh_dataset_stats，更新 total_bytes
+
+文件完整路径 = root_dataset_dir 的父目录 / datasets.dir_path / images.file_path，
+与 ImportParquetDataset 计算 dir_path 的方式一致。
+
+用法：
+  python HashImageFiles.py /mnt/yuansnas/Backup/big_server/ds/DiffusionDataset [--workers 16]
+  python HashImageFiles.py <root> --only-missing      # 只处理 file_hash 为空的行，不 stat 其余文件
+  python HashImageFiles.py <root> --force             # 忽略 size/mtime，全部重新计算
+"""
+
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+DB_CONFIG = {
+    'dbname': 'image_dataset_db4',
+    'user': 'postgres',
+    'password': 'example',
+    'host': 'localhost',
+    'port': 5432
+}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+SELECT_SQL = """
+SELECT i.id, i.dataset_id, d.dir_path, i.file_path, i.file_hash, i.file_size, i.last_modified
+FROM images i
+JOIN datasets d ON d.id = i.dataset_id
+WHERE i.id > %s {where}
+ORDER BY i.id
+LIMIT %s
+"""
+
+UPDATE_SQL = """
+UPDATE images AS i
+SET file_hash = v.file_hash, file_size = v.file_size, last_modified = v.last_modified
+FROM (VALUES %s) AS v(id, file_hash, file_size, last_modified)
+WHERE i.id = v.id
+"""
+UPDATE_TEMPLATE = "(%s::uuid, %s::bytea, %s::bigint, %s::timestamptz)"
+
+
+def file_mtime(st):
+    # 截断到微秒，与 TIMESTAMPTZ 精度一致，避免浮点误差导致每次都判定为已修改
+    return EPOCH + timedelta(microseconds=st.st_mtime_ns // 1000)
+
+
+def sha256_file(path, read_size):
+    h = hashlib.sha256()
+    buf = bytearray(read_size)
+    view = memoryview(buf)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = os.readv(fd, [buf])
+            if n == 0:
+                break
+            h.update(view[:n])
+    finally:
+        os.close(fd)
+    return h.digest()
+
+
+class ImageHasher:
+    def __init__(self, db_config, root_dataset_dir, workers=16, batch_size=5000,
+                 read_size=4 << 20, force=False, only_missing=False):
+        self.db_config = db_config
+        self.base_dir = Path(root_dataset_dir).parent
+        self.workers = workers
+        self.batch_size = batch_size
+        self.read_size = read_size
+        self.force = force
+        self.only_missing = only_missing
+
+    def check_file(self, row):
+        """
+        返回 (status, update_tuple)，status 为 skipped / hashed / missing
+        """
+        image_id, _, dir_path, file_path, old_hash, old_size, old_mtime = row
+        path = self.base_dir / dir_path / file_path
+        try:
+            st = os.stat(path)
+            mtime = file_mtime(st)
+            if (not self.force and old_hash is not None
+                    and old_size == st.st_size and old_mtime == mtime):
+                return "skipped", None
+            digest = sha256_file(path, self.read_size)
+        except OSError as e:
+            print(f"[WARN] {path}: {e}")
+            return "missing", None
+        return "hashed", (image_id, psycopg2.Binary(digest), st.st_size, mtime)
+
+    def run(self):
+        where = "AND i.file_hash IS NULL" if self.only_missing else ""
+        select_sql = SELECT_SQL.format(where=where)
+        counts = {"skipped": 0, "hashed": 0, "missing": 0}
+        changed_datasets = set()
+        last_id = "00000000-0000-0000-0000-000000000000"
+        t0 = time.time()
+
+        conn = psycopg2.connect(**self.db_config)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while True:
+                    with conn, conn.cursor() as cur:
+                        cur.execute(select_sql, (last_id, self.batch_size))
+                        rows = cur.fetchall()
+                        if not rows:
+                            break
+
+                        updates = []
+                        for row, (status, update) in zip(rows, pool.map(self.check_file, rows)):
+                            counts[status] += 1
+                            if update is not None:
+                                updates.append(update)
+                                changed_datasets.add(row[1])
+                        if updates:
+                            execute_values(cur, UPDATE_SQL, updates,
+                                           template=UPDATE_TEMPLATE, page_size=1000)
+                    last_id = rows[-1][0]
+                    total = sum(counts.values())
+                    print(f"{total} files checked ({total / (time.time() - t0):.0f}/s), "
+                          f"hashed {counts['hashed']}, skipped {counts['skipped']}, "
+                          f"missing {counts['missing']}, last id {last_id}")
+
+            if changed_datasets:
+                with conn, conn.cursor() as cur:
+                    cur.execute("SELECT refresh_dataset_stats(%s::uuid[])",
+                                ([str(d) for d in changed_datasets],))
+        finally:
+            conn.close()
+        print(f"Done in {time.time() - t0:.1f}s: {counts}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill images.file_hash / file_size / last_modified")
+    parser.add_argument("root_dataset_dir", help="数据集根目录（与 ImportParquetDataset 的 root_dataset_dir 相同）")
+    parser.add_argument("--workers", type=int, default=16, help="并行读取文件的线程数")
+    parser.add_argument("--batch-size", type=int, default=5000, help="每页读取、写回的行数")
+    parser.add_argument("--read-size", type=int, default=4, help="每次顺序读取的大小（MiB）")
+    parser.add_argument("--force", action="store_true", help="忽略 size/mtime，全部重新计算")
+    parser.add_argument("--only-missing", action="store_true", help="只处理 file_hash 为空的图片")
+    args = parser.parse_args()
+
+    ImageHasher(DB_CONFIG, args.root_dataset_dir, workers=args.workers, batch_size=args.batch_size,
+                read_size=args.read_size << 20, force=args.force,
+                only_missing=args.only_missing).run()
@@ -4,6 +4,8 @@ import psycopg2
 from psycopg2.extras import execute_values
 from tqdm import tqdm
 
+import ImportManifest
+
 DB_CONFIG = {
     'dbname': 'image_dataset_db4',
     'user': 'postgres',
@@ -13,6 +15,10 @@ DB_CONFIG = {
 }
 
 
+# batch_import 写入的表，记录在 import_manifest.tables 中
+JSON_TABLES = ["images", "image_features", "image_captions", "image_tags", "image_pose"]
+
+
 def connect_db():
     return psycopg2.connect(**DB_CONFIG)
 
@@ -51,139 +57,187 @@ def get_or_create_dataset(cur, dataset_root_dir, json_dir):
     return cur.fetchone()[0]
 
 
-def batch_import(root_dir):
+def refresh_dataset_stats(cur, dataset_ids):
+    """按数据集重算 dataset_stats（见 schema2.sql 中的 refresh_dataset_stats）"""
+    cur.execute("SELECT refresh_dataset_stats(%s::uuid[])",
+                ([str(d) for d in dataset_ids],))
+
+
+def import_info_file(cur, root_dir, info_path):
+    """导入一个 ImageInfo.json，返回 (dataset_id, 记录数)"""
+    with open(info_path, 'r', encoding='utf-8') as f:
+        json_records = json.load(f)
+    print(f'Importing {info_path}')
+
+    if not isinstance(json_records, list):
+        json_records = [json_records]
+
+    images_records = []
+    captions_records = []
+    tags_records = []
+    pose_records = []
+    features_records = []
+
+    # 获取 dataset_id，保证 dataset.name 是顶层，dir_path 保留相对路径
+    dataset_id = get_or_create_dataset(
+        cur, root_dir, os.path.dirname(info_path))
+
+    for data in tqdm(json_records, desc=f"Records in {os.path.basename(info_path)}", leave=False):
+        file_path = data["IMG"]
+        file_format = file_path.split(
+            '.')[-1].lower() if '.' in file_path else None
+
+        # images 记录
+        images_records.append((
+            dataset_id,
+            file_path,
+            None,  # file_hash
+            None,  # file_size
+            file_format,
+            None,  # last_modified
+            data.get("W"),
+            data.get("H"),
+            data.get("A_EAT"),
+            data.get("HAS_WATERMARK"),
+            data.get("Q512"),
+            data.get("A")
+        ))
+
+    # 批量插入 images 并返回 id
+    insert_images_sql = """
+    INSERT INTO images
+    (dataset_id, file_path, file_hash, file_size, file_format, last_modified,
+     width, height, aesthetic_eat, watermark_prob,
+     quality_score, aesthetic_score)
+    VALUES %s
+    ON CONFLICT (dataset_id, file_path) DO UPDATE SET
+      file_format = EXCLUDED.file_format,
+      width = EXCLUDED.width,
+      height = EXCLUDED.height,
+      aesthetic_eat = EXCLUDED.aesthetic_eat,
+      watermark_prob = EXCLUDED.watermark_prob,
+      quality_score = EXCLUDED.quality_score,
+      aesthetic_score = EXCLUDED.aesthetic_score
+    RETURNING id, file_path
+    """
+    inserted_images = execute_values(
+        cur, insert_images_sql, images_records, fetch=True)
+
+    # 建立 file_path -> image_id 映射
+    file_path_to_id = {row[1]: row[0]
+                       for row in inserted_images}
+
+    # captions / tags / pose
+    for data in json_records:
+        file_path = data["IMG"]
+        image_id = file_path_to_id.get(file_path)
+        if not image_id:
+            continue
+
+        # semantic_center 存在 image_features
+        if data.get("A_CENTER") is not None:
+            features_records.append((image_id, data["A_CENTER"]))
+
+        # captions
+        for c in data.get("CAP", []):
+            captions_records.append((image_id, c, 'generic'))
+        for c in data.get("HQ_CAP", []):
+            captions_records.append((image_id, c, 'hq'))
+
+        # tags
+        tag_str = data.get("DBRU_TAG", "")
+        tags = [t.strip()
+                for t in tag_str.split(",")] if tag_str else []
+        if tags:
+            tags_records.append((image_id, tags))
+
+        # poses
+        poses = data.get("POSE_KPTS", [])
+        for idx, pose in enumerate(poses):
+            bbox = pose.get("BBOX")
+            invalid_kpts_idx = pose.get("INVLD_KPTS_IDX", [])
+            kpts_x = pose.get("KPTS_X", [])
+            kpts_y = pose.get("KPTS_Y", [])
+            pose_records.append((
+                image_id,
+                idx,
+                bbox,
+                invalid_kpts_idx,
+                kpts_x,
+                kpts_y
+            ))
+
+    if features_records:
+        insert_features_sql = """
+        INSERT INTO image_features (image_id, semantic_center)
+        VALUES %s
+        ON CONFLICT (image_id) DO UPDATE SET semantic_center = EXCLUDED.semantic_center
+        """
+        execute_values(cur, insert_features_sql, features_records)
+
+    if captions_records:
+        insert_captions_sql = """
+        INSERT INTO image_captions (image_id, caption, caption_type)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        """
+        execute_values(cur, insert_captions_sql,
+                       captions_records)
+
+    if tags_records:
+        insert_tags_sql = """
+        INSERT INTO image_tags (image_id, tags)
+        VALUES %s
+        ON CONFLICT (image_id) DO UPDATE SET tags = EXCLUDED.tags
+        """
+        execute_values(cur, insert_tags_sql, tags_records)
+
+    if pose_records:
+        insert_pose_sql = """
+        INSERT INTO image_pose (image_id, pose_index, bbox, invalid_kpts_idx, kpts_x, kpts_y)
+        VALUES %s
+        ON CONFLICT (image_id, pose_index) DO NOTHING
+        """
+        execute_values(cur, insert_pose_sql, pose_records)
+
+    refresh_dataset_stats(cur, [dataset_id])
+    return dataset_id, len(json_records)
+
+
+def batch_import(root_dir, force=False):
+    """
+    导入 root_dir 下所有 ImageInfo.json，每个文件一个事务。
+    用 import_manifest 跳过未变化的文件（见 ImportManifest.check_file），force=True 时全部重新导入；
+    中断后重新运行会跳过已提交的文件
+    """
     conn = connect_db()
     try:
-        with conn:
-            with conn.cursor() as cur:
-                imageinfo_files = find_imageinfo_files(root_dir)
-                print(
-                    f"Found {len(imageinfo_files)} ImageInfo.json files under {root_dir}")
-
-                for info_path in imageinfo_files:
-                    with open(info_path, 'r', encoding='utf-8') as f:
-                        json_records = json.load(f)
-                    print(f'Importing {info_path}')
-
-                    if not isinstance(json_records, list):
-                        json_records = [json_records]
-
-                    images_records = []
-                    captions_records = []
-                    tags_records = []
-                    pose_records = []
-
-                    # 获取 dataset_id，保证 dataset.name 是顶层，dir_path 保留相对路径
-                    dataset_id = get_or_create_dataset(
-                        cur, root_dir, os.path.dirname(info_path))
-
-                    for data in tqdm(json_records, desc=f"Records in {os.path.basename(info_path)}", leave=False):
-                        file_path = data["IMG"]
-                        file_format = file_path.split(
-                            '.')[-1].lower() if '.' in file_path else None
-
-                        # images 记录
-                        images_records.append((
-                            dataset_id,
-                            file_path,
-                            None,  # file_hash
-                            None,  # file_size
-                            file_format,
-                            None,  # last_modified
-                            data.get("W"),
-                            data.get("H"),
-                            data.get("A_CENTER"),
-                            data.get("A_EAT"),
-                            data.get("HAS_WATERMARK"),
-                            data.get("Q512"),
-                            data.get("A")
-                        ))
-
-                    # 批量插入 images 并返回 id
-                    insert_images_sql = """
-                    INSERT INTO images
-                    (dataset_id, file_path, file_hash, file_size, file_format, last_modified,
-                     width, height, semantic_center, aesthetic_eat, watermark_prob,
-                     quality_score, aesthetic_score)
-                    VALUES %s
-                    ON CONFLICT (dataset_id, file_path) DO UPDATE SET
-                      file_format = EXCLUDED.file_format,
-                      width = EXCLUDED.width,
-                      height = EXCLUDED.height,
-                      semantic_center = EXCLUDED.semantic_center,
-                      aesthetic_eat = EXCLUDED.aesthetic_eat,
-                      watermark_prob = EXCLUDED.watermark_prob,
-                      quality_score = EXCLUDED.quality_score,
-                      aesthetic_score = EXCLUDED.aesthetic_score
-                    RETURNING id, file_path
-                    """
-                    inserted_images = execute_values(
-                        cur, insert_images_sql, images_records, fetch=True)
-
-                    # 建立 file_path -> image_id 映射
-                    file_path_to_id = {row[1]: row[0]
-                                       for row in inserted_images}
-
-                    # captions / tags / pose
-                    for data in json_records:
-                        file_path = data["IMG"]
-                        image_id = file_path_to_id.get(file_path)
-                        if not image_id:
-                            continue
-
-                        # captions
-                        for c in data.get("CAP", []):
-                            captions_records.append((image_id, c, 'generic'))
-                        for c in data.get("HQ_CAP", []):
-                            captions_records.append((image_id, c, 'hq'))
-
-                        # tags
-                        tag_str = data.get("DBRU_TAG", "")
-                        tags = [t.strip()
-                                for t in tag_str.split(",")] if tag_str else []
-                        if tags:
-                            tags_records.append((image_id, tags))
-
-                        # poses
-                        poses = data.get("POSE_KPTS", [])
-                        for idx, pose in enumerate(poses):
-                            bbox = pose.get("BBOX")
-                            invalid_kpts_idx = pose.get("INVLD_KPTS_IDX", [])
-                            kpts_x = pose.get("KPTS_X", [])
-                            kpts_y = pose.get("KPTS_Y", [])
-                            pose_records.append((
-                                image_id,
-                                idx,
-                                bbox,
-                                invalid_kpts_idx,
-                                kpts_x,
-                                kpts_y
-                            ))
-
-                    if captions_records:
-                        insert_captions_sql = """
-                        INSERT INTO image_captions (image_id, caption, caption_type)
-                        VALUES %s
-                        ON CONFLICT DO NOTHING
-                        """
-                        execute_values(cur, insert_captions_sql,
-                                       captions_records)
-
-                    if tags_records:
-                        insert_tags_sql = """
-                        INSERT INTO image_tags (image_id, tags)
-                        VALUES %s
-                        ON CONFLICT (image_id) DO UPDATE SET tags = EXCLUDED.tags
-                        """
-                        execute_values(cur, insert_tags_sql, tags_records)
-
-                    if pose_records:
-                        insert_pose_sql = """
-                        INSERT INTO image_pose (image_id, pose_index, bbox, invalid_kpts_idx, kpts_x, kpts_y)
-                        VALUES %s
-                        ON CONFLICT (image_id, pose_index) DO NOTHING
-                        """
-                        execute_values(cur, insert_pose_sql, pose_records)
+        imageinfo_files = find_imageinfo_files(root_dir)
+        print(
+            f"Found {len(imageinfo_files)} ImageInfo.json files under {root_dir}")
+
+        rel_paths = {p: os.path.relpath(p, os.path.dirname(root_dir)) for p in imageinfo_files}
+        entries = {}
+        if not force:
+            with conn, conn.cursor() as cur:
+                entries = ImportManifest.fetch_entries(cur, rel_paths.values())
+
+        skipped = 0
+        for info_path, rel_path in rel_paths.items():
+            action, _, size, mtime, content_hash = ImportManifest.check_file(
+                entries.get(rel_path), info_path, JSON_TABLES)
+            with conn, conn.cursor() as cur:
+                if action in ("skip", "touch"):
+                    if action == "touch":
+                        ImportManifest.touch_file(cur, rel_path, size, mtime)
+                    skipped += 1
+                    continue
+                # JSON 文件整体导入，没有批次断点：清单行与数据在同一事务中写入
+                dataset_id, num_records = import_info_file(cur, root_dir, info_path)
+                ImportManifest.start_file(cur, rel_path, dataset_id, size, mtime,
+                                          content_hash, JSON_TABLES, num_records)
+                ImportManifest.finish_file(cur, rel_path)
+        print(f"Skipped {skipped} unchanged files")
 
     finally:
         conn.close()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+import_manifest 表的读写（见 schema2.sql），ImportParquetDataset / ImportJsonDataset 共用
+
+判断一个 ImageInfo 文件是否需要导入（check_file）：
+  1. 清单中状态为 done，大小、mtime 和目标表都没变 -> skip（不读文件）
+  2. 大小或 mtime 变了，但内容哈希相同 -> touch（只更新清单中的大小和 mtime）
+  3. 状态为 running 且内容未变 -> resume（从 rows_done 继续）
+  4. 其余 -> import（从头导入）
+"""
+
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def file_signature(path):
+    """返回 (大小, mtime)；mtime 截断到微秒，与 TIMESTAMPTZ 精度一致"""
+    st = os.stat(path)
+    return st.st_size, EPOCH + timedelta(microseconds=st.st_mtime_ns // 1000)
+
+
+def sha256_file(path, read_size=4 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(read_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.digest()
+
+
+def fetch_entries(cur, file_paths):
+    """返回 {file_path: 清单行 dict}"""
+    cur.execute("""
+        SELECT file_path, file_size, file_mtime, content_hash, tables, rows_done, status
+        FROM import_manifest
+        WHERE file_path = ANY(%s)
+    """, (list(file_paths),))
+    columns = [d[0] for d in cur.description]
+    return {row[0]: dict(zip(columns, row)) for row in cur.fetchall()}
+
+
+def is_unchanged(entry, size, mtime, tables):
+    """不读文件内容的快速判断：已完成且大小、mtime、目标表都没变"""
+    return (entry is not None and entry["status"] == "done"
+            and entry["file_size"] == size and entry["file_mtime"] == mtime
+            and sorted(entry["tables"]) == sorted(tables))
+
+
+def check_file(entry, path, tables):
+    """
+    返回 (action, start_row, size, mtime, content_hash)，action 为 skip / touch / resume / import
+    """
+    size, mtime = file_signature(path)
+    if is_unchanged(entry, size, mtime, tables):
+        return "skip", None, size, mtime, bytes(entry["content_hash"])
+
+    if entry is not None and sorted(entry["tables"]) == sorted(tables):
+        same_signature = entry["file_size"] == size and entry["file_mtime"] == mtime
+        content_hash = bytes(entry["content_hash"]) if same_signature else sha256_file(path)
+        if content_hash == bytes(entry["content_hash"]):
+            if entry["status"] == "done":
+                return "touch", None, size, mtime, content_hash
+            return "resume", entry["rows_done"], size, mtime, content_hash
+    else:
+        content_hash = sha256_file(path)
+    return "import", 0, size, mtime, content_hash
+
+
+def start_file(cur, file_path, dataset_id, size, mtime, content_hash, tables, total_rows=None):
+    """开始（重新）导入：清单行置为 running，rows_done 归零"""
+    cur.execute("""
+        INSERT INTO import_manifest
+            (file_path, dataset_id, file_size, file_mtime, content_hash, tables, total_rows,
+             rows_done, status, started_at, finished_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, 0, 'running', now(), NULL)
+        ON CONFLICT (file_path) DO UPDATE SET
+            dataset_id = EXCLUDED.dataset_id,
+            file_size = EXCLUDED.file_size,
+            file_mtime = EXCLUDED.file_mtime,
+            content_hash = EXCLUDED.content_hash,
+            tables = EXCLUDED.tables,
+            total_rows = EXCLUDED.total_rows,
+            rows_done = 0,
+            status = 'running',
+            started_at = now(),
+            finished_at = NULL
+    """, (file_path, str(dataset_id), size, mtime, psycopg2.Binary(content_hash),
+          sorted(tables), total_rows))
+
+
+def checkpoint(cur, file_path, rows_done):
+    """记录已写入的行数，与该批数据在同一事务中提交"""
+    cur.execute("UPDATE import_manifest SET rows_done = %s WHERE file_path = %s",
+                (rows_done, file_path))
+
+
+def finish_file(cur, file_path):
+    cur.execute("""
+        UPDATE import_manifest
+        SET status = 'done', rows_done = coalesce(total_rows, rows_done), finished_at = now()
+        WHERE file_path = %s
+    """, (file_path,))
+
+
+def touch_file(cur, file_path, size, mtime):
+    """内容未变、只有大小或 mtime 变化（例如被复制过）时更新清单，下次走快速判断"""
+    cur.execute("UPDATE import_manifest SET file_size = %s, file_mtime = %s WHERE file_path = %s",
+                (size, mtime, file_path))
@@ -6,8 +6,12 @@ Parquet -> PostgreSQL 同步工具（封装为 ParquetSyncer 类）
 - 支持 dry-run（可查询数据库但不写入、不提交）
 - 保留并使用你最开始的处理函数（process_tags / generate_pose_index / explode_caption / process_table 等）
 - dry-run 会打印每个表将写入的行数与前 5 条样例，并在结束时打印汇总
+- import_manifest 记录已导入的文件：未变化的文件直接跳过，中断的导入从最后提交的批次继续
 """
 
+import io
+import os
+import numpy as np
 import polars as pl
 from pathlib import Path
 from psycopg2.extras import execute_values
@@ -15,9 +19,12 @@ import psycopg2
 from tqdm import tqdm
 import uuid
 import hashlib
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
 from LocalDatasetHelper import DatasetDectector
+import ImportManifest
 
 # --------------------------- 示例数据库配置（请按需修改） ---------------------------
 DB_CONFIG = {
@@ -106,6 +113,99 @@ def explode_caption(df: pl.DataFrame, col: str, context: Dict) -> pl.DataFrame:
     return out
 
 
+# image_features.embedding 的存储格式（见 schema2.sql）：小端 float16 字节串
+EMBEDDING_DTYPE = np.dtype("<f2")
+
+
+def encode_embedding(df: pl.DataFrame, col: str, context: Dict) -> pl.DataFrame:
+    """
+    把 list[float] 的 embedding 列整体转成 float16 字节串列 'embedding'：
+      - 非空行拼成一个 (n, dim) 矩阵一次转换，不逐行调用 Python
+      - 空值 / 空列表输出 NULL；parquet 中没有该列时整列为 NULL
+    """
+    if col not in df.columns:
+        return df.with_columns(pl.lit(None, dtype=pl.Binary).alias("embedding"))
+
+    s = df[col]
+    valid = (s.is_not_null() & (s.list.len() > 0)).to_numpy()
+    blobs = np.full(len(df), None, dtype=object)
+    if valid.any():
+        lengths = s.filter(pl.Series(valid)).list.len().unique().to_list()
+        if len(lengths) != 1:
+            raise ValueError(f"Column '{col}' has inconsistent embedding dimensions: {sorted(lengths)}")
+        mat = (
+            s.filter(pl.Series(valid)).explode().to_numpy()
+            .astype(EMBEDDING_DTYPE).reshape(-1, lengths[0])
+        )
+        row_bytes = mat.shape[1] * EMBEDDING_DTYPE.itemsize
+        buf = mat.tobytes()
+        blobs[valid] = [buf[i:i + row_bytes] for i in range(0, len(buf), row_bytes)]
+    return df.with_columns(pl.Series("embedding", blobs.tolist(), dtype=pl.Binary))
+
+
+# UUID 文本中各段在 32 位 hex 中的位置：(目标起点, 目标终点, hex 起点)
+UUID_HEX_SLICES = ((0, 8, 0), (9, 13, 8), (14, 18, 12), (19, 23, 16), (24, 36, 20))
+
+
+def deterministic_image_ids(dataset_id: str, paths: pl.Series) -> pl.Series:
+    """
+    新图片的固定 UUID：sha1(f"{dataset_id}/{path}") 的前 16 字节，与 str(uuid.UUID(h[:32])) 结果相同
+      - 摘要拼成一个字节串后整体转 hex，再用 NumPy 切片插入 '-'，不逐行构造 uuid.UUID
+    """
+    prefix = f"{dataset_id}/".encode("utf-8")
+    digests = b"".join([hashlib.sha1(prefix + p.encode("utf-8")).digest()[:16]
+                        for p in paths.to_list()])
+    hexs = np.frombuffer(digests.hex().encode("ascii"), dtype=np.uint8).reshape(-1, 32)
+    out = np.full((len(hexs), 36), ord("-"), dtype=np.uint8)
+    for start, end, src in UUID_HEX_SLICES:
+        out[:, start:end] = hexs[:, src:src + end - start]
+    return pl.Series("image_id", out.view("S36").ravel()).cast(pl.Utf8)
+
+
+def quote_array_element(e: pl.Expr) -> pl.Expr:
+    # 数组字面量中的字符串元素：转义 \\ 和 "，再加双引号
+    return pl.concat_str([pl.lit('"'), e.str.replace_all("\\", "\\\\", literal=True)
+                          .str.replace_all('"', '\\"', literal=True), pl.lit('"')])
+
+
+def to_copy_frame(frame: pl.DataFrame) -> pl.DataFrame:
+    """
+    把待写入的 DataFrame 转成可以直接 write_csv 后 COPY ... (FORMAT csv) 的文本列：
+      - list 列 -> PostgreSQL 数组字面量 '{1,2,NULL}'（字符串元素加引号转义）
+      - Binary 列 -> bytea hex 格式 '\\x...'
+      - 其它列交给 write_csv（NULL 写成不带引号的空值，空字符串写成 ""，与 COPY csv 一致）
+    全部是 Polars 表达式，不逐行调用 Python
+    """
+    exprs = []
+    for name, dtype in frame.schema.items():
+        col = pl.col(name)
+        if isinstance(dtype, pl.Array):
+            dtype = pl.List(dtype.inner)
+            col = col.cast(dtype)
+        if isinstance(dtype, pl.List):
+            inner = dtype.inner
+            if isinstance(inner, (pl.List, pl.Array, pl.Struct)):
+                raise ValueError(f"Column '{name}' has unsupported nested type {dtype}")
+            if inner == pl.Utf8:
+                element = quote_array_element(pl.element())
+            else:
+                element = pl.element().cast(pl.Utf8)
+            exprs.append(pl.concat_str([
+                pl.lit("{"),
+                col.list.eval(element.fill_null("NULL")).list.join(","),
+                pl.lit("}"),
+            ]).alias(name))
+        elif dtype == pl.Binary:
+            exprs.append(pl.concat_str([pl.lit("\\x"), col.bin.encode("hex")]).alias(name))
+        else:
+            exprs.append(col)
+    return frame.select(exprs)
+
+
+# 流式读取时，mapping 处理（clone / explode / select）和 COPY 缓冲区相对单批 DataFrame 的额外内存倍数（经验值）
+STREAM_MEMORY_FACTOR = 4
+
+
 # --------------------------- ParquetSyncer 类（封装主流程与 dry-run 行为） ---------------------------
 
 class ParquetSyncer:
@@ -117,15 +217,38 @@ class ParquetSyncer:
       syncer.run([images_mapping, poses_mapping, captions_mapping, tags_mapping])
     """
 
-    def __init__(self, db_config: Dict[str, Any], root_dataset_dir: str, dry_run: bool = False):
+    def __init__(self, db_config: Dict[str, Any], root_dataset_dir: str, dry_run: bool = False,
+                 scan_cache_file: Optional[str] = None, load_mode: str = "values",
+                 copy_batch_rows: int = 200_000, workers: int = 1,
+                 memory_limit_mb: Optional[int] = None, stream_probe_rows: int = 1000,
+                 use_manifest: bool = True, force: bool = False):
         """
         :param db_config: psycopg2 连接配置 dict
         :param root_dataset_dir: Parquet 根目录
         :param dry_run: 是否 dry-run（True：只做查询，不写入、不提交）
+        :param scan_cache_file: 目录扫描缓存文件（见 LocalDatasetHelper.DatasetDectector），None 表示不用缓存
+        :param load_mode: 'values'：execute_values 逐批 INSERT；'copy'：COPY 到临时表后一条 INSERT ... SELECT 合并
+            两种模式的写入速度尚未实测（utils/BenchParquetLoad.py），默认保持 'values'
+        :param copy_batch_rows: copy 模式下每次 COPY 的行数（限制 CSV 缓冲区大小）
+        :param workers: 并行导入的进程数；每个进程独立连接，每个 parquet 文件一个事务
+        :param memory_limit_mb: 每个进程导入时的内存上限（MiB）；设置后按批流式读取 parquet，None 表示整个文件一次读入
+        :param stream_probe_rows: 流式读取时第一批的行数，用来估算每行内存
+        :param use_manifest: 使用 import_manifest 跳过未变化的文件，并在每批写入后提交、记录断点
+        :param force: 忽略清单中的记录，重新导入所有文件（仍会更新清单）
         """
+        if load_mode not in ("values", "copy"):
+            raise ValueError("load_mode must be 'values' or 'copy'")
         self.db_config = db_config
         self.root_dataset_dir = Path(root_dataset_dir)
         self.dry_run = dry_run
+        self.scan_cache_file = scan_cache_file
+        self.load_mode = load_mode
+        self.copy_batch_rows = copy_batch_rows
+        self.workers = workers
+        self.memory_limit_mb = memory_limit_mb
+        self.stream_probe_rows = stream_probe_rows
+        self.use_manifest = use_manifest
+        self.force = force
         self.conn: Optional[psycopg2.extensions.connection] = None
 
         # dry-run 汇总统计（仅用于 dry_run=True）
@@ -148,6 +271,15 @@ class ParquetSyncer:
             self.conn = None
 
     # ---------- dataset 行为 ----------
+    def dataset_dir_path(self, dataset_root_dir: str, parquet_dir: Path) -> str:
+        """
+        datasets.dir_path：parquet 所在目录相对于 dataset_root_dir 父目录的路径
+        """
+        try:
+            return str(Path(parquet_dir).relative_to(Path(dataset_root_dir).parent))
+        except ValueError:
+            return str(parquet_dir)
+
     def get_or_create_dataset(self, cur, dataset_root_dir: str, parquet_dir: Path) -> str:
         """
         获取或创建 datasets 表记录
@@ -158,71 +290,124 @@ class ParquetSyncer:
         dataset_root_dir: root path string（用于计算相对路径），通常为 self.root_dataset_dir
         parquet_dir: Parquet 文件所在目录（Path）
         """
-        parquet_path = Path(parquet_dir)
-        dataset_root_path = Path(dataset_root_dir)
-        dataset_name = parquet_path.name
-        parent_of_dataset_root = dataset_root_path.parent
+        return self.prefetch_dataset_ids(cur, dataset_root_dir, [parquet_dir])[Path(parquet_dir)]
 
-        try:
-            rel_dir_path = str(
-                parquet_path.relative_to(parent_of_dataset_root))
-        except ValueError:
-            rel_dir_path = str(parquet_path)
+    def prefetch_dataset_ids(self, cur, dataset_root_dir: str, parquet_dirs: List[Path]) -> Dict[Path, str]:
+        """
+        批量获取或创建 datasets 记录，返回 {parquet_dir: dataset_id}
+          - 一次 SELECT 查出全部已有数据集
+          - 缺少的用一条 INSERT ... SELECT unnest(...) 创建；dry-run 下只打印并分配随机 uuid
+        """
+        dir_paths = {Path(d): self.dataset_dir_path(dataset_root_dir, d) for d in parquet_dirs}
 
         # 查询是否已有该记录（SELECT 始终执行）
-        cur.execute("SELECT id FROM datasets WHERE dir_path = %s",
-                    (rel_dir_path,))
-        row = cur.fetchone()
-        if row:
-            return row[0]
+        cur.execute("SELECT dir_path, id FROM datasets WHERE dir_path = ANY(%s)",
+                    (list(dir_paths.values()),))
+        existing = dict(cur.fetchall())
 
-        # 如果不存在：dry-run 下不插入，直接打印并返回临时 id
-        if self.dry_run:
-            print(
-                f"[DRY-RUN] Would create dataset: name={dataset_name}, dir_path={rel_dir_path}")
-            return str(uuid.uuid4())
-
-        # 正常写入
-        cur.execute("""
-            INSERT INTO datasets (name, dir_path, created_at)
-            VALUES (%s, %s, now())
-            RETURNING id
-        """, (dataset_name, rel_dir_path))
-        return cur.fetchone()[0]
+        missing = sorted({p for p in dir_paths.values() if p not in existing})
+        if missing:
+            names = [Path(p).name for p in missing]
+            if self.dry_run:
+                # 如果不存在：dry-run 下不插入，直接打印并返回临时 id
+                for name, dir_path in zip(names, missing):
+                    print(
+                        f"[DRY-RUN] Would create dataset: name={name}, dir_path={dir_path}")
+                    existing[dir_path] = str(uuid.uuid4())
+            else:
+                # 正常写入
+                cur.execute("""
+                    INSERT INTO datasets (name, dir_path, created_at)
+                    SELECT name, dir_path, now() FROM unnest(%s::text[], %s::text[]) AS t(name, dir_path)
+                    RETURNING dir_path, id
+                """, (names, missing))
+                existing.update(cur.fetchall())
+
+        return {d: existing[p] for d, p in dir_paths.items()}
+
+    def fetch_existing_image_ids(self, cur, paths: pl.Series, dataset_id: str) -> pl.DataFrame:
+        """
+        查询 paths 中已在数据库里的图片（SELECT 总是允许，dry-run 也会执行）
+          - 路径用 COPY 写入临时表，再与 images 按 (dataset_id, file_path) 连接，结果同样用 COPY 读回
+        返回 DataFrame[IMG, image_id]
+        """
+        buf = io.BytesIO()
+        paths.to_frame("IMG").write_csv(buf, include_header=False)
+        buf.seek(0)
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS tmp_image_paths (file_path TEXT)")
+        cur.execute("TRUNCATE tmp_image_paths")
+        cur.copy_expert("COPY tmp_image_paths (file_path) FROM STDIN WITH (FORMAT csv)", buf)
+        cur.execute("ANALYZE tmp_image_paths")
+
+        out = io.BytesIO()
+        cur.copy_expert(cur.mogrify("""
+            COPY (
+                SELECT i.file_path, i.id
+                FROM tmp_image_paths t
+                JOIN images i ON i.dataset_id = %s AND i.file_path = t.file_path
+            ) TO STDOUT WITH (FORMAT csv)
+        """, (str(dataset_id),)).decode(), out)
+        schema = {"IMG": pl.Utf8, "image_id": pl.Utf8}
+        if out.tell() == 0:
+            return pl.DataFrame(schema=schema)
+        out.seek(0)
+        return pl.read_csv(out, has_header=False, new_columns=list(schema), schema=schema)
 
     def generate_or_fetch_image_id(self, cur, df: pl.DataFrame, dataset_id: str) -> pl.DataFrame:
         """
         给 DataFrame 生成 image_id：
-        - 先查询数据库已有的 image_id（SELECT 总是允许）
-        - 对于不存在的文件路径，用 sha1(dataset_id + path) 生成固定 UUID
+        - 先查询数据库已有的 image_id（见 fetch_existing_image_ids）
+        - 对于不存在的文件路径，用 sha1(dataset_id + path) 生成固定 UUID（见 deterministic_image_ids）
         返回带有 image_id 列的 DataFrame
         """
-        img_paths = df["IMG"].to_list()
-        # SELECT 操作（dry-run 也会运行）
-        cur.execute("""
-            SELECT file_path, id
-            FROM images
-            WHERE dataset_id = %s AND file_path = ANY(%s)
-        """, (dataset_id, img_paths))
-        existing = dict(cur.fetchall())
-
-        def _get_or_create_uuid(img_path: str) -> str:
-            if img_path in existing:
-                return existing[img_path]
-            else:
-                # 生成 deterministic UUID（使用 sha1 的前 32 hex 字符）
-                h = hashlib.sha1(
-                    f"{dataset_id}/{img_path}".encode("utf-8")).hexdigest()
-                return str(uuid.UUID(h[:32]))
-
-        # ✅ 正确写法
+        paths = df["IMG"].unique()
+        existing = self.fetch_existing_image_ids(cur, paths, dataset_id)
+        new_paths = paths.filter(~paths.is_in(existing["IMG"]))
+        ids = pl.concat([
+            existing,
+            pl.DataFrame([new_paths.alias("IMG"), deterministic_image_ids(dataset_id, new_paths)]),
+        ])
         return df.with_columns(
-            pl.col("IMG").map_elements(_get_or_create_uuid,
-                                       return_dtype=pl.Utf8).alias("image_id")
+            pl.col("IMG").replace_strict(ids["IMG"], ids["image_id"],
+                                         return_dtype=pl.Utf8).alias("image_id")
         )
 
     # ---------- 批量 insert/update ----------
 
+    def record_dry_run(self, table_name: str, columns: List[str], num_rows: int, samples: List[tuple]):
+        """
+        dry-run: 把统计记入 self.tables_counts / samples 并打印
+        """
+        self.tables_counts[table_name] += num_rows
+        # 保留至多前 5 条样例
+        existing_samples = self.tables_samples[table_name]
+        existing_samples.extend(samples[:5 - len(existing_samples)])
+        print(
+            f"[DRY-RUN] Would insert {num_rows} rows into '{table_name}' columns={columns}")
+
+    @staticmethod
+    def build_conflict_sql(table_name: str, columns: List[str], pk_cols: List[str],
+                           update_mode: str = "overwrite") -> str:
+        """
+        构造 ON CONFLICT 子句：
+          - overwrite: 非主键列用新值覆盖
+          - null_only: 只填充数据库中为 NULL 的列
+        没有非主键列时返回空字符串（与原来一样不加 ON CONFLICT）
+        """
+        non_pk_cols = [c for c in columns if c not in pk_cols]
+        if not non_pk_cols:
+            return ""
+        if update_mode == "overwrite":
+            update_sql = ", ".join(
+                [f"{c}=EXCLUDED.{c}" for c in non_pk_cols])
+        elif update_mode == "null_only":
+            update_sql = ", ".join(
+                [f"{c}=COALESCE(EXCLUDED.{c},{table_name}.{c})" for c in non_pk_cols])
+        else:
+            raise ValueError(
+                "update_mode must be 'overwrite' or 'null_only'")
+        return f" ON CONFLICT ({','.join(pk_cols)}) DO UPDATE SET {update_sql}"
+
     def insert_or_update(self, cur, table_name: str, columns: List[str], records: List[tuple],
                          pk_cols: List[str], update_mode: str = "overwrite"):
         """
@@ -234,48 +419,85 @@ class ParquetSyncer:
             return
 
         if self.dry_run:
-            # 记录统计信息并打印样例
-            self.tables_counts[table_name] += len(records)
-            # 保留至多前 5 条样例
-            existing_samples = self.tables_samples[table_name]
-            for r in records:
-                if len(existing_samples) < 5:
-                    existing_samples.append(r)
-                else:
-                    break
-            print(
-                f"[DRY-RUN] Would insert {len(records)} rows into '{table_name}' columns={columns}")
-            # for r in records[:5]:
-            #     print("   sample:", r)
+            self.record_dry_run(table_name, columns, len(records), records[:5])
             return
 
-        # 非 dry-run：构造 ON CONFLICT 更新 SQL
-        non_pk_cols = [c for c in columns if c not in pk_cols]
-        update_sql = ""
-        if non_pk_cols:
-            if update_mode == "overwrite":
-                update_sql = ", ".join(
-                    [f"{c}=EXCLUDED.{c}" for c in non_pk_cols])
-            elif update_mode == "null_only":
-                update_sql = ", ".join(
-                    [f"{c}=COALESCE(EXCLUDED.{c},{table_name}.{c})" for c in non_pk_cols])
-            else:
-                raise ValueError(
-                    "update_mode must be 'overwrite' or 'null_only'")
-
         sql = f"""
         INSERT INTO {table_name} ({','.join(columns)})
         VALUES %s
         """
-        if update_sql:
-            sql += f" ON CONFLICT ({','.join(pk_cols)}) DO UPDATE SET {update_sql}"
+        sql += self.build_conflict_sql(table_name, columns, pk_cols, update_mode)
 
         # 使用 execute_values 批量提交
         execute_values(cur, sql, records)
 
+    def copy_merge(self, cur, table_name: str, frame: pl.DataFrame, pk_cols: List[str],
+                   update_mode: str = "overwrite"):
+        """
+        COPY 批量写入：
+          1. 按 (表, 列) 建临时暂存表（临时表不写 WAL，本连接私有，多进程导入互不干扰）
+          2. frame 转成 CSV 文本（to_copy_frame），每 copy_batch_rows 行一次 COPY ... FROM STDIN
+          3. 一条 INSERT ... SELECT ... ON CONFLICT 合并到目标表，overwrite / null_only 语义与 insert_or_update 相同
+        frame 须已按主键去重（process_frame 已处理）
+        """
+        if frame.height == 0:
+            return
+        columns = frame.columns
+
+        if self.dry_run:
+            self.record_dry_run(table_name, columns, frame.height, frame.head(5).rows())
+            return
+
+        col_sql = ",".join(columns)
+        staging = f"stg_{table_name}_{hashlib.sha1(col_sql.encode()).hexdigest()[:8]}"
+        cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging} AS "
+                    f"SELECT {col_sql} FROM {table_name} WITH NO DATA")
+        cur.execute(f"TRUNCATE {staging}")
+
+        copy_frame = to_copy_frame(frame)
+        for offset in range(0, copy_frame.height, self.copy_batch_rows):
+            buf = io.BytesIO()
+            copy_frame.slice(offset, self.copy_batch_rows).write_csv(buf, include_header=False)
+            buf.seek(0)
+            cur.copy_expert(f"COPY {staging} ({col_sql}) FROM STDIN WITH (FORMAT csv)", buf)
+
+        sql = f"INSERT INTO {table_name} ({col_sql}) SELECT {col_sql} FROM {staging}"
+        sql += self.build_conflict_sql(table_name, columns, pk_cols, update_mode)
+        cur.execute(sql)
+
+    def write_mapping(self, cur, df: pl.DataFrame, mapping: Dict[str, Any], context: Dict[str, Any]):
+        """
+        对一个 mapping 执行 process_frame 并按 load_mode 写入
+        """
+        pk_cols = mapping["primaryKey"]["columns"]
+        update_mode = mapping.get("update_mode", "overwrite")
+        frame, columns = self.process_frame(df, mapping, context)
+        if self.load_mode == "copy":
+            self.copy_merge(cur, mapping["table"], frame, pk_cols, update_mode)
+        else:
+            self.insert_or_update(cur, mapping["table"], columns, frame.rows(),
+                                  pk_cols, update_mode)
+
+    def refresh_dataset_stats(self, cur, dataset_ids: List[str]):
+        """
+        按数据集重算 dataset_stats（见 schema2.sql 中的 refresh_dataset_stats）
+          - dry-run: 不执行
+        """
+        if self.dry_run or not dataset_ids:
+            return
+        cur.execute("SELECT refresh_dataset_stats(%s::uuid[])",
+                    ([str(d) for d in dataset_ids],))
+
     def process_table(self, df: pl.DataFrame, mapping: Dict[str, Any], context: Dict[str, Any] = {}) -> Tuple[List[tuple], List[str]]:
         """
-        将 Parquet DataFrame 转为可插入数据库的 records
+        将 Parquet DataFrame 转为可插入数据库的 records（list of tuples，可直接传递给 execute_values）
+        """
+        frame, target_columns = self.process_frame(df, mapping, context)
+        return frame.rows(), target_columns
+
+    def process_frame(self, df: pl.DataFrame, mapping: Dict[str, Any], context: Dict[str, Any] = {}) -> Tuple[pl.DataFrame, List[str]]:
+        """
+        将 Parquet DataFrame 转为只含目标列的 DataFrame
 
         参数：
         - df: 原始 DataFrame
@@ -283,8 +505,8 @@ class ParquetSyncer:
         - context: 可选上下文（例如 dataset_id，或 generate_image_id 函数等）
 
         返回：
-        - records: list of tuples（可直接传递给 execute_values）
-        - target_columns: 列顺序（与 records 中的顺序一致）
+        - frame: 按主键去重、只含目标列的 DataFrame
+        - target_columns: 列顺序（与 frame 中的顺序一致）
         """
         df_proc = df.clone()
 
@@ -350,22 +572,14 @@ class ParquetSyncer:
         if pk_cols:
             df_proc = df_proc.unique(subset=pk_cols)
 
-        # 按目标列选取并转换为 records（list of tuples）
+        # 按目标列选取
         # 注意：如果某些列不存在 above 将在 earlier 的检查阶段触发异常
-        records = df_proc.select(target_columns).rows()
-        # 将内部 list 转为 tuple（execute_values 接受 iterable of sequences，这里 list 也可）
-        #records = [tuple(r.to_list()) for r in records]
-        return records, target_columns
+        target_columns = list(target_columns)
+        return df_proc.select(target_columns), target_columns
 
     # ---------- 主流程 ----------
-    def run(self, mappings: List[Dict[str, Any]]):
-        """
-        主执行入口：
-          - 遍历 root_dataset_dir 下所有 parquet 文件
-          - 对每个文件执行映射并写入数据库（或 dry-run 打印）
-        :param mappings: mapping 列表（每个 mapping 形如你给出的 images_mapping 等）
-        """
-        parquet_detector = DatasetDectector(self.root_dataset_dir)
+    def find_parquet_files(self) -> List[Path]:
+        parquet_detector = DatasetDectector(self.root_dataset_dir, cacheFile=self.scan_cache_file)
         parquet_detector.scanDir(True)
 
         parquet_files = []
@@ -376,7 +590,128 @@ class ParquetSyncer:
                     pass  # 不处理JSON
                 elif ext == ".parquet":
                     parquet_files.append(imageInfoFile)
+        return parquet_files
+
+    def iter_parquet_batches(self, pq_file: Path, start_row: int = 0) -> Iterator[pl.DataFrame]:
+        """
+        从第 start_row 行开始读取 parquet：
+          - 未设置 memory_limit_mb：整个文件一次读入
+          - 设置后用 scan_parquet + slice 分批读取（slice 下推到 parquet reader，只解码所需的 row group），
+            第一批 stream_probe_rows 行，之后按上一批实测的每行内存调整批大小，
+            使 单批大小 * STREAM_MEMORY_FACTOR 不超过 memory_limit_mb
+        """
+        if not self.memory_limit_mb:
+            yield pl.read_parquet(pq_file).slice(start_row)
+            return
+
+        lf = pl.scan_parquet(pq_file)
+        total_rows = lf.select(pl.len()).collect().item()
+        budget = self.memory_limit_mb << 20
+        batch_rows = self.stream_probe_rows
+        offset = start_row
+        while offset < total_rows:
+            batch = lf.slice(offset, batch_rows).collect()
+            if batch.height == 0:
+                break
+            offset += batch.height
+            row_bytes = max(1, batch.estimated_size() // batch.height)
+            yield batch
+            del batch
+            batch_rows = max(1, budget // (STREAM_MEMORY_FACTOR * row_bytes))
+
+    def sync_file(self, pq_file: Path, dataset_id: str, mappings: List[Dict[str, Any]]):
+        """
+        导入单个 parquet 文件：
+          - 按 iter_parquet_batches 分批读取，每批经过全部 mapping 写入后再读下一批
+          - use_manifest: 先用 import_manifest 判断文件是否变化（见 ImportManifest.check_file），
+            未变化则跳过；每批写入后与断点一起提交，中断后下次从断点继续
+          - 不用清单时整个文件一个事务
+          - 非 dry-run 成功后提交，失败回滚并抛出异常；dry-run 始终回滚
+        """
+        manifest_path = self.dataset_dir_path(str(self.root_dataset_dir), pq_file)
+        tables = [m["table"] for m in mappings]
+        checkpoints = self.use_manifest and not self.dry_run
+        context = {
+            "dataset_id": dataset_id,
+        }
+        try:
+            with self.conn.cursor() as cur:
+                start_row = 0
+                if self.use_manifest:
+                    entry = None if self.force else \
+                        ImportManifest.fetch_entries(cur, [manifest_path]).get(manifest_path)
+                    action, start_row, size, mtime, content_hash = ImportManifest.check_file(
+                        entry, pq_file, tables)
+                    if action in ("skip", "touch"):
+                        if action == "touch" and not self.dry_run:
+                            ImportManifest.touch_file(cur, manifest_path, size, mtime)
+                            self.conn.commit()
+                        else:
+                            self.conn.rollback()
+                        return
+                    if action == "import" and checkpoints:
+                        total_rows = pl.scan_parquet(pq_file).select(pl.len()).collect().item()
+                        ImportManifest.start_file(cur, manifest_path, dataset_id, size, mtime,
+                                                  content_hash, tables, total_rows)
+                        self.conn.commit()
+
+                rows_done = start_row
+                for df in self.iter_parquet_batches(pq_file, start_row):
+                    if df.height == 0:
+                        continue
+                    rows_done += df.height
+
+                    # 生成或获取 image_id（会执行 SELECT 查询以获取已存在 image_id）
+                    df = self.generate_or_fetch_image_id(cur, df, dataset_id)
+
+                    # 对每个 mapping 执行 process_frame -> insert_or_update / copy_merge
+                    for mapping in mappings:
+                        self.write_mapping(cur, df, mapping, context)
+                    del df
+
+                    # 记录断点，与这批数据一起提交
+                    if checkpoints:
+                        ImportManifest.checkpoint(cur, manifest_path, rows_done)
+                        self.conn.commit()
+
+                # 刷新该数据集的 dataset_stats
+                self.refresh_dataset_stats(cur, [dataset_id])
+                if checkpoints:
+                    ImportManifest.finish_file(cur, manifest_path)
+        except Exception:
+            self.conn.rollback()
+            raise
+        if self.dry_run:
+            self.conn.rollback()
+        else:
+            self.conn.commit()
+
+    def skip_unchanged_files(self, cur, parquet_files: List[Path], tables: List[str]) -> List[Path]:
+        """
+        用一次清单查询过滤掉大小、mtime、目标表都没变的已完成文件（不读文件内容），
+        其余文件在 sync_file 中再按内容哈希判断
+        """
+        rel_paths = {f: self.dataset_dir_path(str(self.root_dataset_dir), f) for f in parquet_files}
+        entries = ImportManifest.fetch_entries(cur, rel_paths.values())
+        remaining = []
+        for pq_file, rel_path in rel_paths.items():
+            size, mtime = ImportManifest.file_signature(pq_file)
+            if not ImportManifest.is_unchanged(entries.get(rel_path), size, mtime, tables):
+                remaining.append(pq_file)
+        print(f"Skipped {len(parquet_files) - len(remaining)} unchanged files")
+        return remaining
 
+    def run(self, mappings: List[Dict[str, Any]]):
+        """
+        主执行入口：
+          - 遍历 root_dataset_dir 下所有 parquet 文件，跳过清单中未变化的文件，
+            批量获取或创建对应的 datasets 记录
+          - 对每个文件执行映射并写入数据库（或 dry-run 打印），每个文件（使用清单时每批）单独提交
+          - workers > 1 时用进程池并行处理文件，每个进程一个连接
+          - 单个文件失败不影响其它文件，结束时列出失败的文件
+        :param mappings: mapping 列表（每个 mapping 形如你给出的 images_mapping 等）
+        """
+        parquet_files = self.find_parquet_files()
         if not parquet_files:
             print("No parquet files found under", str(self.root_dataset_dir))
             return
@@ -385,50 +720,96 @@ class ParquetSyncer:
         self.connect_db()
         try:
             with self.conn.cursor() as cur:
-                # 遍历 parquet 文件
-                for pq_file in tqdm(parquet_files, desc="Sync Parquet Files"):
-                    # 1) 获取或创建 dataset（注意：get_or_create_dataset 中 SELECT 总会执行，
-                    #    dry-run 下不会 INSERT）
-                    dataset_id = self.get_or_create_dataset(
-                        cur, str(self.root_dataset_dir), pq_file.parent)
-
-                    # 2) 读取 parquet 到 polars DataFrame
-                    df = pl.read_parquet(pq_file)
-
-                    # 3) 生成或获取 image_id（会执行 SELECT 查询以获取已存在 image_id）
-                    df = self.generate_or_fetch_image_id(cur, df, dataset_id)
+                if self.use_manifest and not self.force:
+                    parquet_files = self.skip_unchanged_files(
+                        cur, parquet_files, [m["table"] for m in mappings])
+                dataset_ids = self.prefetch_dataset_ids(
+                    cur, str(self.root_dataset_dir), [f.parent for f in parquet_files])
+            if not self.dry_run:
+                self.conn.commit()
 
-                    context = {
-                        "dataset_id": dataset_id,
-                    }
+            failed = []
+            if self.workers > 1:
+                failed = self.run_parallel(parquet_files, dataset_ids, mappings)
+            else:
+                for pq_file in tqdm(parquet_files, desc="Sync Parquet Files"):
+                    try:
+                        self.sync_file(pq_file, dataset_ids[pq_file.parent], mappings)
+                    except Exception as e:
+                        print(f"[ERROR] {pq_file}: {e!r}")
+                        failed.append(pq_file)
 
-                    # 5) 对每个 mapping 执行 process_table -> insert_or_update
-                    for mapping in mappings:
-                        records, columns = self.process_table(
-                            df, mapping, context)
-                        self.insert_or_update(cur,
-                                              mapping["table"],
-                                              columns,
-                                              records,
-                                              mapping["primaryKey"]["columns"],
-                                              mapping.get("update_mode", "overwrite"))
-
-            # 6) 如果不是 dry-run，提交事务；dry-run 则不 commit（不写入）
             if not self.dry_run:
-                self.conn.commit()
-                print("Committed changes to database.")
+                print(f"Committed {len(parquet_files) - len(failed)} files to database.")
             else:
                 print("[DRY-RUN] No changes committed to database. Summary below:")
                 # dry-run 汇总输出
                 for table_name, count in self.tables_counts.items():
                     print(f"  table '{table_name}': would insert {count} rows")
-                    # samples = self.tables_samples.get(table_name, [])
-                    # for s in samples:
-                    #     print("     sample:", s)
+            if failed:
+                print(f"{len(failed)} files failed:")
+                for pq_file in failed:
+                    print("  ", pq_file)
 
         finally:
             self.close_db()
 
+    def run_parallel(self, parquet_files: List[Path], dataset_ids: Dict[Path, str],
+                     mappings: List[Dict[str, Any]]) -> List[Path]:
+        """
+        进程池并行导入，返回失败的文件
+          - 用 spawn 启动进程（Polars 的线程池不能安全 fork）
+          - 每个进程的 Polars 线程数限制为 CPU 数 / workers，避免线程过量
+        """
+        os.environ.setdefault("POLARS_MAX_THREADS", str(max(1, (os.cpu_count() or 1) // self.workers)))
+        options = {
+            "dry_run": self.dry_run,
+            "load_mode": self.load_mode,
+            "copy_batch_rows": self.copy_batch_rows,
+            "memory_limit_mb": self.memory_limit_mb,
+            "stream_probe_rows": self.stream_probe_rows,
+            "use_manifest": self.use_manifest,
+            "force": self.force,
+        }
+        init_args = (self.db_config, str(self.root_dataset_dir), options)
+        failed = []
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=init_args) as pool:
+            futures = {
+                pool.submit(_sync_file_in_worker, pq_file, dataset_ids[pq_file.parent], mappings): pq_file
+                for pq_file in parquet_files
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Sync Parquet Files"):
+                pq_file = futures[future]
+                try:
+                    counts = future.result()
+                except Exception as e:
+                    print(f"[ERROR] {pq_file}: {e!r}")
+                    failed.append(pq_file)
+                    continue
+                for table_name, count in counts.items():
+                    self.tables_counts[table_name] += count
+        return failed
+
+
+# --------------------------- 进程池 worker ---------------------------
+# 每个 worker 进程持有一个 ParquetSyncer 和一个连接，由 ParquetSyncer.run_parallel 使用
+_worker_syncer: Optional[ParquetSyncer] = None
+
+
+def _init_worker(db_config, root_dataset_dir, options):
+    global _worker_syncer
+    _worker_syncer = ParquetSyncer(db_config, root_dataset_dir, **options)
+    _worker_syncer.connect_db()
+
+
+def _sync_file_in_worker(pq_file: Path, dataset_id: str, mappings: List[Dict[str, Any]]) -> Dict[str, int]:
+    """导入一个文件，返回 dry-run 统计（table_name -> 行数）"""
+    _worker_syncer.tables_counts.clear()
+    _worker_syncer.sync_file(pq_file, dataset_id, mappings)
+    return dict(_worker_syncer.tables_counts)
+
 
 # --------------------------- mapping 定义（与最开始你给的一致） ---------------------------
 # 注意：这些 mapping 使用上面定义的处理函数（generate_pose_index、explode_caption、process_tags）
@@ -440,12 +821,10 @@ images_mapping = {
         "dataset_id": "dataset_id",  # 仅 images 表
         "W": "width",
         "H": "height",
-        'A_CENTER': 'semantic_center',
         'A_EAT': 'aesthetic_eat',
         'HAS_WATERMARK': 'watermark_prob',
         'Q512': 'quality_score',
         'A': 'aesthetic_score',
-        'IMG_EMBD': 'image_embedding'
     },
     "primaryKey": {
         "columns": ["id"]
@@ -454,6 +833,23 @@ images_mapping = {
     "ignore_if_missing": True
 }
 
+# semantic_center / embedding 写入 image_features（从 images 拆出的大字段表）
+features_mapping = {
+    "table": "image_features",
+    "rules": {
+        'A_CENTER': 'semantic_center',
+        "IMG_EMBD": {
+            "target": ["embedding"],
+            "func": encode_embedding
+        }
+    },
+    "primaryKey": {
+        "columns": ["image_id"]
+    },
+    "update_mode": "null_only",
+    "ignore_if_missing": True
+}
+
 poses_mapping = {
     "table": "image_pose",
     "rules": {
@@ -504,15 +900,17 @@ tags_mapping = {
     "ignore_if_missing": True
 }
 
-ALL_MAPPINGS = [images_mapping]#, poses_mapping, captions_mapping, tags_mapping]
+ALL_MAPPINGS = [images_mapping, features_mapping]#, poses_mapping, captions_mapping, tags_mapping]
 
 
 # --------------------------- CLI / main 使用示例 ---------------------------
 if __name__ == "__main__":
-    # 你可以在这里修改 root_dataset_dir 与 dry_run
+    # 你可以在这里修改 root_dataset_dir、dry_run、workers（并行导入的进程数）
+    # 与 memory_limit_mb（每个进程的内存上限，大文件按批流式导入）
     root_dataset_dir = "/mnt/yuansnas/Backup/big_server/ds/DiffusionDataset"
     syncer = ParquetSyncer(db_config=DB_CONFIG,
-                           root_dataset_dir=root_dataset_dir, dry_run=False)
+                           root_dataset_dir=root_dataset_dir, dry_run=False,
+                           workers=min(8, os.cpu_count() or 1), memory_limit_mb=2048)
 
     # 运行（dry-run=True：仅查询、打印样例、不会写入）
     syncer.run(ALL_MAPPINGS)
@@ -1,55 +1,215 @@
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
+CACHE_VERSION = 1
+
+
 class DatasetDectector:
-    def __init__(self, topDir) -> None:
-        self.topDir = topDir
+    """
+    查找 topDir 下含 ImageInfo 文件的数据集目录
+
+    含 ImageInfo 文件的目录视为一个数据集，不再向下查找；其余目录用 os.scandir 列出子目录。
+    每个目录是线程池里的一个任务，NAS 上的目录读取延迟由多个线程重叠。
+
+    指定 cacheFile 时保存一份目录缓存：
+      - 非数据集目录记录 mtime 和子目录名，下次扫描时 mtime 未变就直接用缓存的子目录，不再列目录
+      - 数据集目录记录 ImageInfo 文件的大小和 mtime，与上次比较得到 新增 / 删除 / 修改 的数据集
+    数据集目录里通常有大量图片，这里只 stat ImageInfo 文件，从不列出数据集目录。
+    """
+
+    def __init__(self, topDir, cacheFile=None, workers=16,
+                 ImageInfoFileNameList=('ImageInfo.json', 'ImageInfo.parquet')) -> None:
+        self.topDir = Path(topDir)
+        self.cacheFile = Path(cacheFile) if cacheFile else None
+        self.workers = workers
+        self.ImageInfoFileNameList = list(ImageInfoFileNameList)
         self.imageInfoFilesInDir = []
         self.dirsHasNotImageInfo = []
+        self.newDatasets = []
+        self.removedDatasets = []
+        self.modifiedDatasets = []
 
     def scanDir(self, printScanResult=False):
-        self.imageInfoFilesInDir, self.dirsHasNotImageInfo = self.detectImageInfoFolder(
-            self.topDir)
+        oldCache = self.loadCache()
+        nodes = self.walk(oldCache)
+
+        self.imageInfoFilesInDir = []
+        self.dirsHasNotImageInfo = []
+        self.collect(self.topDir, nodes)
+        self.diffDatasets(oldCache, nodes)
+        if self.cacheFile:
+            self.saveCache(nodes)
 
         if printScanResult:
             print(
                 'Scan Result (--: Has ImageInfofile, ??: Has not ImageInfofile)')
-            for dir in self.imageInfoFilesInDir:
-                print('--', dir)
+            for infoFiles in self.imageInfoFilesInDir:
+                print('--', infoFiles[0].parent)
             for dir in self.dirsHasNotImageInfo:
                 print('??', dir)
+            print(f'Datasets: {len(self.newDatasets)} new, {len(self.modifiedDatasets)} modified, '
+                  f'{len(self.removedDatasets)} removed')
 
     def detectImageInfoFolder(self, path, ImageInfoFileNameList=['ImageInfo.json', 'ImageInfo.parquet']):
-        imageInfoFilesInDir = []
-        dirsHasNotImageInfo = []
-        dir_HasImageInfo = {}
+        """
+        兼容旧接口：不使用缓存扫描 path，返回 (imageInfoFilesInDir, dirsHasNotImageInfo)
+        """
+        detector = DatasetDectector(path, workers=self.workers,
+                                    ImageInfoFileNameList=ImageInfoFileNameList)
+        nodes = detector.walk({})
+        detector.collect(detector.topDir, nodes)
+        return detector.imageInfoFilesInDir, detector.dirsHasNotImageInfo
 
-        current_path = Path(path)
-        for imageInfoFile in ImageInfoFileNameList:
-            imageInfoPath = current_path/Path(imageInfoFile)
-            if imageInfoPath.is_file():
-                imageInfoFilesInDir.append(imageInfoPath)
+    # ---------- 扫描 ----------
+    def relKey(self, path):
+        return path.relative_to(self.topDir).as_posix()
 
-        if len(imageInfoFilesInDir) > 0:
-            return (imageInfoFilesInDir,), dirsHasNotImageInfo
+    def visitDir(self, path, oldCache):
+        """
+        扫描单个目录，返回节点：
+          数据集目录: {"infoFiles": [Path], "signatures": {文件名: [size, mtime_ns]}, "subdirs": []}
+          其它目录:   {"infoFiles": [], "mtime_ns": int, "subdirs": [子目录名]}
+        """
+        infoFiles = []
+        signatures = {}
+        for name in self.ImageInfoFileNameList:
+            try:
+                st = os.stat(path / name)
+            except OSError:
+                continue
+            infoFiles.append(path / name)
+            signatures[name] = [st.st_size, st.st_mtime_ns]
+        if infoFiles:
+            return {"infoFiles": infoFiles, "signatures": signatures, "subdirs": []}
+
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError as e:
+            print(f'[WARN] {path}: {e}')
+            return {"infoFiles": [], "mtime_ns": None, "subdirs": []}
+
+        cached = oldCache.get("dirs", {}).get(self.relKey(path))
+        if cached is not None and cached["mtime_ns"] == mtime_ns:
+            subdirs = cached["subdirs"]
         else:
-            for entry in current_path.iterdir():
-                if entry.is_dir():
-                    imageInfoFilesInDir_, dirsHasNotImageInfo_ = self.detectImageInfoFolder(
-                        entry)
-                    imageInfoFilesInDir.extend(imageInfoFilesInDir_)
-                    dirsHasNotImageInfo.extend(dirsHasNotImageInfo_)
-                    if len(imageInfoFilesInDir_) > 0:
-                        dir_HasImageInfo[entry] = True
-                    else:
-                        dir_HasImageInfo[entry] = False
+            subdirs = []
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir():
+                                subdirs.append(entry.name)
+                        except OSError:
+                            pass
+            except OSError as e:
+                print(f'[WARN] {path}: {e}')
+            subdirs.sort()
+        return {"infoFiles": [], "mtime_ns": mtime_ns, "subdirs": subdirs}
+
+    def walk(self, oldCache):
+        """
+        从 topDir 开始并行广度优先扫描，返回 {Path: 节点}
+        """
+        nodes = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {pool.submit(self.visitDir, self.topDir, oldCache): self.topDir}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    node = future.result()
+                    nodes[path] = node
+                    for name in node["subdirs"]:
+                        child = path / name
+                        pending[pool.submit(self.visitDir, child, oldCache)] = child
+        return nodes
+
+    def collect(self, path, nodes):
+        """
+        与原递归实现的结果一致：
+          imageInfoFilesInDir: 每个数据集一个 ImageInfo 文件列表
+          dirsHasNotImageInfo: 兄弟目录中有数据集、自身子树中却没有数据集的目录
+        返回 path 子树中是否有数据集
+        """
+        node = nodes[path]
+        if node["infoFiles"]:
+            self.imageInfoFilesInDir.append(node["infoFiles"])
+            return True
+
+        dir_HasImageInfo = {}
+        for name in node["subdirs"]:
+            child = path / name
+            dir_HasImageInfo[child] = self.collect(child, nodes)
+
+        if any(dir_HasImageInfo.values()):
+            for child, hasImageInfo in dir_HasImageInfo.items():
+                if not hasImageInfo:
+                    self.dirsHasNotImageInfo.append(child)
+            return True
+        return False
+
+    # ---------- 缓存 ----------
+    def loadCache(self):
+        if not self.cacheFile or not self.cacheFile.is_file():
+            return {}
+        try:
+            with open(self.cacheFile, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'[WARN] Ignore scan cache {self.cacheFile}: {e}')
+            return {}
+        if cache.get("version") != CACHE_VERSION or cache.get("topDir") != str(self.topDir):
+            return {}
+        return cache
+
+    def saveCache(self, nodes):
+        cache = {"version": CACHE_VERSION, "topDir": str(self.topDir), "dirs": {}, "datasets": {}}
+        for path, node in nodes.items():
+            key = self.relKey(path)
+            if node["infoFiles"]:
+                cache["datasets"][key] = node["signatures"]
+            elif node["mtime_ns"] is not None:
+                cache["dirs"][key] = {"mtime_ns": node["mtime_ns"], "subdirs": node["subdirs"]}
 
-            if len(imageInfoFilesInDir) > 0:
-                for path, hasImageInfo in dir_HasImageInfo.items():
-                    if not hasImageInfo:
-                        dirsHasNotImageInfo.append(path)
+        tmpFile = self.cacheFile.with_name(self.cacheFile.name + '.tmp')
+        with open(tmpFile, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tmpFile, self.cacheFile)
 
-            return imageInfoFilesInDir, dirsHasNotImageInfo
+    def diffDatasets(self, oldCache, nodes):
+        oldDatasets = oldCache.get("datasets", {})
+        currentKeys = set()
+        self.newDatasets = []
+        self.modifiedDatasets = []
+        for path, node in nodes.items():
+            if not node["infoFiles"]:
+                continue
+            key = self.relKey(path)
+            currentKeys.add(key)
+            if key not in oldDatasets:
+                self.newDatasets.append(path)
+            elif oldDatasets[key] != node["signatures"]:
+                self.modifiedDatasets.append(path)
+        self.removedDatasets = [self.topDir / key for key in oldDatasets if key not in currentKeys]
+        self.newDatasets.sort()
+        self.modifiedDatasets.sort()
+        self.removedDatasets.sort()
 
 
+if __name__ == '__main__':
+    import argparse
 
+    parser = argparse.ArgumentParser(description='Find dataset folders containing ImageInfo files')
+    parser.add_argument('topDir')
+    parser.add_argument('--cache', default=None, help='目录缓存文件，用于增量扫描和变化报告')
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
 
+    detector = DatasetDectector(args.topDir, cacheFile=args.cache, workers=args.workers)
+    detector.scanDir(True)
+    for title, dirs in (('New', detector.newDatasets), ('Modified', detector.modifiedDatasets),
+                        ('Removed', detector.removedDatasets)):
+        for dir in dirs:
+            print(f'[{title}]', dir)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+把 images.image_embedding / images.semantic_center 迁移到 image_features 表
+
+步骤：
+  1. 先执行 schema2.sql 中 image_features 表、索引和触发器的 DDL
+  2. python MigrateImageFeatures.py
+     按 id 分批读取旧列，embedding 转成 float16 字节串写入 image_features，每批提交一次。
+     已存在的 image_features 行不会被覆盖（可能是迁移期间新导入的数据），重复执行是安全的；
+     中断后可用 --start-after <最后输出的 id> 继续
+  3. 确认后端、导入器都已切换到新表，再执行
+     python MigrateImageFeatures.py --drop-columns [--vacuum-full]
+     DROP COLUMN 只是把列标记为删除，需要 VACUUM FULL（或 pg_repack）重写 images 才会真正缩小
+"""
+
+import argparse
+import time
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+
+DB_CONFIG = {
+    'dbname': 'image_dataset_db4',
+    'user': 'postgres',
+    'password': 'example',
+    'host': 'localhost',
+    'port': 5432
+}
+
+# 与 schema2.sql / models.Float16Vector 一致：小端 float16
+EMBEDDING_DTYPE = np.dtype("<f2")
+
+SELECT_SQL = """
+SELECT id, image_embedding, semantic_center
+FROM images
+WHERE id > %s AND (image_embedding IS NOT NULL OR semantic_center IS NOT NULL)
+ORDER BY id
+LIMIT %s
+"""
+
+INSERT_SQL = """
+INSERT INTO image_features (image_id, embedding, semantic_center)
+VALUES %s
+ON CONFLICT (image_id) DO NOTHING
+"""
+
+
+def encode_embedding(values):
+    if values is None:
+        return None
+    return psycopg2.Binary(np.asarray(values, dtype=EMBEDDING_DTYPE).tobytes())
+
+
+def copy_features(conn, batch_size, start_after):
+    last_id = start_after
+    total = 0
+    t0 = time.time()
+    while True:
+        with conn, conn.cursor() as cur:
+            cur.execute(SELECT_SQL, (last_id, batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            execute_values(cur, INSERT_SQL, [
+                (image_id, encode_embedding(embedding), center)
+                for image_id, embedding, center in rows
+            ], page_size=1000)
+        last_id = rows[-1][0]
+        total += len(rows)
+        print(f"{total} rows copied, last id {last_id} ({total / (time.time() - t0):.0f} rows/s)")
+    print(f"Done, {total} rows copied")
+
+
+def drop_columns(conn, vacuum_full):
+    with conn, conn.cursor() as cur:
+        cur.execute("ALTER TABLE images DROP COLUMN IF EXISTS image_embedding, DROP COLUMN IF EXISTS semantic_center")
+    print("Dropped images.image_embedding / images.semantic_center")
+    if vacuum_full:
+        # VACUUM 不能在事务中执行；VACUUM FULL 期间 images 表被锁
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("VACUUM FULL ANALYZE images")
+        print("Rewrote images with VACUUM FULL")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move image embeddings out of the images table")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--start-after", default="00000000-0000-0000-0000-000000000000",
+                        help="从这个图片 id 之后继续")
+    parser.add_argument("--drop-columns", action="store_true", help="删除 images 上的旧列（先完成复制）")
+    parser.add_argument("--vacuum-full", action="store_true", help="删除旧列后用 VACUUM FULL 重写 images")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        if args.drop_columns:
+            drop_columns(conn, args.vacuum_full)
+        else:
+            copy_features(conn, args.batch_size, args.start_after)
+    finally:
+        conn.close()